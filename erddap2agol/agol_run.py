@@ -3,6 +3,7 @@ from arcgis.gis import GIS
 from .src import erddap_client as ec
 from .src import das_client as dc
 from .src import ago_wrapper as aw
+from .src import nrt_scheduler as ns
 from .tests import test_params as tp
 from .logs import updatelog as ul
 
@@ -19,11 +20,9 @@ def main():
     gcload = ec.erddapGcoos
 
     das_resp = ec.ERDDAPHandler.getDas(gcload, datasetid)
-    parsed_response = dc.parseDasResponse(das_resp)
-    parsed_response = dc.convertToDict(parsed_response)
-    dc.saveToJson(parsed_response, datasetid)
+    dc.saveDas(das_resp, datasetid, gcload.server)
 
-    # now we have the das info downloaded and parsed into json
+    # now we have the das info downloaded and stored
     # lets find what attributes are available
     
     attribute_list = dc.getActualAttributes(dc.openDasJson(datasetid))
@@ -55,3 +54,9 @@ def main():
     seed_url = "None"
 
     ul.updateLog(gcload.datasetid, table_id, seed_url, full_url, gcload.end_time, ul.get_current_time())
+
+
+# Long running NRT updates for a scheduled AGOL notebook. Each item is polled on its own cadence,
+# stopAfter (seconds) ends the run before the notebook's time limit, the schedule is saved for the next one.
+def nrtScheduler(stopAfter: float = None):
+    ns.runScheduler(stopAfter=stopAfter)
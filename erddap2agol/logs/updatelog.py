@@ -97,5 +97,24 @@ def updateCallFromNRT(boolPref) -> dict:
         print("No match found.")
         return {}
 
+# Rewrites lastest_data and last_update on the row for itemID after an incremental update
+def updateLatestData(itemID, lastest_data, last_update) -> None:
+    logpath = checkforDB()
+
+    with open(logpath, 'r') as file:
+        lines = file.readlines()
+
+    for index, line in enumerate(lines[1:], start=1):
+        columns = line.strip().split(",")
+        if len(columns) > 6 and itemID == columns[1]:
+            columns[4] = str(lastest_data)
+            columns[5] = str(last_update)
+            lines[index] = ",".join(columns) + "\n"
+
+    temppath = logpath + ".tmp"
+    with open(temppath, 'w') as file:
+        file.writelines(lines)
+    os.replace(temppath, logpath)
+
 def get_current_time() -> str:
     return str(datetime.datetime.now().isoformat())
\ No newline at end of file
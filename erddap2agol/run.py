@@ -1,6 +1,7 @@
 from .src import erddap_client as ec
 from .src import level_manager as lm
 from .src import core
+from .src import nrt_scheduler as ns
 from arcgis.gis import GIS
 
 #-----------------ERDDAP2AGOL CUI-----------------
@@ -12,6 +13,7 @@ def cui():
         print("GCOOS GIS, 2024.")
         print("\n1. Create ERDDAP Items Individually.")
         print("2. Create ERDDAP NRT Items")
+        print("3. Keep NRT Items Updated (runs until Ctrl-C)")
 
         user_choice = input(": ")  
 
@@ -19,6 +21,8 @@ def cui():
             create_erddap_item_menu()
         elif user_choice == "2":
             nrt_creation()
+        elif user_choice == "3":
+            nrt_scheduler()
         else:
             print("Invalid input. Please try again.")
 
@@ -118,6 +122,13 @@ def nrt_creation():
             core.processListInput(NRT_IDs, gcload, 1)
         
 
+def nrt_scheduler():
+    print("\nNRT Scheduler")
+    print("Each NRT item is polled on its own update cadence. Press Ctrl-C to stop.")
+    ns.runScheduler()
+    cui()
+
+
 def exit_program():
     print("\nExiting program...")
     exit()
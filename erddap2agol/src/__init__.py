@@ -1,4 +1,15 @@
 from . import ago_wrapper
 from . import glob_var
 from . import erddap_client
-from . import das_client
\ No newline at end of file
+from . import das_client
+from . import metadata_store
+from . import transport
+from . import catalog_cache
+from . import das_fetcher
+from . import chunked_download
+from . import response_formats
+from . import obs_cache
+from . import tabledap_query
+from . import decimate
+from . import pipeline
+from . import nrt_scheduler
\ No newline at end of file
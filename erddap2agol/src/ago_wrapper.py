@@ -2,7 +2,9 @@ from arcgis.gis import GIS
 from arcgis.features import FeatureLayer, FeatureLayerCollection
 from . import erddap_client as ec
 from . import das_client as dc
-import copy, json
+import copy, json, re
+from datetime import timezone
+import pandas as pd
 
 gis = GIS("home")
 
@@ -70,6 +72,82 @@ def publishTable(item_prop: dict, geom_params: dict, path):
     except Exception as e:
         print(f"An error occurred adding the item: {e}")
 
+# Features sent per edit_features call when appending rows
+EDIT_BATCH_SIZE = 1000
+
+def getFeatureLayer(itemid: str):
+    try:
+        item = gis.content.get(itemid)
+        return item.layers[0] if item and item.layers else None
+    except Exception as e:
+        print(f"An error occurred getting the layer for {itemid}: {e}")
+        return None
+
+# Maps csv headers to layer fields. Publishing keeps the csv header as the field alias,
+# the field name is the header with anything that isn't a word character replaced by _
+def matchFields(layer, columns: list) -> dict:
+    fields = layer.properties.fields
+    matched = {}
+    for column in columns:
+        sanitized = re.sub(r"\W", "_", column)
+        for field in fields:
+            if column in (field["alias"], field["name"]) or field["name"] == sanitized:
+                matched[column] = field
+                break
+    return matched
+
+# Adds the rows of a csvp frame to a hosted layer as point features, returns the number added.
+# header is the csv header the layer was published from, in frame column order.
+def appendRows(layer, frame: pd.DataFrame, erddapObj: "ec.ERDDAPHandler", header: list) -> int:
+    fields = matchFields(layer, header)
+    names = [column.split(" (")[0] for column in header]
+    lon_index = names.index(erddapObj.longitude)
+    lat_index = names.index(erddapObj.latitude)
+
+    features = []
+    for row in frame.itertuples(index=False):
+        attributes = {}
+        for column, value in zip(header, row):
+            field = fields.get(column)
+            if field is None:
+                continue
+            if pd.isna(value):
+                value = None
+            elif isinstance(value, pd.Timestamp):
+                value = int(value.timestamp() * 1000)
+            elif hasattr(value, "item"):
+                # numpy scalars aren't JSON serializable
+                value = value.item()
+            attributes[field["name"]] = value
+        features.append({"attributes": attributes,
+                         "geometry": {"x": float(row[lon_index]), "y": float(row[lat_index]),
+                                      "spatialReference": {"wkid": 4326}}})
+
+    added = 0
+    for start in range(0, len(features), EDIT_BATCH_SIZE):
+        try:
+            result = layer.edit_features(adds=features[start:start + EDIT_BATCH_SIZE])
+            added += sum(1 for entry in result.get("addResults", []) if entry.get("success"))
+        except Exception as e:
+            print(f"An error occurred appending features: {e}")
+            break
+    return added
+
+# Deletes features whose time field is older than cutoff (a UTC datetime, aware or naive), returns the count deleted
+def deleteBefore(layer, timeColumn: str, cutoff) -> int:
+    if cutoff.tzinfo is not None:
+        cutoff = cutoff.astimezone(timezone.utc)
+    field = matchFields(layer, [timeColumn]).get(timeColumn)
+    if field is None:
+        print(f"No field matching {timeColumn} in {layer.url}")
+        return 0
+    try:
+        result = layer.delete_features(where=f"{field['name']} < timestamp '{cutoff:%Y-%m-%d %H:%M:%S}'")
+        return sum(1 for entry in result.get("deleteResults", []) if entry.get("success"))
+    except Exception as e:
+        print(f"An error occurred deleting old features: {e}")
+        return 0
+
 def searchContentByTag(tag: str) -> list:
     try:
         search_query = f'tags:"{tag}" AND owner:{gis.users.me.username} AND type:Feature Service'
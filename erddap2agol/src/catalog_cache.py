@@ -0,0 +1,197 @@
+#Per-server cache of the info/index.json catalog.
+#The catalog is pulled once and kept on disk under e2a_erddap_conf, then revalidated
+#with ETag/If-Modified-Since once the TTL runs out.
+#Full catalog rows are snapshotted so consumers (DAS refresh, AGOL updates) can ask
+#which datasets were added, removed or changed since they last synced.
+import os, json, time, hashlib, threading, requests
+from . import transport as tp
+
+# Seconds before a cached catalog is revalidated against the server
+CATALOG_TTL = 3600
+
+def getCatalogDir() -> str:
+    agol_home = os.getenv('AGOL_HOME', '/arcgis/home')
+    catalog_dir = os.path.join(agol_home, 'e2a_erddap_conf', 'catalogs')
+    os.makedirs(catalog_dir, exist_ok=True)
+    return catalog_dir
+
+
+class CatalogCache:
+    def __init__(self, serverInfo: str, ttl: int = CATALOG_TTL):
+        self.serverInfo = serverInfo
+        self.ttl = ttl
+        url_hash = hashlib.sha1(serverInfo.encode("utf-8")).hexdigest()[:16]
+        self.filepath = os.path.join(getCatalogDir(), f"catalog_{url_hash}.json")
+        self.etag = None
+        self.lastModified = None
+        self.fetchedAt = 0
+        self.datasetIDs = []
+        # Hashed index so membership checks don't scan the list
+        self.idIndex = frozenset()
+        self.hasAllDatasets = False
+        self.columnNames = []
+        self.rows = []
+        # {datasetid: hash of its catalog row}
+        self.rowHashes = {}
+        # {consumer: rowHashes as of that consumer's last sync}
+        self.baselines = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self) -> None:
+        if not os.path.exists(self.filepath):
+            return
+        try:
+            with open(self.filepath, 'r') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Ignoring unreadable catalog cache {self.filepath}: {e}")
+            return
+
+        if data.get("serverInfo") != self.serverInfo:
+            return
+        self.baselines = data.get("baselines", {})
+        if "rows" not in data:
+            # Written before rows were snapshotted, fetch it again
+            return
+        self.etag = data.get("etag")
+        self.lastModified = data.get("lastModified")
+        self.fetchedAt = data.get("fetchedAt", 0)
+        self.setRows(data["columnNames"], data["rows"])
+        self.hasAllDatasets = data.get("hasAllDatasets", False)
+
+    def save(self) -> None:
+        data = {
+            "serverInfo": self.serverInfo,
+            "etag": self.etag,
+            "lastModified": self.lastModified,
+            "fetchedAt": self.fetchedAt,
+            "hasAllDatasets": self.hasAllDatasets,
+            "columnNames": self.columnNames,
+            "rows": self.rows,
+            "baselines": self.baselines
+        }
+        tmp_path = self.filepath + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.filepath)
+
+    def setDatasetIDs(self, dataset_ids: list) -> None:
+        self.datasetIDs = list(dataset_ids)
+        self.idIndex = frozenset(self.datasetIDs)
+
+    def setRows(self, column_names: list, rows: list) -> None:
+        dataset_id_index = column_names.index("Dataset ID")
+        self.columnNames = column_names
+        self.rows = [row for row in rows if row[dataset_id_index] != "allDatasets"]
+        self.hasAllDatasets = len(self.rows) != len(rows)
+        self.rowHashes = {row[dataset_id_index]: hashRow(row) for row in self.rows}
+        self.setDatasetIDs([row[dataset_id_index] for row in self.rows])
+
+    def setFromResponse(self, data: dict) -> None:
+        self.setRows(data['table']['columnNames'], data['table']['rows'])
+
+    def isExpired(self) -> bool:
+        return (time.time() - self.fetchedAt) > self.ttl
+
+    # Returns True when a new catalog was downloaded
+    def refresh(self, force: bool = False) -> bool:
+        if not force and self.datasetIDs and not self.isExpired():
+            return False
+        with self.lock:
+            # Another thread may have refreshed while we waited
+            if not force and self.datasetIDs and not self.isExpired():
+                return False
+            return self.revalidate()
+
+    def revalidate(self) -> bool:
+        headers = {}
+        if self.datasetIDs:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.lastModified:
+                headers["If-Modified-Since"] = self.lastModified
+
+        try:
+            response = tp.get(self.serverInfo, headers=headers)
+            if response.status_code == 304:
+                self.fetchedAt = time.time()
+                self.save()
+                return False
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # A stale catalog beats no catalog
+            if self.datasetIDs:
+                print(f"Could not revalidate catalog {self.serverInfo}, using cached copy: {e}")
+                return False
+            raise
+
+        self.setFromResponse(data)
+        self.etag = response.headers.get("ETag")
+        self.lastModified = response.headers.get("Last-Modified")
+        self.fetchedAt = time.time()
+        self.save()
+        return True
+
+    def getDatasetIDs(self) -> list:
+        self.refresh()
+        return list(self.datasetIDs)
+
+    def contains(self, datasetid: str) -> bool:
+        self.refresh()
+        return datasetid in self.idIndex
+
+    # Catalog row as {column name: value}
+    def getRow(self, datasetid: str) -> dict:
+        self.refresh()
+        dataset_id_index = self.columnNames.index("Dataset ID")
+        for row in self.rows:
+            if row[dataset_id_index] == datasetid:
+                return dict(zip(self.columnNames, row))
+        return None
+
+    # Datasets added, removed or changed since consumer last called markSynced.
+    # A consumer that has never synced sees every dataset as added.
+    def getChanges(self, consumer: str) -> dict:
+        self.refresh()
+        baseline = self.baselines.get(consumer, {})
+        return {
+            "added": [datasetid for datasetid in self.datasetIDs if datasetid not in baseline],
+            "removed": sorted(datasetid for datasetid in baseline if datasetid not in self.rowHashes),
+            "changed": [datasetid for datasetid in self.datasetIDs
+                        if datasetid in baseline and baseline[datasetid] != self.rowHashes[datasetid]]
+        }
+
+    # Records the current catalog as seen by consumer, only for datasetids if given
+    # so that datasets that failed to process show up again next time
+    def markSynced(self, consumer: str, datasetids: list = None) -> None:
+        with self.lock:
+            baseline = self.baselines.setdefault(consumer, {})
+            if datasetids is None:
+                baseline.clear()
+                baseline.update(self.rowHashes)
+            else:
+                for datasetid in datasetids:
+                    if datasetid in self.rowHashes:
+                        baseline[datasetid] = self.rowHashes[datasetid]
+                    else:
+                        baseline.pop(datasetid, None)
+            self.save()
+
+
+def hashRow(row: list) -> str:
+    return hashlib.sha1(json.dumps(row, separators=(",", ":")).encode("utf-8")).hexdigest()[:16]
+
+
+_catalogs = {}
+
+# One cache object per catalog URL for the life of the process
+def getCatalog(serverInfo: str, ttl: int = None) -> CatalogCache:
+    catalog = _catalogs.get(serverInfo)
+    if catalog is None:
+        catalog = CatalogCache(serverInfo, CATALOG_TTL if ttl is None else ttl)
+        _catalogs[serverInfo] = catalog
+    elif ttl is not None:
+        catalog.ttl = ttl
+    return catalog
@@ -0,0 +1,392 @@
+#Downloads long tabledap histories as time windows fetched in parallel.
+#Every window is its own orderBy(time) request, windows never overlap, and the
+#pieces are stitched back in time order so the output matches one full-range request.
+#Chunks arrive in the handler's response format and are kept as csvp.
+#Finished windows are checkpointed in a manifest so an interrupted backfill resumes where it stopped.
+import os, time, shutil, json, hashlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from . import erddap_client as ec
+
+# Chunk sizes are picked so each request returns about this many bytes
+TARGET_CHUNK_BYTES = 50 * 1024 * 1024
+# Bounds on an adaptive chunk, in seconds of data time
+MIN_CHUNK_SECONDS_ADAPTIVE = 6 * 3600
+MAX_CHUNK_SECONDS = 3650 * 86400
+# The first probe window, grown until it returns PROBE_MIN_ROWS or PROBE_ATTEMPTS run out
+PROBE_SECONDS = 86400
+PROBE_GROWTH = 8
+PROBE_MIN_ROWS = 100
+PROBE_ATTEMPTS = 4
+# Weight given to the newest chunk when updating the observed density
+EWMA_ALPHA = 0.3
+# Histories spanning fewer days than this go out as a single request
+CHUNK_THRESHOLD_DAYS = 180
+# Window length while no rows have been seen to size chunks from, e.g. a history that starts empty
+UNKNOWN_DENSITY_SECONDS = CHUNK_THRESHOLD_DAYS * 86400
+# Windows downloaded at once, the transport also caps requests in flight per host
+MAX_PER_HOST = 4
+MAX_RETRIES = 2
+# Seconds, doubled after every failed attempt
+BACKOFF_BASE = 2.0
+# A window that keeps timing out or failing on the server is split in half until it gets
+# shorter than this, or has been split MAX_SPLIT_DEPTH times
+MIN_CHUNK_SECONDS = 3600
+MAX_SPLIT_DEPTH = 4
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# path is None for a window ERDDAP had no rows for
+ChunkResult = namedtuple("ChunkResult", ["start", "end", "path", "rows", "bytes"])
+
+
+class ChunkError(Exception):
+    pass
+
+
+# Tracks bytes and rows per second of data time and turns them into the next window length.
+# Starts from the probe and follows the chunks as they come back with an EWMA.
+class ChunkSizer:
+    def __init__(self, targetBytes: int = TARGET_CHUNK_BYTES, minSeconds: float = MIN_CHUNK_SECONDS_ADAPTIVE,
+                 maxSeconds: float = MAX_CHUNK_SECONDS, alpha: float = EWMA_ALPHA):
+        self.targetBytes = targetBytes
+        self.minSeconds = minSeconds
+        self.maxSeconds = maxSeconds
+        self.alpha = alpha
+        self.bytesPerSecond = None
+        self.rowsPerSecond = None
+
+    def observe(self, nbytes: int, rows: int, seconds: float) -> None:
+        if seconds <= 0:
+            return
+        if nbytes == 0:
+            # An empty window says nothing about density, only that the next one can be longer
+            if self.bytesPerSecond is not None:
+                self.bytesPerSecond /= 2
+            return
+        bps = nbytes / seconds
+        rps = (rows or 0) / seconds
+        if self.bytesPerSecond is None:
+            self.bytesPerSecond, self.rowsPerSecond = bps, rps
+        else:
+            self.bytesPerSecond = self.alpha * bps + (1 - self.alpha) * self.bytesPerSecond
+            self.rowsPerSecond = self.alpha * rps + (1 - self.alpha) * (self.rowsPerSecond or rps)
+
+    # Whole seconds, window bounds are written to the manifest and URLs at second precision
+    def nextSpan(self) -> int:
+        if not self.bytesPerSecond:
+            return int(min(max(UNKNOWN_DENSITY_SECONDS, self.minSeconds), self.maxSeconds))
+        return int(min(max(self.targetBytes / self.bytesPerSecond, self.minSeconds), self.maxSeconds))
+
+    def describe(self) -> str:
+        if not self.bytesPerSecond:
+            return f"no rows seen yet, chunks of {self.nextSpan() / 86400:.1f} days"
+        return (f"{self.rowsPerSecond * 86400:.0f} rows/day, {self.bytesPerSecond * 86400 / 1e6:.2f} MB/day, "
+                f"chunks of {self.nextSpan() / 86400:.1f} days")
+
+
+def parseTime(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(str(value).rstrip("Z")[:19], TIME_FORMAT)
+
+def formatTime(value: datetime) -> str:
+    return value.strftime(TIME_FORMAT)
+
+# Chunks and their manifest live outside the temp dir so cleanTemp never removes a partial backfill
+def getBackfillDir(datasetid: str) -> str:
+    agol_home = os.getenv('AGOL_HOME', '/arcgis/home')
+    backfill_dir = os.path.join(agol_home, 'e2a_backfill', datasetid)
+    os.makedirs(backfill_dir, exist_ok=True)
+    return backfill_dir
+
+def getManifestPath(chunkDir: str) -> str:
+    return os.path.join(chunkDir, "manifest.json")
+
+# Identifies the request a manifest belongs to, chunks from a different server, variable list
+# or start time can't be reused. The end time is left out so a grown dataset still resumes.
+def manifestKey(erddapObj: ec.ERDDAPHandler, attrs: list, start: datetime) -> str:
+    parts = [erddapObj.server or "", erddapObj.datasetid or "", formatTime(start)]
+    parts.extend(erddapObj.orderedAttributes(attrs))
+    return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+def loadManifest(chunkDir: str) -> dict:
+    try:
+        with open(getManifestPath(chunkDir), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def saveManifest(chunkDir: str, key: str, end: datetime, chunks: list) -> None:
+    manifest = {
+        "key": key,
+        "end": formatTime(end),
+        "chunks": [{"start": formatTime(chunk.start), "end": formatTime(chunk.end),
+                    "file": os.path.basename(chunk.path) if chunk.path else None,
+                    "rows": chunk.rows, "bytes": chunk.bytes}
+                   for chunk in sorted(chunks, key=lambda chunk: chunk.start)]
+    }
+    path = getManifestPath(chunkDir)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, path)
+
+# Index of the time column in a csvp header, where it appears as "time (UTC)"
+def timeColumnIndex(header: bytes, timeName: str) -> int:
+    names = [name.strip().strip('"').split(" (")[0] for name in header.decode("utf-8", "replace").split(",")]
+    return names.index(timeName) if timeName in names else None
+
+# Checks a chunk file against what was recorded for it: the row count, and that its first
+# and last times fall inside the window (the end only counts for the final window).
+def verifyChunk(chunk: ChunkResult, timeName: str, isLast: bool) -> bool:
+    if chunk.path is None:
+        return True
+    rows = 0
+    first_line = last_line = None
+    try:
+        with open(chunk.path, 'rb') as f:
+            header = f.readline()
+            for line in f:
+                if not line.strip():
+                    continue
+                rows += 1
+                if first_line is None:
+                    first_line = line
+                last_line = line
+    except OSError:
+        return False
+    if chunk.rows is not None and rows != chunk.rows:
+        return False
+    index = timeColumnIndex(header, timeName)
+    if index is None or first_line is None:
+        return index is not None or rows == 0
+    try:
+        first = parseTime(first_line.decode("utf-8").split(",")[index].strip())
+        last = parseTime(last_line.decode("utf-8").split(",")[index].strip())
+    except (ValueError, IndexError):
+        return False
+    if first < chunk.start or first > last:
+        return False
+    return last <= chunk.end if isLast else last < chunk.end
+
+# Reloads finished chunks from an earlier run of the same download. Only the unbroken run of
+# verified chunks from start is kept, the download resumes where that run ends.
+def resumeChunks(erddapObj: ec.ERDDAPHandler, chunkDir: str, key: str, start: datetime, end: datetime) -> list:
+    manifest = loadManifest(chunkDir)
+    if manifest is None:
+        return []
+    if manifest.get("key") != key:
+        print(f"\nDiscarding checkpoints for {erddapObj.datasetid}, the request changed")
+        return []
+
+    kept = []
+    cursor = start
+    for entry in manifest.get("chunks", []):
+        chunk = ChunkResult(parseTime(entry["start"]), parseTime(entry["end"]),
+                            os.path.join(chunkDir, entry["file"]) if entry["file"] else None,
+                            entry["rows"], entry["bytes"])
+        # A window that ran up to an older end included that end, the new range starts past it
+        isLast = chunk.end >= parseTime(manifest["end"])
+        if chunk.start != cursor or (isLast and chunk.end != end) or chunk.end > end:
+            break
+        if not verifyChunk(chunk, erddapObj.time, isLast):
+            print(f"Checkpoint {entry['file']} for {erddapObj.datasetid} failed verification, refetching from there")
+            break
+        kept.append(chunk)
+        cursor = chunk.end
+    if kept:
+        print(f"\nResuming {erddapObj.datasetid} from {formatTime(cursor)} with {len(kept)} checkpointed chunks")
+    return kept
+
+def shouldChunk(erddapObj: ec.ERDDAPHandler, threshold: int = CHUNK_THRESHOLD_DAYS) -> bool:
+    try:
+        return erddapObj.calculateTimeRange() > threshold
+    except (TypeError, ValueError):
+        return False
+
+def chunkFilename(start: datetime, end: datetime) -> str:
+    return f"{start:%Y%m%dT%H%M%S}_{end:%Y%m%dT%H%M%S}.csv"
+
+# Downloads one window, retrying with backoff and then splitting it in half if it still fails.
+# Only timeouts, throttling and server errors are retried or split, a 4xx or a bad response fails at once.
+# Returns a list of ChunkResult in time order, raises ChunkError when a piece can't be fetched.
+def fetchChunk(erddapObj: ec.ERDDAPHandler, attrs: list, start: datetime, end: datetime, isLast: bool,
+               chunkDir: str, retries: int = MAX_RETRIES, backoff: float = BACKOFF_BASE, depth: int = 0) -> list:
+    url = erddapObj.generateChunkUrl(attrs, start, end, isLast)
+    file_path = os.path.join(chunkDir, chunkFilename(start, end))
+
+    # Pacing and the per-host cap on requests in flight are the transport's job
+    for attempt in range(retries + 1):
+        failure = {}
+        result = ec.downloadAsCsvp(url, file_path, erddapObj.getFormat(), failure=failure, units=erddapObj.units)
+        if result is not None:
+            return [ChunkResult(start, end, result["path"], result["rows"], result["bytes"])]
+        if not failure.get("retryable", True):
+            raise ChunkError(f"{erddapObj.datasetid} window {start} to {end} was refused "
+                             f"({failure.get('status') or 'bad response'}), not retrying")
+        if attempt < retries:
+            delay = backoff * (2 ** attempt)
+            print(f"Retrying {erddapObj.datasetid} {start:%Y-%m-%d} to {end:%Y-%m-%d} in {delay:.0f}s")
+            time.sleep(delay)
+
+    span = (end - start).total_seconds()
+    if span / 2 < MIN_CHUNK_SECONDS or depth >= MAX_SPLIT_DEPTH:
+        raise ChunkError(f"{erddapObj.datasetid} window {start} to {end} failed after {retries + 1} attempts")
+
+    # Large windows are the usual cause of server timeouts, so try the two halves on their own
+    middle = start + timedelta(seconds=int(span // 2))
+    print(f"Splitting {erddapObj.datasetid} window {start:%Y-%m-%d} to {end:%Y-%m-%d}")
+    return (fetchChunk(erddapObj, attrs, start, middle, False, chunkDir, retries, backoff, depth + 1)
+            + fetchChunk(erddapObj, attrs, middle, end, isLast, chunkDir, retries, backoff, depth + 1))
+
+# Concatenates chunk files in order, keeping the header of the first one. Returns the row count.
+def stitchChunks(results: list, out_path: str) -> int:
+    header = None
+    rows = 0
+    tmp_path = out_path + ".part"
+    with open(tmp_path, 'wb') as out:
+        for result in results:
+            if result.path is None:
+                continue
+            with open(result.path, 'rb') as f:
+                chunk_header = f.readline()
+                if header is None:
+                    header = chunk_header
+                    out.write(header.rstrip(b"\r\n") + b"\n")
+                elif chunk_header.strip() != header.strip():
+                    raise ChunkError(f"Header of {result.path} does not match the first chunk")
+                body_start = f.tell()
+                shutil.copyfileobj(f, out, ec.DOWNLOAD_CHUNK_SIZE)
+                # Keep the next chunk's first row off this chunk's last line
+                if f.tell() > body_start:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        out.write(b"\n")
+            rows += result.rows or 0
+    if header is None:
+        os.remove(tmp_path)
+        return 0
+    os.replace(tmp_path, out_path)
+    return rows
+
+# Fetches small windows from the start of the range until one has enough rows to size chunks from.
+# The probe windows are kept as the first chunks. Returns (chunk results, cursor) or None on failure.
+def probeDensity(erddapObj: ec.ERDDAPHandler, attrs: list, start: datetime, end: datetime, chunkDir: str,
+                 sizer: ChunkSizer, retries: int = MAX_RETRIES):
+    results = []
+    cursor = start
+    span = PROBE_SECONDS
+    for attempt in range(PROBE_ATTEMPTS):
+        window_end = min(cursor + timedelta(seconds=span), end)
+        isLast = window_end >= end
+        try:
+            chunks = fetchChunk(erddapObj, attrs, cursor, window_end, isLast, chunkDir, retries, BACKOFF_BASE)
+        except ChunkError as e:
+            print(e)
+            return None
+        results.extend(chunks)
+        rows = sum(chunk.rows or 0 for chunk in chunks)
+        sizer.observe(sum(chunk.bytes for chunk in chunks), rows, (window_end - cursor).total_seconds())
+        cursor = window_end
+        if isLast or rows >= PROBE_MIN_ROWS:
+            break
+        span *= PROBE_GROWTH
+    return results, cursor
+
+# Downloads the erddapObj start_time to end_time range in parallel windows into the temp csv.
+# Window lengths come from a probe of the first rows and adapt as chunks finish, unless chunkDays fixes them.
+# With resume, chunks checkpointed by an interrupted run are verified and reused.
+# Returns the file path, or None when a window could not be fetched or the range has no rows.
+def downloadChunked(erddapObj: ec.ERDDAPHandler, attrs: list, chunkDays: float = None,
+                    maxPerHost: int = MAX_PER_HOST, retries: int = MAX_RETRIES,
+                    targetBytes: int = TARGET_CHUNK_BYTES, resume: bool = True) -> str:
+    # One column order however the caller built the list, a resumed run has to match the manifest
+    # key and the headers of the chunks it reuses
+    attrs = sorted(attrs)
+    start = parseTime(erddapObj.start_time)
+    end = parseTime(erddapObj.end_time)
+    chunk_dir = getBackfillDir(erddapObj.datasetid)
+    out_path = os.path.join(ec.getTempDir(), f"{erddapObj.datasetid}.csv")
+    key = manifestKey(erddapObj, attrs, start)
+    if not resume:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+        os.makedirs(chunk_dir, exist_ok=True)
+
+    collected = resumeChunks(erddapObj, chunk_dir, key, start, end) if resume else []
+    cursor = collected[-1].end if collected else start
+
+    if chunkDays is not None:
+        sizer = ChunkSizer(minSeconds=chunkDays * 86400, maxSeconds=chunkDays * 86400)
+    else:
+        sizer = ChunkSizer(targetBytes=targetBytes)
+        for chunk in collected:
+            sizer.observe(chunk.bytes, chunk.rows, (chunk.end - chunk.start).total_seconds())
+        if sizer.bytesPerSecond is None and cursor < end:
+            probe = probeDensity(erddapObj, attrs, cursor, end, chunk_dir, sizer, retries)
+            if probe is None:
+                print(f"\nProbe request failed for {erddapObj.datasetid}, nothing was published.")
+                saveManifest(chunk_dir, key, end, collected)
+                return None
+            collected.extend(probe[0])
+            cursor = probe[1]
+            saveManifest(chunk_dir, key, end, collected)
+        print(f"\nSizing {erddapObj.datasetid} chunks: {sizer.describe()}")
+
+    def worker(window):
+        window_start, window_end, isLast = window
+        try:
+            return fetchChunk(erddapObj, attrs, window_start, window_end, isLast, chunk_dir, retries, BACKOFF_BASE)
+        except ChunkError as e:
+            print(e)
+            return None
+
+    failed = 0
+    pending = {}
+    with ThreadPoolExecutor(max_workers=maxPerHost) as executor:
+        # Windows are planned one at a time so every finished chunk can resize the next ones
+        while cursor < end or pending:
+            while cursor < end and len(pending) < maxPerHost and not failed:
+                window_end = min(cursor + timedelta(seconds=sizer.nextSpan()), end)
+                window = (cursor, window_end, window_end >= end)
+                pending[executor.submit(worker, window)] = window
+                cursor = window_end
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                window_start, window_end, _ = pending.pop(future)
+                chunks = future.result()
+                if chunks is None:
+                    # Stop planning new windows, the ones in flight still finish and get checkpointed
+                    failed += 1
+                    continue
+                collected.extend(chunks)
+                sizer.observe(sum(chunk.bytes for chunk in chunks), sum(chunk.rows or 0 for chunk in chunks),
+                              (window_end - window_start).total_seconds())
+            saveManifest(chunk_dir, key, end, collected)
+
+    if failed:
+        print(f"\n{failed} chunks failed for {erddapObj.datasetid}, finished chunks are kept in {chunk_dir} "
+              f"and the next run resumes from them.")
+        return None
+
+    results = sorted(collected, key=lambda chunk: chunk.start)
+    bad = [chunk for chunk in results if not verifyChunk(chunk, erddapObj.time, chunk.end >= end)]
+    if bad:
+        # Drop the bad chunks from the checkpoint so the next run fetches them again
+        for chunk in bad:
+            print(f"Chunk {formatTime(chunk.start)} to {formatTime(chunk.end)} of {erddapObj.datasetid} failed verification")
+            if chunk.path and os.path.exists(chunk.path):
+                os.remove(chunk.path)
+        saveManifest(chunk_dir, key, end, [chunk for chunk in results if chunk not in bad])
+        return None
+
+    rows = stitchChunks(results, out_path)
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    if rows == 0:
+        print(f"\nNo matching results for {erddapObj.datasetid}")
+        return None
+    total_bytes = sum(result.bytes for result in results)
+    print(f"\nDownloaded {rows} rows ({total_bytes / 1e6:.1f} MB) in {len(results)} chunks to {out_path}")
+    return out_path
@@ -4,10 +4,21 @@ from . import erddap_client as ec
 from . import das_client as dc
 from . import ago_wrapper as aw
 from . import level_manager as lm
+from . import das_fetcher as df
+from . import chunked_download as cd
+from . import obs_cache as oc
+from . import response_formats as rf
+from . import decimate as dm
+from . import transport as tp
+from . import pipeline as pl
 from logs import updatelog as ul
-from src.utils import OverwriteFS
+from .utils import OverwriteFS
 
 from arcgis.gis import GIS
+import os, csv, copy, threading
+from collections import namedtuple
+import pandas as pd
+from datetime import datetime, timedelta, timezone
 
 ###################################
 ###### CUI Wrapper Functions ######
@@ -24,9 +35,13 @@ def inputToList(user_input):
  # Show erddap menu and define gcload with selection
 def erddapSelection():
     ec.getErddapList()
+    ec.probeServers()
     ec.showErddapList()
     uc = input("\nSelect an ERDDAP server to use: ")
     gcload = ec.ERDDAPHandler.setErddap(ec.custom_server, int(uc))
+    if gcload is None:
+        print("\nReturning to main menu...")
+        return None
     print(f"\nSelected server: {gcload.server}")
     uc = input("Proceed with server selection? (y/n): ")
 
@@ -38,18 +53,21 @@ def erddapSelection():
         return None
 
 # DAS parsing and attribute definitions for non-NRT datasets
-def parseDas(gcload, dataset):
-    das_resp = ec.ERDDAPHandler.getDas(gcload, dataset)
+# das_resp can be passed in when the DAS was already fetched in a batch
+def parseDas(gcload, dataset, das_resp=None):
+    if das_resp is None:
+        das_resp = df.fetchDasBatch(gcload, [dataset], revalidate=True)[0].das
     if das_resp is None:
         print(f"\nNo data found for dataset {dataset}.")
         return None
     
-    parsed_response = dc.convertToDict(dc.parseDasResponse(das_resp))
-    fp = dc.saveToJson(parsed_response, dataset)
-    print(f"\nJSON file saved to {fp}")
+    fp = dc.saveDas(das_resp, dataset, gcload.server)
+    print(f"\nDAS saved to {fp}")
 
     
-    attribute_list = dc.getActualAttributes(dc.openDasJson(dataset), gcload)
+    das_json = dc.openDasJson(dataset)
+    setattr(gcload, "dtypes", dc.getDtypePlan(das_json))
+    setattr(gcload, "units", dc.getUnits(das_json))
 
     unixtime = (dc.getTimeFromJson(dataset))
     start, end = dc.convertFromUnix(unixtime)
@@ -57,6 +75,8 @@ def parseDas(gcload, dataset):
     setattr(gcload, "start_time", start)
     setattr(gcload, "end_time", end)
     setattr(gcload, "datasetid", dataset)
+    # Profiling the variables needs the dataset and its time range set first
+    attribute_list = dc.getActualAttributes(das_json, gcload)
     setattr(gcload, "attributes", attribute_list)
 
     timeintv = ec.ERDDAPHandler.calculateTimeRange(gcload)
@@ -65,18 +85,20 @@ def parseDas(gcload, dataset):
     return attribute_list
 
 # DAS parsing and attribute definitions for NRT datasets
-def parseDasNRT(gcload, dataset) -> list:
-    das_resp = ec.ERDDAPHandler.getDas(gcload, dataset)
+def parseDasNRT(gcload, dataset, das_resp=None) -> list:
+    if das_resp is None:
+        das_resp = df.fetchDasBatch(gcload, [dataset], revalidate=True)[0].das
     if das_resp is None:
         print(f"\nNo data found for dataset {dataset}.")
         return None
     
-    parsed_response = dc.convertToDict(dc.parseDasResponse(das_resp))
-    fp = dc.saveToJson(parsed_response, dataset)
-    print(f"\nJSON file saved to {fp}")
+    fp = dc.saveDas(das_resp, dataset, gcload.server)
+    print(f"\nDAS saved to {fp}")
 
     
-    attribute_list = dc.getActualAttributes(dc.openDasJson(dataset), gcload)
+    das_json = dc.openDasJson(dataset)
+    setattr(gcload, "dtypes", dc.getDtypePlan(das_json))
+    setattr(gcload, "units", dc.getUnits(das_json))
 
     window_start, window_end = lm.movingWindow(isStr=True)
 
@@ -90,6 +112,7 @@ def parseDasNRT(gcload, dataset) -> list:
         setattr(gcload, "start_time", window_start)
         setattr(gcload, "end_time", window_end)
         setattr(gcload, "datasetid", dataset)
+        attribute_list = dc.getActualAttributes(das_json, gcload)
         setattr(gcload, "attributes", attribute_list)
 
         timeintv = ec.ERDDAPHandler.calculateTimeRange(gcload)
@@ -97,47 +120,116 @@ def parseDasNRT(gcload, dataset) -> list:
         
         return attribute_list
 
-# AGOL publishing and log updating
-# Terminal
-def agolPublish(gcload, attribute_list, isNRT: int) -> None:
-    if isNRT == 0:
-        seed_choice = input("Would you like to create a seed file? (y/n): ").lower()
-        seedbool = seed_choice
-    else:
-        seedbool = False
+# Seed files only apply to manual uploads, asked once per run
+def askSeed() -> bool:
+    seed_choice = input("Would you like to create a seed file? (y/n): ").lower()
+    return seed_choice == "y"
 
+# Downloads what agolPublish uploads. Returns (filepath, full_url), filepath is None when the download failed.
+# maxFeatures caps the rows published, dense datasets are thinned to one row per time bucket
+def downloadForPublish(gcload, attribute_list, seedbool: bool, maxFeatures: int = None) -> tuple:
     full_url = gcload.generate_url(seedbool, attribute_list)
-    response = ec.ERDDAPHandler.return_response(full_url)
-    filepath = ec.ERDDAPHandler.responseToCsv(gcload, response)
-
+    if not seedbool and maxFeatures:
+        filepath, full_url = dm.downloadDecimated(gcload, attribute_list, maxFeatures)
+    # Long histories are fetched as parallel time windows, full_url is still what gets logged
+    elif not seedbool and cd.shouldChunk(gcload):
+        filepath = cd.downloadChunked(gcload, attribute_list)
+    else:
+        # Shorter windows are rebuilt from the local observation cache when pyarrow is installed
+        filepath = oc.buildPublishFile(gcload, attribute_list) if not seedbool else None
+        if filepath is None:
+            filepath = gcload.downloadToCsv(full_url)
+    if filepath is None:
+        print(f"\nDownload failed for {gcload.datasetid}, skipping publish.")
+    return filepath, full_url
+
+_log_lock = threading.Lock()
+
+# Adds the downloaded file to AGOL, publishes it and logs the item
+def publishFile(gcload, filepath: str, full_url: str, isNRT: int) -> None:
     gis = aw.agoConnect()
     propertyDict = aw.makeItemProperties(gcload)
     geom_params = aw.defineGeoParams(gcload)
 
     table_id = aw.publishTable(propertyDict, geom_params, filepath)
-    ul.updateLog(gcload.datasetid, table_id, "None", full_url, gcload.end_time, ul.get_current_time(), isNRT)
-    ec.cleanTemp()
+    # The newest row actually published, incremental NRT updates pick up from here
+    latest = ec.readLastTime(filepath, gcload.time) or gcload.end_time
+    with _log_lock:
+        ul.updateLog(gcload.datasetid, table_id, "None", full_url, latest, ul.get_current_time(), isNRT)
 
-# When users provide multiple datasets for manual upload 
+# AGOL publishing and log updating
 # Terminal
-def processListInput(dataset_list, gcload, isNRT: int):
+# seed is asked for when it isn't given, for manual (isNRT 0) uploads
+def agolPublish(gcload, attribute_list, isNRT: int, maxFeatures: int = None, seed: bool = None) -> None:
     if isNRT == 0:
-        for dataset in dataset_list:
-            attribute_list = parseDas(gcload, dataset)
-            if attribute_list is None:
-                print(f"\nNo data found for dataset {dataset}, trying next.")
-                continue
-            else:
-                agolPublish(gcload, attribute_list, isNRT)           
-        ec.cleanTemp()
+        seedbool = askSeed() if seed is None else seed
     else:
-        for dataset in dataset_list:
-            attribute_list = parseDasNRT(gcload, dataset)
-            if attribute_list is None:
-                continue
-            
-            agolPublish(gcload, attribute_list, isNRT)           
-        ec.cleanTemp()
+        seedbool = False
+
+    filepath, full_url = downloadForPublish(gcload, attribute_list, seedbool, maxFeatures)
+    if filepath is None:
+        return None
+
+    publishFile(gcload, filepath, full_url, isNRT)
+    ec.cleanTemp()
+
+# Worker threads per processListInput stage. DAS and data requests are also paced by the transport's
+# per-host limiter, AGOL publishing stays one at a time.
+STAGE_WORKERS = {"das": 4, "parse": 2, "download": 2, "publish": 1}
+
+# One dataset moving through processListInput, gcload is its own copy of the handler
+PublishJob = namedtuple("PublishJob", ["datasetid", "gcload", "das", "attributes", "filepath", "url"],
+                        defaults=[None, None, None, None])
+
+# When users provide multiple datasets for manual upload 
+# Terminal
+# Datasets go through DAS fetch, parsing, download and publish as a pipeline, so one dataset
+# downloads while the one before it publishes. stageWorkers overrides STAGE_WORKERS per stage.
+def processListInput(dataset_list, gcload, isNRT: int, maxFeatures: int = None, stageWorkers: dict = None):
+    seedbool = askSeed() if isNRT == 0 else False
+    workers = dict(STAGE_WORKERS, **(stageWorkers or {}))
+
+    def fetchStage(datasetid):
+        result = df.fetchDasResult(gcload, datasetid, revalidate=True)
+        if result.das is None:
+            print(f"\nNo data found for dataset {datasetid}, trying next. {result.error or ''}")
+            return None
+        return PublishJob(datasetid, copy.copy(gcload), result.das)
+
+    def parseStage(job):
+        if isNRT == 0:
+            attribute_list = parseDas(job.gcload, job.datasetid, job.das)
+        else:
+            attribute_list = parseDasNRT(job.gcload, job.datasetid, job.das)
+        if attribute_list is None:
+            print(f"\nNo data found for dataset {job.datasetid}, trying next.")
+            return None
+        return job._replace(das=None, attributes=attribute_list)
+
+    def downloadStage(job):
+        filepath, full_url = downloadForPublish(job.gcload, job.attributes, seedbool, maxFeatures)
+        if filepath is None:
+            return None
+        return job._replace(filepath=filepath, url=full_url)
+
+    def publishStage(job):
+        try:
+            publishFile(job.gcload, job.filepath, job.url, isNRT)
+        finally:
+            # cleanTemp would take the files of datasets still queued for publishing
+            if os.path.exists(job.filepath):
+                os.remove(job.filepath)
+        return job.datasetid
+
+    stages = [pl.Stage("das", fetchStage, workers["das"]),
+              pl.Stage("parse", parseStage, workers["parse"]),
+              pl.Stage("download", downloadStage, workers["download"]),
+              pl.Stage("publish", publishStage, workers["publish"])]
+    published = pl.runPipeline(dataset_list, stages,
+                               label=lambda item: item if isinstance(item, str) else item.datasetid)
+    print(f"\nPublished {len(published)} of {len(dataset_list)} datasets.")
+    ec.cleanTemp()
+    tp.printStats()
 
 
 
@@ -146,31 +238,141 @@ def processListInput(dataset_list, gcload, isNRT: int):
 ##### Functions for Notebooks #####
 ###################################
 
-def NRTUpdateAGOL() -> None:
-    gcload = ec.erddapGcoos    
+# Brings one NRT item up to date by appending only the rows newer than its last ingested time
+# and deleting features that fell out of the moving window. Returns False when the item has
+# to be overwritten instead, e.g. it has no usable log entry or the append failed.
+def incrementalUpdate(gcload, datasetid: str, itemid: str) -> bool:
+    params = ul.updateCallFromID(itemid)
+    if not params or params[1] in ("", "None"):
+        return False
+    full_url, last_data = params[0], params[1]
+    try:
+        last_time = cd.parseTime(last_data)
+    except ValueError:
+        return False
+
+    layer = aw.getFeatureLayer(itemid)
+    if layer is None:
+        return False
+
+    current_time = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    update_url = ec.ERDDAPHandler.generateUpdateUrl(full_url, last_time.strftime('%Y-%m-%dT%H:%M:%S'), current_time, gcload.time)
+    file_path = os.path.join(ec.getTempDir(), f"{datasetid}_update.csv")
+    result = ec.downloadAsCsvp(update_url, file_path, gcload.getFormat(), units=gcload.units)
+    if result is None:
+        return False
+
+    added = 0
+    newest = last_time.strftime('%Y-%m-%dT%H:%M:%S')
+    time_column = f"{gcload.time} (UTC)"
+    if result["path"] is not None:
+        with open(file_path, 'r', encoding="utf-8") as f:
+            header = next(csv.reader([f.readline()]))
+        frame = rf.readFrame(file_path, rf.getFormat("csvp"), dtypes=gcload.dtypes)
+        os.remove(file_path)
+        time_column = next((column for column in header if rf.splitUnits(column)[0] == gcload.time), time_column)
+        if not pd.api.types.is_datetime64_any_dtype(frame[gcload.time]):
+            rf.applyDtypePlan(frame, {gcload.time: "datetime64"})
+        # The update url starts at >= the last time, that row is already in the layer
+        frame = frame[frame[gcload.time] > pd.Timestamp(last_time, tz="UTC")]
+        if len(frame):
+            added = aw.appendRows(layer, frame, gcload, header)
+            if added < len(frame):
+                print(f"\nOnly {added} of {len(frame)} new rows were appended to {datasetid}, overwriting instead.")
+                return False
+            newest = frame[gcload.time].max().strftime('%Y-%m-%dT%H:%M:%S')
+
+    # The 7 day window on the UTC clock current_time uses, movingWindow is local time and the layer is UTC
+    window_start = datetime.now(timezone.utc) - timedelta(days=7)
+    expired = aw.deleteBefore(layer, time_column, window_start)
+    with _log_lock:
+        ul.updateLatestData(itemid, newest, ul.get_current_time())
+    print(f"\n{datasetid}: appended {added} new rows, expired {expired}, now current to {newest}")
+    return True
+
+# Refetches the DAS of NRT datasets that were added or changed in the catalog since the last run.
+# Returns ({datasetid: itemid}, datasetids to skip because they were removed or their DAS failed)
+def prepareNRTUpdate(gcload) -> tuple:
+    nrt_dict  = lm.NRTFindAGOL() or {}
+
+    # Catalog rows carry no data timestamps, so every item still gets its window rolled forward,
+    # but only datasets added or changed in the catalog since the last run get their DAS refetched
+    catalog = gcload.getCatalog()
+    changes = catalog.getChanges("agol")
+    removed = set(changes["removed"])
+    updated = set(changes["added"]) | set(changes["changed"])
+
+    for datasetid in removed & set(nrt_dict):
+        print(f"\n{datasetid} was removed from {gcload.server}, skipping its update.")
+
+    refresh_list = [datasetid for datasetid in nrt_dict
+                    if datasetid not in removed and (datasetid in updated or not dc.checkForJson(datasetid))]
+    das_results = df.fetchDasBatch(gcload, refresh_list, revalidate=True)
+    failed = {result.datasetid for result in das_results if result.error is not None}
+    # Changed items are marked synced by updateNRTItem once they are updated, until then they stay changed
+    catalog.markSynced("agol", changes["removed"])
+    return nrt_dict, removed | failed
+
+# Rolls one NRT item's window forward. gcload is set up for datasetid, pass a copy when items run in parallel.
+# With incremental, new rows are appended and old ones expired, falling back to overwriting the whole window
+# when that isn't possible. With maxFeatures the window is always overwritten with a decimated download
+# so the cap holds. Returns False when the item could not be updated, it then stays marked as changed
+# in the catalog so its DAS is refetched next time.
+def updateNRTItem(gcload, datasetid: str, itemid: str, incremental: bool = True, maxFeatures: int = None) -> bool:
+    startWindow, endWindow = lm.movingWindow(isStr=True)
+    das_data = dc.openDasJson(datasetid)
+    if das_data is None:
+        return False
+    setattr(gcload, "dtypes", dc.getDtypePlan(das_data))
+    setattr(gcload, "units", dc.getUnits(das_data))
+
+    setattr(gcload, "start_time", startWindow)
+    setattr(gcload, "end_time", endWindow)
+    setattr(gcload, "datasetid", datasetid)
+    attribute_list = dc.getActualAttributes(das_data, gcload)
+    setattr(gcload, "attributes", attribute_list)
 
-    nrt_dict  = lm.NRTFindAGOL()
+    if incremental and not maxFeatures and incrementalUpdate(gcload, datasetid, itemid):
+        gcload.getCatalog().markSynced("agol", [datasetid])
+        return True
 
-    for datasetid, itemid in nrt_dict.items():
-        # try: 
-        startWindow, endWindow = lm.movingWindow(isStr=True)
-        das_resp = ec.ERDDAPHandler.getDas(gcload, datasetid)
-        parsed_response = dc.convertToDict(dc.parseDasResponse(das_resp))
-        fp = dc.saveToJson(parsed_response, datasetid)
-        das_data = dc.openDasJson(datasetid)
-        attribute_list = dc.getActualAttributes(das_data, gcload)
-
-        setattr(gcload, "start_time", startWindow)
-        setattr(gcload, "end_time", endWindow)
-        setattr(gcload, "datasetid", datasetid)
-        setattr(gcload, "attributes", attribute_list)
+    if maxFeatures:
+        update_file, _ = dm.downloadDecimated(gcload, attribute_list, maxFeatures)
+        if update_file is None:
+            return False
+    else:
+        # Only days missing from the observation cache are requested, AGOL gets the rebuilt file
+        update_file = oc.buildPublishFile(gcload, attribute_list)
+        if update_file is None:
+            # Downloaded here as csvp, OverwriteFS would fetch whatever fileType the url asks for
+            update_file = gcload.downloadToCsv(gcload.generate_url(False, attribute_list))
+            if update_file is None:
+                return False
 
-        url = gcload.generate_url(False, attribute_list)
+    gis = aw.agoConnect()
+    
+    content = gis.content.get(itemid)
+
+    outcome = OverwriteFS.overwriteFeatureService(content, update_file, preserveProps=False, verbose=True, ignoreAge = True)
+    if isinstance(outcome, dict) and outcome.get("success") is False:
+        return False
+    # Keep the logged newest row current so the next incremental update and the scheduler see it
+    latest = ec.readLastTime(update_file, gcload.time)
+    if latest:
+        with _log_lock:
+            ul.updateLatestData(itemid, latest, ul.get_current_time())
+    gcload.getCatalog().markSynced("agol", [datasetid])
+    return True
+
+# Single pass over every NRT item, see nrt_scheduler for updating each one on its own cadence
+def NRTUpdateAGOL(incremental: bool = True, maxFeatures: int = None) -> None:
+    gcload = ec.erddapGcoos    
 
-        gis = aw.agoConnect()
-        
-        content = gis.content.get(itemid)
+    nrt_dict, skip = prepareNRTUpdate(gcload)
 
-        OverwriteFS.overwriteFeatureService(content, url, preserveProps=False, verbose=True, ignoreAge = True)
-        # except Exception as e:
+    for datasetid, itemid in nrt_dict.items():
+        if datasetid in skip:
+            continue
+        updateNRTItem(gcload, datasetid, itemid, incremental, maxFeatures)
     
+    tp.printStats()
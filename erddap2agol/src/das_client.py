@@ -1,44 +1,408 @@
 import sys, os, requests, datetime 
-import json
-from collections import OrderedDict
+import json, re, threading, hashlib
+from collections import OrderedDict, namedtuple
 from . import erddap_client as ec
+from . import transport as tp
+from . import metadata_store as ms
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 
-def parseDasResponse(response_text):
-    data = OrderedDict()
-    current_section = None
-    section_name = None
+# Typed DAS model: containers are dicts, leaves are DasAttribute tuples.
+# Numeric values are ints/floats, multi-valued ones (actual_range) are tuples.
+DasAttribute = namedtuple("DasAttribute", ["datatype", "value"])
+
+INT_TYPES = {"Byte", "UByte", "Int16", "UInt16", "Int32", "UInt32", "Int64", "UInt64"}
+FLOAT_TYPES = {"Float32", "Float64"}
+
+def parseNumber(datatype: str, text: str):
+    if datatype in INT_TYPES:
+        try:
+            return int(text)
+        except ValueError:
+            # NaN and friends can show up in integer attributes
+            return float(text)
+    return float(text)
+
+def parseDasValue(datatype: str, text: str):
+    if datatype in FLOAT_TYPES:
+        if "," not in text:
+            return float(text)
+        return tuple(float(part) for part in text.split(","))
+    if datatype in INT_TYPES:
+        if "," not in text:
+            return parseNumber(datatype, text)
+        return tuple(parseNumber(datatype, part.strip()) for part in text.split(","))
+
+    if len(text) >= 2 and text[0] == '"' and text[-1] == '"':
+        text = text[1:-1]
+    if "\\" in text:
+        text = re.sub(r'\\(.)', r'\1', text, flags=re.S)
+    return text
+
+# String values can run over several lines, they end on an unescaped quote followed by ;
+def isStringComplete(text: str) -> bool:
+    if not text.endswith('";'):
+        return False
+    if not text.endswith('\\";'):
+        return True
+    backslashes = 0
+    index = len(text) - 3
+    while index >= 0 and text[index] == "\\":
+        backslashes += 1
+        index -= 1
+    return backslashes % 2 == 0
+
+# Consumes any iterable of lines (str or bytes), e.g. response.iter_lines()
+def parseDasStream(lines) -> dict:
+    root = {}
+    stack = []
+    current = None
+    pending = None
+
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+
+        if pending is not None:
+            pending[2].append(line)
+            if isStringComplete(line.rstrip()):
+                datatype, name, parts = pending
+                current[name] = DasAttribute(datatype, parseDasValue(datatype, "\n".join(parts).strip()[:-1]))
+                pending = None
+            continue
 
-    for line in response_text.strip().splitlines():
         line = line.strip()
-
-        if line.startswith("Attributes {"):
+        if not line:
             continue
 
-        if line.endswith("{"):
-            section_name = line.split()[0]
-            current_section = OrderedDict()
-            data[section_name] = current_section
+        last = line[-1]
+        if last == "{":
+            if current is None and not stack:
+                # Outer "Attributes {" block
+                current = root
+                stack.append(root)
+                continue
+            container = {}
+            current[line[:-1].rstrip()] = container
+            stack.append(container)
+            current = container
             continue
 
         if line == "}":
-            section_name = None
-            current_section = None
+            if stack:
+                stack.pop()
+            current = stack[-1] if stack else None
             continue
 
-        if current_section is not None:
-            parts = line.split(maxsplit=2)
-            if len(parts) == 3:
-                datatype, description, value = parts
-                current_section[description] = {
-                    "datatype": datatype,
-                    "value": value.strip('";')
-                }
+        if current is None:
+            continue
+        parts = line.split(None, 2)
+        if len(parts) != 3:
+            continue
+        datatype, name, value = parts
+
+        if datatype == "String":
+            if last != ";" or not isStringComplete(value):
+                pending = (datatype, name, [value])
+                continue
+        elif last != ";":
+            continue
 
+        current[name] = DasAttribute(datatype, parseDasValue(datatype, value[:-1].rstrip()))
+
+    return root
+
+def formatDasValue(value) -> str:
+    if isinstance(value, tuple):
+        return ", ".join(formatDasValue(v) for v in value)
+    if isinstance(value, float):
+        if value != value:
+            return "NaN"
+        return repr(value)
+    return str(value)
+
+# ERDDAP nests variables inside an "s" container, this walks every container
+# depth first and returns {name: container} with the nesting removed
+def flattenContainers(model: dict, flat: dict = None) -> dict:
+    if flat is None:
+        flat = {}
+    for name, entry in model.items():
+        if not isinstance(entry, DasAttribute):
+            flat[name] = entry
+            flattenContainers(entry, flat)
+    return flat
+
+# Compatibility adapter, produces the flat {variable: {attribute: {"datatype": ..., "value": "..."}}}
+# shape saved to the DAS JSON
+def toLegacyDict(model: dict) -> OrderedDict:
+    data = OrderedDict()
+    for name, container in flattenContainers(model).items():
+        section = OrderedDict()
+        for attr_name, entry in container.items():
+            if isinstance(entry, DasAttribute):
+                section[attr_name] = {
+                    "datatype": entry.datatype,
+                    "value": formatDasValue(entry.value)
+                }
+        data[name] = section
     return data
 
+def parseDasResponse(response_text):
+    return toLegacyDict(parseDasStream(response_text.splitlines()))
+
+# Returns (start, end) epoch seconds from a parsed DAS model
+def getTimeRange(model: dict):
+    try:
+        start_time, end_time = flattenContainers(model)['time']['actual_range'].value
+        return int(start_time), int(end_time)
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"Error getting time from DAS: {e}")
+        return None
+
+# Streams a DAS straight into the parser without holding the response text
+def streamDas(erddapObj: ec.ERDDAPHandler, datasetid: str) -> dict:
+    url = f"{erddapObj.server}{datasetid}.das"
+    with tp.get(url, stream=True) as response:
+        response.raise_for_status()
+        return parseDasStream(response.iter_lines())
+
+# Longitude/latitude extent from the variable actual_range, falling back to NC_Global
+def getBbox(model: dict):
+    flat = flattenContainers(model)
+    try:
+        min_lon, max_lon = flat['longitude']['actual_range'].value
+        min_lat, max_lat = flat['latitude']['actual_range'].value
+        return min_lon, max_lon, min_lat, max_lat
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        nc_global = flat['NC_Global']
+        return tuple(nc_global[key].value for key in
+                     ("geospatial_lon_min", "geospatial_lon_max", "geospatial_lat_min", "geospatial_lat_max"))
+    except KeyError:
+        return None
+
+# Containers holding attributes, i.e. everything except NC_Global and the "s" wrapper
+def getVariableNames(model: dict) -> list:
+    names = []
+    for name, container in flattenContainers(model).items():
+        if name == "NC_Global":
+            continue
+        if any(isinstance(entry, DasAttribute) for entry in container.values()):
+            names.append(name)
+    return names
+
+# pandas dtypes for the DAS data types. Integers use the nullable types so one missing value
+# doesn't turn a column into float64, strings are mostly repeated ids and flags so they go to category.
+PANDAS_DTYPES = {
+    "Byte": "Int8", "UByte": "UInt8", "Int16": "Int16", "UInt16": "UInt16",
+    "Int32": "Int32", "UInt32": "UInt32", "Int64": "Int64", "UInt64": "UInt64",
+    "Float32": "float32", "Float64": "float64", "String": "category"
+}
+# Attributes that share the data type of the variable they describe
+TYPED_ATTRIBUTES = ("_FillValue", "missing_value", "actual_range", "data_min", "data_max",
+                    "valid_min", "valid_max", "valid_range")
+# Plan entry for columns parsed into datetime64, tabledap sends them as ISO 8601 strings
+DATETIME = "datetime64"
+
+# (datatype, value) from a typed DasAttribute or a legacy {"datatype", "value"} entry
+def attributeInfo(entry) -> tuple:
+    if isinstance(entry, DasAttribute):
+        return entry.datatype, entry.value
+    if isinstance(entry, dict) and "datatype" in entry:
+        return entry["datatype"], entry.get("value")
+    return None, None
+
+# DAS data type of a variable's values, String when none of its attributes are numeric
+def getVariableType(var_attrs: dict) -> str:
+    for name in TYPED_ATTRIBUTES:
+        datatype, value = attributeInfo(var_attrs.get(name))
+        if datatype is None:
+            continue
+        if datatype == "Byte":
+            _, unsigned = attributeInfo(var_attrs.get("_Unsigned"))
+            if str(unsigned).strip('"').lower() == "true":
+                return "UByte"
+        return datatype
+    return "String"
+
+def isTimeVariable(var_attrs: dict) -> bool:
+    _, units = attributeInfo(var_attrs.get("units"))
+    return isinstance(units, str) and " since " in units
+
+# cf_role values that name the station, profile or platform a row belongs to
+FEATURE_ROLES = ("timeseries_id", "profile_id", "trajectory_id")
+
+# Variables whose cf_role identifies a feature, e.g. ["station"] for a multi-station dataset
+def getFeatureIdVariables(dasJson: dict) -> list:
+    if dasJson is None:
+        return []
+    names = []
+    for name, var_attrs in flattenContainers(dasJson).items():
+        if name == "NC_Global" or not isinstance(var_attrs, dict):
+            continue
+        _, role = attributeInfo(var_attrs.get("cf_role"))
+        if isinstance(role, str) and role.strip('"') in FEATURE_ROLES:
+            names.append(name)
+    return names
+
+# Units csvp puts after each column name, from a parsed DAS (typed model or legacy dict).
+# Time variables get "UTC" since tabledap sends them as ISO 8601 strings, e.g.
+# {"time": "UTC", "latitude": "degrees_north", "sea_water_temperature": "degree_C"}
+def getUnits(dasJson: dict) -> dict:
+    if dasJson is None:
+        return {}
+    legacy = any(isinstance(entry, dict) and "datatype" in entry
+                 for container in dasJson.values() if isinstance(container, dict)
+                 for entry in container.values())
+    variables = dasJson if legacy else flattenContainers(dasJson)
+    units = {}
+    for name, var_attrs in variables.items():
+        if name == "NC_Global" or not isinstance(var_attrs, dict):
+            continue
+        _, value = attributeInfo(var_attrs.get("units"))
+        if isTimeVariable(var_attrs):
+            units[name] = "UTC"
+        elif isinstance(value, str) and value.strip('"'):
+            units[name] = value.strip('"')
+    return units
+
+# Column dtypes for reading tabledap responses, from a parsed DAS (typed model or legacy dict).
+# e.g. {"time": "datetime64", "sea_water_temperature": "float32", "station": "category"}
+def getDtypePlan(dasJson: dict) -> dict:
+    if dasJson is None:
+        return {}
+    # Legacy dicts from openDasJson are already flat
+    legacy = any(isinstance(entry, dict) and "datatype" in entry
+                 for container in dasJson.values() if isinstance(container, dict)
+                 for entry in container.values())
+    variables = dasJson if legacy else flattenContainers(dasJson)
+    plan = {}
+    for name, var_attrs in variables.items():
+        if name == "NC_Global" or not isinstance(var_attrs, dict) or not var_attrs:
+            continue
+        if not any(attributeInfo(entry)[0] for entry in var_attrs.values()):
+            continue
+        if isTimeVariable(var_attrs):
+            plan[name] = DATETIME
+        else:
+            plan[name] = PANDAS_DTYPES.get(getVariableType(var_attrs), "object")
+    return plan
+
+# In-process LRU cache for DAS lookups, keyed by (lookup, datasetid).
+# Entries from the metadata store are dropped when the store file changes underneath us,
+# entries from legacy JSON files when that file's mtime changes, and saveDas drops its own dataset.
+DAS_CACHE_SIZE = 512
+
+class DasCache:
+    def __init__(self, maxsize: int = DAS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.storeMtime = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def checkStore(self) -> None:
+        current = getStoreMtime()
+        if current != self.storeMtime:
+            self.entries.clear()
+            self.storeMtime = current
+
+    def get(self, key):
+        with self.lock:
+            self.checkStore()
+            entry = self.entries.get(key)
+            if entry is not None:
+                json_path, json_mtime, value = entry
+                if json_path is None or getMtime(json_path) == json_mtime:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value, json_path: str = None) -> None:
+        with self.lock:
+            json_mtime = getMtime(json_path) if json_path else None
+            self.entries[key] = (json_path, json_mtime, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    # Called after our own writes so the rest of the cache survives
+    def invalidate(self, datasetid: str) -> None:
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == datasetid]:
+                del self.entries[key]
+            self.storeMtime = getStoreMtime()
+
+    # Our own write that didn't change any cached value
+    def noteStoreWrite(self) -> None:
+        with self.lock:
+            self.storeMtime = getStoreMtime()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.storeMtime = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "maxsize": self.maxsize}
+
+def getMtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+# SQLite in WAL mode writes to the -wal file first, so both count
+def getStoreMtime():
+    path = ms.getStorePath()
+    return (getMtime(path), getMtime(path + "-wal"))
+
+_dasCache = DasCache()
+
+def getDasCacheStats() -> dict:
+    return _dasCache.stats()
+
+def clearDasCache() -> None:
+    _dasCache.clear()
+
+def hashDas(das_text: str) -> str:
+    return hashlib.sha1(das_text.encode("utf-8")).hexdigest()
+
+# Parses a DAS response and writes it to the metadata store, returns True if the stored DAS changed.
+# An identical DAS (same content hash) is only marked as fresh, it isn't parsed again.
+def storeDas(das_text: str, datasetid: str, server: str = None, etag: str = None, last_modified: str = None) -> bool:
+    content_hash = hashDas(das_text)
+    if ms.getValidators(datasetid, server or "")[2] == content_hash:
+        touchDas(datasetid, server, etag, last_modified)
+        return False
+
+    model = parseDasStream(das_text.splitlines())
+    ms.upsertDataset(server, datasetid, das_text,
+                     time_range=getTimeRange(model),
+                     bbox=getBbox(model),
+                     variables=getVariableNames(model),
+                     etag=etag,
+                     last_modified=last_modified,
+                     content_hash=content_hash)
+    _dasCache.invalidate(datasetid)
+    return True
+
+def touchDas(datasetid: str, server: str = None, etag: str = None, last_modified: str = None) -> None:
+    ms.touchDataset(server, datasetid, etag, last_modified)
+    _dasCache.noteStoreWrite()
+
+# Same as storeDas but returns the store path
+def saveDas(das_text: str, datasetid: str, server: str = None, etag: str = None, last_modified: str = None) -> str:
+    storeDas(das_text, datasetid, server, etag, last_modified)
+    return ms.getStorePath()
+
 def getConfDir():
 
     agol_home = os.getenv('AGOL_HOME', '/arcgis/home')
@@ -50,10 +414,18 @@ def getConfDir():
     os.makedirs(das_conf_dir, exist_ok=True)
     return das_conf_dir
 
+# Per-dataset JSON files are only read when the dataset isn't in the metadata store yet
+def getJsonPath(datasetid: str) -> str:
+    return os.path.join(getConfDir(), f'{datasetid}.json')
+
+# Only a hit is cached, a dataset that is missing now may be saved by another thread or process at any time
 def checkForJson(datasetid: str) -> bool:
-    das_conf_dir = getConfDir()
-    filepath = os.path.join(das_conf_dir, f'{datasetid}.json')
-    return os.path.exists(filepath)
+    found, exists = _dasCache.get(("exists", datasetid))
+    if not found:
+        exists = ms.hasDataset(datasetid) or os.path.exists(getJsonPath(datasetid))
+        if exists:
+            _dasCache.put(("exists", datasetid), exists)
+    return exists
 
 
 #need this function to convert OrderedDict to dict for json
@@ -72,9 +444,19 @@ def saveToJson(data, datasetid: str) -> str:
         json.dump(data, json_file, indent=4)
     return filepath
 
+# The returned dict is shared through the cache, don't modify it
 def openDasJson(datasetid):
-    das_conf_dir = getConfDir()
-    filepath = os.path.join(das_conf_dir, f'{datasetid}.json')
+    found, data = _dasCache.get(("das", datasetid))
+    if found:
+        return data
+
+    das_text = ms.getDas(datasetid)
+    if das_text is not None:
+        data = convertToDict(parseDasResponse(das_text))
+        _dasCache.put(("das", datasetid), data)
+        return data
+
+    filepath = getJsonPath(datasetid)
     try:
         with open(filepath, 'r') as json_file:
             data = json.load(json_file)
@@ -82,14 +464,25 @@ def openDasJson(datasetid):
                 print(f"File {filepath} does not contain data.")
                 return None
             else:
+                _dasCache.put(("das", datasetid), data, filepath)
                 return data
     except FileNotFoundError:
-        print(f"File {filepath} not found.")
+        print(f"DAS for {datasetid} not found.")
         return None
 
 def getTimeFromJson(datasetid):
-    das_conf_dir = getConfDir()
-    filepath = os.path.join(das_conf_dir, f'{datasetid}.json')
+    found, time_range = _dasCache.get(("time", datasetid))
+    if found:
+        return time_range
+
+    if ms.hasDataset(datasetid):
+        time_range = ms.getTimeRange(datasetid)
+        if time_range is None:
+            print(f"Error getting time from DAS: no time actual_range for {datasetid}")
+        _dasCache.put(("time", datasetid), time_range)
+        return time_range
+
+    filepath = getJsonPath(datasetid)
     with open(filepath, 'r') as json_file:
         data = json.load(json_file)
     
@@ -98,6 +491,7 @@ def getTimeFromJson(datasetid):
         start_time_str, end_time_str = time_str.split(', ')
         start_time = int(float(start_time_str))
         end_time = int(float(end_time_str))
+        _dasCache.put(("time", datasetid), (start_time, end_time), filepath)
         return start_time, end_time
     except Exception as e:
         print(f"Error getting time from JSON: {e}")
@@ -146,7 +540,9 @@ def displayAttributes(timeintv: int , attributes: list) -> None:
 
 
 
-def getActualAttributes(dasJson, erddapObject: ec.ERDDAPHandler) -> list:
+# With profile, variables ERDDAP reports no values for are dropped (see ERDDAPHandler.attributeRequest),
+# erddapObject needs its server and datasetid set for that
+def getActualAttributes(dasJson, erddapObject: ec.ERDDAPHandler, profile: bool = True) -> list:
     attributes_set = set()
     for var_name, var_attrs in dasJson.items():
         if not isinstance(var_attrs, dict):
@@ -169,5 +565,9 @@ def getActualAttributes(dasJson, erddapObject: ec.ERDDAPHandler) -> list:
         if len(var_attrs) == 1:
             attributes_set.add(var_name)
 
-    setattr(erddapObject, "attributes", list(attributes_set))
-    return list(attributes_set)
+    attributes = sorted(attributes_set)
+    if profile and attributes and erddapObject.server and erddapObject.datasetid:
+        attributes = erddapObject.attributeRequest(attributes)
+
+    setattr(erddapObject, "attributes", attributes)
+    return attributes
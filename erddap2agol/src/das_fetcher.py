@@ -0,0 +1,110 @@
+#Fetches DAS documents for many datasets at once.
+#Requests run on a thread pool, the transport's host limiter paces them,
+#and a failure on one dataset never stops the rest of the batch.
+import time, requests
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from . import erddap_client as ec
+from . import das_client as dc
+from . import metadata_store as ms
+from . import transport as tp
+
+# Worker threads for a batch, requests in flight per host are capped by tp.configureHost
+MAX_PER_HOST = 4
+MAX_RETRIES = 3
+# Seconds, doubled after every failed attempt
+BACKOFF_BASE = 1.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+# Seconds a stored DAS is trusted before batch scans revalidate it
+DAS_MAX_AGE = 3600
+
+# changed is False when a revalidation found the stored DAS still current
+DasResult = namedtuple("DasResult", ["datasetid", "das", "error", "changed"], defaults=[True])
+
+class RetryableError(Exception):
+    pass
+
+
+def requestDas(erddapObj: ec.ERDDAPHandler, datasetid: str, headers: dict = None, retries: int = MAX_RETRIES, backoff: float = BACKOFF_BASE):
+    url = f"{erddapObj.server}{datasetid}.das"
+
+    # 429 and 503 were already retried by the transport after the pause the server asked for
+    for attempt in range(retries + 1):
+        try:
+            response = tp.get(url, headers=headers)
+            if response.status_code in RETRY_STATUS:
+                raise RetryableError(f"HTTP {response.status_code} from {url}")
+            response.raise_for_status()
+            return response
+        except (RetryableError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt == retries:
+                raise
+            wait = backoff * (2 ** attempt)
+            print(f"Retrying DAS for {datasetid} in {wait:.1f}s ({e})")
+            time.sleep(wait)
+
+def fetchDas(erddapObj: ec.ERDDAPHandler, datasetid: str, retries: int = MAX_RETRIES, backoff: float = BACKOFF_BASE) -> str:
+    return requestDas(erddapObj, datasetid, None, retries, backoff).text
+
+# Conditional GET against the validators kept in the metadata store.
+# A 304 or an identical body only marks the stored DAS as fresh, anything else is parsed and stored.
+def revalidateDas(erddapObj: ec.ERDDAPHandler, datasetid: str, retries: int = MAX_RETRIES, backoff: float = BACKOFF_BASE) -> DasResult:
+    server = erddapObj.server
+    etag, last_modified, content_hash = ms.getValidators(datasetid, server)
+
+    headers = {}
+    if content_hash is not None:
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    response = requestDas(erddapObj, datasetid, headers, retries, backoff)
+    if response.status_code == 304:
+        dc.touchDas(datasetid, server, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        return DasResult(datasetid, ms.getDas(datasetid, server), None, False)
+
+    das_text = response.text
+    changed = dc.storeDas(das_text, datasetid, server, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return DasResult(datasetid, das_text, None, changed)
+
+
+def isStale(erddapObj: ec.ERDDAPHandler, datasetid: str, maxAge: float = DAS_MAX_AGE) -> bool:
+    fetched_at = ms.getFetchedAt(datasetid, erddapObj.server)
+    return fetched_at is None or (time.time() - fetched_at) > maxAge
+
+
+# DasResult for one dataset, errors are returned in the result rather than raised
+def fetchDasResult(erddapObj: ec.ERDDAPHandler, datasetid: str, retries: int = MAX_RETRIES, backoff: float = BACKOFF_BASE, revalidate: bool = False) -> DasResult:
+    catalog = erddapObj.getCatalog()
+    catalog.refresh()
+    if not catalog.contains(datasetid):
+        return DasResult(datasetid, None, "not found in the list of available datasets")
+    try:
+        if revalidate:
+            return revalidateDas(erddapObj, datasetid, retries, backoff)
+        return DasResult(datasetid, fetchDas(erddapObj, datasetid, retries, backoff), None)
+    except Exception as e:
+        return DasResult(datasetid, None, str(e))
+
+# Returns a DasResult for every dataset, in the same order as datasetids.
+# With revalidate=True each DAS is conditionally refreshed and written to the metadata store.
+def fetchDasBatch(erddapObj: ec.ERDDAPHandler, datasetids: list, maxPerHost: int = MAX_PER_HOST, retries: int = MAX_RETRIES, backoff: float = BACKOFF_BASE, revalidate: bool = False) -> list:
+    erddapObj.getCatalog().refresh()
+    if not datasetids:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(maxPerHost, len(datasetids))) as executor:
+        results = list(executor.map(lambda datasetid: fetchDasResult(erddapObj, datasetid, retries, backoff, revalidate),
+                                    datasetids))
+
+    failed = [result for result in results if result.error is not None]
+    for result in failed:
+        print(f"\nCould not fetch DAS for {result.datasetid}: {result.error}")
+    if revalidate:
+        changed = sum(1 for result in results if result.error is None and result.changed)
+        print(f"\nRevalidated {len(results) - len(failed)} of {len(results)} DAS documents, {changed} changed.")
+    else:
+        print(f"\nFetched {len(results) - len(failed)} of {len(results)} DAS documents.")
+
+    return results
@@ -0,0 +1,128 @@
+#Caps the number of rows published for dense datasets.
+#The time range is split into buckets sized so that one row per bucket stays under maxFeatures.
+#ERDDAP picks the row closest to each bucket with orderByClosest, separately for every station
+#and depth, when the server can't the full download is thinned locally the same way.
+import csv, math, os
+from datetime import datetime
+from . import erddap_client as ec
+from . import das_client as dc
+from . import chunked_download as cd
+from . import response_formats as rf
+
+# Bucket sizes in seconds, a computed size is rounded up to the next one so the interval reads
+# like "10minutes" in the url and stays stable while the window slides
+NICE_SECONDS = [1, 2, 5, 10, 15, 20, 30,
+                60, 120, 180, 300, 600, 900, 1200, 1800,
+                3600, 7200, 10800, 14400, 21600, 28800, 43200, 86400]
+UNITS = [(86400, "days"), (3600, "hours"), (60, "minutes"), (1, "seconds")]
+
+# Smallest bucket that keeps the erddapObj time range under maxFeatures rows
+def bucketSeconds(erddapObj: ec.ERDDAPHandler, maxFeatures: int) -> int:
+    span = erddapObj.calculateTimeRange("seconds")
+    raw = span / max(maxFeatures - 1, 1)
+    for seconds in NICE_SECONDS:
+        if seconds >= raw:
+            return seconds
+    return math.ceil(raw / 86400) * 86400
+
+# 3600 -> "1hours", 5400 -> "90minutes", the form orderByClosest takes after "time/"
+def formatInterval(seconds: int) -> str:
+    for size, unit in UNITS:
+        if seconds % size == 0:
+            return f"{seconds // size}{unit}"
+
+def parseTime(value: str) -> float:
+    value = value.strip()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    return datetime.fromisoformat(value).timestamp()
+
+# Columns that tell features apart, the cf_role station/profile/platform id and depth, when requested
+def featureColumns(erddapObj: ec.ERDDAPHandler, attrs: list) -> list:
+    columns = erddapObj.orderedAttributes(attrs)
+    keys = [name for name in dc.getFeatureIdVariables(dc.openDasJson(erddapObj.datasetid)) if name in columns]
+    if "depth" in columns and "depth" not in keys:
+        keys.append("depth")
+    return keys
+
+# Keeps the row closest to each multiple of bucket seconds, like orderByClosest("station,depth,time/N"):
+# one row per bucket for every combination of keyColumns. Streams the csvp file and holds at most
+# one row per bucket and feature, rows are written back in time order. Returns the number of rows kept.
+def decimateFile(file_path: str, timeName: str, bucket: int, keyColumns: list = None) -> int:
+    kept = {}
+    tmp_path = file_path + ".part"
+    with open(file_path, 'r', encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return 0
+        names = [rf.splitUnits(column)[0] for column in header]
+        time_index = names.index(timeName)
+        key_indexes = [names.index(name) for name in keyColumns or [] if name in names]
+        for row in reader:
+            if not row or not row[time_index]:
+                continue
+            seconds = parseTime(row[time_index])
+            key = (tuple(row[index] for index in key_indexes), round(seconds / bucket))
+            distance = abs(seconds - key[1] * bucket)
+            if key not in kept or distance < kept[key][0]:
+                kept[key] = (distance, seconds, row)
+
+    with open(tmp_path, 'w', encoding="utf-8", newline="") as out:
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(header)
+        for _, _, row in sorted(kept.values(), key=lambda entry: entry[1]):
+            writer.writerow(row)
+    os.replace(tmp_path, file_path)
+    return len(kept)
+
+def countRows(file_path: str) -> int:
+    with open(file_path, 'rb') as f:
+        return max(sum(1 for line in f if line.strip()) - 1, 0)
+
+# Widens the buckets until the file is under maxFeatures, for when there are more stations or
+# depths than the bucket size allowed for. Stops at one bucket for the whole range. Returns the rows left.
+def enforceCap(erddapObj: ec.ERDDAPHandler, file_path: str, bucket: int, keyColumns: list, maxFeatures: int) -> int:
+    rows = countRows(file_path)
+    if rows > maxFeatures:
+        # Several rows can share a bucket, e.g. a server that ignored part of the orderByClosest
+        rows = decimateFile(file_path, erddapObj.time, bucket, keyColumns)
+    span = erddapObj.calculateTimeRange("seconds")
+    while rows > maxFeatures and bucket < span:
+        bucket = math.ceil(bucket * rows / maxFeatures)
+        rows = decimateFile(file_path, erddapObj.time, bucket, keyColumns)
+        print(f"Thinned {erddapObj.datasetid} to one row per {formatInterval(bucket)} per feature, {rows} rows")
+    return rows
+
+# Downloads at most maxFeatures rows of attrs for the erddapObj time range.
+# Returns (file_path, url) where url is the request that was used, or (None, url) on failure.
+def downloadDecimated(erddapObj: ec.ERDDAPHandler, attrs: list, maxFeatures: int) -> tuple:
+    bucket = bucketSeconds(erddapObj, maxFeatures)
+    keys = featureColumns(erddapObj, attrs)
+    erddapObj.decimation = formatInterval(bucket)
+    erddapObj.decimationKeys = keys
+    try:
+        url = erddapObj.generate_url(False, list(attrs))
+    finally:
+        erddapObj.decimation = None
+        erddapObj.decimationKeys = None
+    print(f"\nDecimating {erddapObj.datasetid} to one row per {formatInterval(bucket)} (at most {maxFeatures} rows)")
+    failure = {}
+    file_path = erddapObj.downloadToCsv(url, failure=failure)
+
+    if file_path is None:
+        if failure.get("status") != 400:
+            # No rows in the window, or a network or server failure a full download won't get past
+            return None, url
+        # Older servers reject orderByClosest, take everything and thin it here
+        print(f"\norderByClosest was rejected by {erddapObj.server}, decimating {erddapObj.datasetid} locally.")
+        url = erddapObj.generate_url(False, list(attrs))
+        if cd.shouldChunk(erddapObj):
+            file_path = cd.downloadChunked(erddapObj, attrs)
+        else:
+            file_path = erddapObj.downloadToCsv(url)
+        if file_path is None:
+            return None, url
+        print(f"Kept {decimateFile(file_path, erddapObj.time, bucket, keys)} rows of {erddapObj.datasetid}")
+    enforceCap(erddapObj, file_path, bucket, keys, maxFeatures)
+    return file_path, url
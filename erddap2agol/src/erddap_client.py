@@ -1,13 +1,24 @@
 #ERDDAP stuff is handled here with the ERDDAPHandler class.
-import sys, os, requests, json
+import sys, os, requests, json, time, csv
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import pandas as pd
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
 from io import StringIO
 import tempfile
+from . import catalog_cache as cc
+from . import transport as tp
+from . import response_formats as rf
+from . import tabledap_query as tq
+from . import metadata_store as ms
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+# Profiled variable counts are reused for this long before a dataset is counted again
+ATTRIBUTE_COUNT_MAX_AGE = 7 * 86400
+# Days of data read to count values when the server can't do orderByCount
+SAMPLE_DAYS = 7
+
 def getTempDir():
     # Check if running in AGOL Notebook environment
     if os.path.exists('/arcgis/home'):
@@ -34,9 +45,30 @@ def getErddapConfDir() -> str:
 
     return os.path.join(erddap_conf_dir, 'active_erddaps.json')
 
-def getErddapList() -> None:
+# Seconds before the awesome-erddap list is downloaded again
+ERDDAP_LIST_TTL = 86400
+# Seconds a server health probe is trusted
+HEALTH_TTL = 900
+PROBE_TIMEOUT = (5, 10)
+PROBE_WORKERS = 16
+
+# The list is cached on disk for ERDDAP_LIST_TTL, the cached copy is used if GitHub can't be reached
+def getErddapList(force: bool = False) -> None:
     url = "https://raw.githubusercontent.com/IrishMarineInstitute/awesome-erddap/master/erddaps.json"
-    response = requests.get(url)
+    filepath = getErddapConfDir()
+    have_cached = os.path.exists(filepath)
+
+    if have_cached and not force and (time.time() - os.path.getmtime(filepath)) < ERDDAP_LIST_TTL:
+        return filepath
+
+    try:
+        response = tp.get(url)
+    except requests.exceptions.RequestException as e:
+        print(f"\nFailed to fetch ERDDAP List from {url}: {e}")
+        if have_cached:
+            print("Using the cached ERDDAP List.")
+            return filepath
+        return None
     
     if response.status_code == 200:
         try:
@@ -44,9 +76,7 @@ def getErddapList() -> None:
         except json.JSONDecodeError as e:
             print(f"Error decoding ERDDAP list from {url}")
             print(f"Error: {e}")
-            return
-        
-        filepath = getErddapConfDir()
+            return filepath if have_cached else None
 
         with open(filepath, 'w') as f:
             json.dump(data, f, indent=4)
@@ -55,20 +85,256 @@ def getErddapList() -> None:
     else:
         print(f"\nFailed to fetch ERDDAP List from {url}.") 
         print(f"Status code: {response.status_code}")
+        if have_cached:
+            print("Using the cached ERDDAP List.")
+            return filepath
         return None
 
+def getServerHealthPath() -> str:
+    return os.path.join(os.path.dirname(getErddapConfDir()), 'server_health.json')
+
+def loadServerHealth() -> dict:
+    filepath = getServerHealthPath()
+    if not os.path.exists(filepath):
+        return {}
+    try:
+        with open(filepath, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def getBaseUrl(erddap_dict: dict) -> str:
+    baseurl = erddap_dict['url']
+    if baseurl.endswith("/index.html"):
+        baseurl = baseurl[:-len("/index.html")]
+    return baseurl.rstrip("/")
+
+# HEAD request against the server landing page, falls back to GET for servers that reject HEAD
+def probeServer(baseurl: str) -> dict:
+    start = time.perf_counter()
+    try:
+        response = tp.head(baseurl, timeout=PROBE_TIMEOUT)
+        if response.status_code in (405, 501):
+            response = tp.get(baseurl, timeout=PROBE_TIMEOUT, stream=True)
+            response.close()
+        status = response.status_code
+        available = status < 400
+        error = None if available else f"HTTP {status}"
+    except requests.exceptions.RequestException as e:
+        status = None
+        available = False
+        error = str(e)
+
+    return {
+        "available": available,
+        "latency": round(time.perf_counter() - start, 3) if available else None,
+        "status": status,
+        "error": error,
+        "checked": time.time()
+    }
+
+# Probes every server in the list in parallel and saves the results, keyed by base url.
+# Results younger than HEALTH_TTL are reused unless force is set.
+def probeServers(force: bool = False) -> dict:
+    with open(getErddapConfDir(), 'r') as f:
+        data = json.load(f)
+
+    health = loadServerHealth()
+    now = time.time()
+    baseurls = [getBaseUrl(erddap) for erddap in data]
+    to_probe = [baseurl for baseurl in baseurls
+                if force or baseurl not in health or (now - health[baseurl].get("checked", 0)) > HEALTH_TTL]
+
+    if to_probe:
+        print(f"\nChecking {len(to_probe)} ERDDAP servers...")
+        with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+            for baseurl, result in zip(to_probe, executor.map(probeServer, to_probe)):
+                health[baseurl] = result
+
+        with open(getServerHealthPath(), 'w') as f:
+            json.dump(health, f, indent=4)
+
+    return health
+
+# (list index, name, latency) for reachable servers, fastest first
+def rankServers(health: dict = None) -> list:
+    with open(getErddapConfDir(), 'r') as f:
+        data = json.load(f)
+    if health is None:
+        health = loadServerHealth()
+
+    ranked = []
+    for index, erddap in enumerate(data, start=1):
+        result = health.get(getBaseUrl(erddap))
+        if result and result["available"]:
+            ranked.append((index, erddap['name'], result["latency"]))
+    ranked.sort(key=lambda entry: entry[2])
+    return ranked
+
 def showErddapList() -> None:
     filepath = getErddapConfDir()
     with open(filepath, 'r') as f:
         data = json.load(f)
+
+    health = loadServerHealth()
     
     for index, erddap in enumerate(data, start=1):
-        print(f"{index}. ERDDAP Server: {erddap['name']}")
+        result = health.get(getBaseUrl(erddap))
+        if result is None:
+            print(f"{index}. ERDDAP Server: {erddap['name']}")
+        elif result["available"]:
+            print(f"{index}. ERDDAP Server: {erddap['name']} ({int(result['latency'] * 1000)} ms)")
+        else:
+            print(f"{index}. ERDDAP Server: {erddap['name']} (unreachable)")
 
 
 #--------------------------------------------------------------------------------
+# Bytes read from the socket per write when streaming a download to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Streams a response body into file_path chunk by chunk so memory stays flat whatever the size.
+# With validate the first line is checked as a header and newlines are counted as the chunks pass,
+# expected_columns optionally lists names the header must contain, fmt is the requested response format.
+# Returns {"path", "bytes", "rows", "header", "wire_bytes"} or None when the request or validation fails,
+# path is None when ERDDAP reports no matching results. Pass a dict as failure to learn why a
+# download failed, it gets the HTTP status (None without a response) and whether a retry could help.
+def streamToFile(url: str, file_path: str, validate: bool = True, expected_columns: list = None,
+                 fmt: rf.ResponseFormat = None, failure: dict = None) -> dict:
+    fmt = fmt or rf.getFormat()
+    failure = failure if failure is not None else {}
+    # Binary formats have no lines to count, they are checked when they're read
+    validate = validate and not fmt.binary
+    tmp_path = file_path + ".part"
+    header = None
+    head_buffer = b""
+    newlines = 0
+    last_byte = b""
+    total_bytes = 0
+    wire_bytes = None
+
+    try:
+        with tp.get(url, stream=True) as response:
+            if response.status_code >= 400:
+                message = response.text[:500]
+                if response.status_code == 404 and "no matching results" in message.lower():
+                    # ERDDAP's way of saying the query is valid but empty
+                    return {"path": None, "bytes": 0, "rows": 0, "header": None, "wire_bytes": 0}
+                else:
+                    print(f"HTTP error occurred: {response.status_code} {message}")
+                failure.update(status=response.status_code, retryable=isRetryable(response.status_code))
+                return None
+            with open(tmp_path, 'wb') as f:
+                # gzip (or br) is negotiated by the transport and decoded chunk by chunk on the way to disk
+                for chunk in tp.iterContent(response, DOWNLOAD_CHUNK_SIZE):
+                    if not chunk:
+                        continue
+                    f.write(chunk)
+                    total_bytes += len(chunk)
+                    last_byte = chunk[-1:]
+                    if validate:
+                        newlines += chunk.count(b"\n")
+                        if header is None:
+                            head_buffer += chunk
+                            if b"\n" in head_buffer:
+                                header = head_buffer.split(b"\n", 1)[0].decode("utf-8", "replace").strip()
+                                head_buffer = b""
+            wire_bytes = tp.wireBytes(response)
+    except (requests.exceptions.RequestException, OSError) as err:
+        print(f"Download failed for {url}: {err}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        failure.update(status=None, retryable=True)
+        return None
+
+    rows = None
+    if validate:
+        if header is None and head_buffer:
+            header = head_buffer.decode("utf-8", "replace").strip()
+        # A final line without a trailing newline is still a row
+        lines = newlines + (1 if last_byte and last_byte != b"\n" else 0)
+        rows = max(lines - fmt.headerRows, 0)
+        problem = validateHeader(header, expected_columns, fmt)
+        if problem:
+            print(f"\nDownload from {url} failed validation: {problem}")
+            os.remove(tmp_path)
+            failure.update(status=None, retryable=False)
+            return None
+
+    os.replace(tmp_path, file_path)
+    return {"path": file_path, "bytes": total_bytes, "rows": rows, "header": header,
+            "wire_bytes": wire_bytes if wire_bytes is not None else total_bytes}
+
+# Timeouts, dropped connections, throttling and server errors can pass, any other 4xx won't
+def isRetryable(status) -> bool:
+    return status is None or status == 429 or status >= 500
+
+# "12.3 MB, 1.2 MB transferred" for a streamToFile result
+def describeTransfer(result: dict) -> str:
+    text = f"{result['bytes'] / 1e6:.1f} MB"
+    if result.get("wire_bytes") is not None and result["wire_bytes"] != result["bytes"]:
+        text += f", {result['wire_bytes'] / 1e6:.1f} MB transferred"
+    return text
+
+# Returns a description of what is wrong with a downloaded header line, or None if it looks right
+def validateHeader(header: str, expected_columns: list = None, fmt: rf.ResponseFormat = None):
+    if not header:
+        return "empty response"
+    if header.startswith("<") or header.startswith("Error {"):
+        return f"error page instead of data ({header[:80]})"
+    names = rf.headerNames(fmt or rf.getFormat(), header) if expected_columns else None
+    if names is not None:
+        missing = [column for column in expected_columns if column not in names]
+        if missing:
+            return f"missing columns {', '.join(missing)}"
+    return None
+
+# Variable names requested by a tabledap url, in the order the response returns them
+def queryColumns(url: str) -> list:
+    return tq.TabledapQuery.fromUrl(url).variables
+
+# Downloads a response in fmt and leaves it at file_path as csvp, converting it when it arrived
+# in another format. units ({name: units} from the DAS) labels the columns of formats that don't
+# carry their own units. Returns the streamToFile result with rows counted in the csvp file.
+def downloadAsCsvp(url: str, file_path: str, fmt: rf.ResponseFormat = None, validate: bool = True,
+                   expected_columns: list = None, failure: dict = None, units: dict = None) -> dict:
+    fmt = fmt or rf.getFormat()
+    failure = failure if failure is not None else {}
+    if fmt.name == "csvp":
+        return streamToFile(url, file_path, validate, expected_columns, fmt, failure)
+
+    raw_path = f"{file_path}.{fmt.name}"
+    result = streamToFile(url, raw_path, validate, expected_columns, fmt, failure)
+    if result is None or result["path"] is None:
+        return result
+    try:
+        rows = rf.toCsvp(raw_path, fmt, file_path, queryColumns(url), units)
+    except (ValueError, OSError, UnicodeDecodeError) as err:
+        print(f"\nCould not read the {fmt.name} response from {url}: {err}")
+        failure.update(status=None, retryable=False)
+        return None
+    finally:
+        os.remove(raw_path)
+    return {"path": file_path, "bytes": result["bytes"], "rows": rows, "header": result["header"],
+            "wire_bytes": result["wire_bytes"]}
+
+# Time of the last row of a csvp file ordered by time, as YYYY-MM-DDTHH:MM:SS, read from the file tail
+def readLastTime(file_path: str, timeName: str = "time") -> str:
+    try:
+        with open(file_path, 'rb') as f:
+            header = f.readline()
+            names = rf.headerNames(rf.getFormat("csvp"), header.decode("utf-8"))
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 65536, 0))
+            lines = [line for line in f.read().splitlines() if line.strip()]
+    except OSError:
+        return None
+    if not lines or timeName not in names or lines[-1] == header.rstrip(b"\r\n"):
+        return None
+    value = next(csv.reader([lines[-1].decode("utf-8")]))[names.index(timeName)]
+    return value.rstrip("Z")[:19] or None
+
 class ERDDAPHandler:
-    def __init__(self, server, serverInfo, datasetid, attributes, fileType, longitude, latitude, time, start_time, end_time, geoParams):
+    def __init__(self, server, serverInfo, datasetid, attributes, fileType, longitude, latitude, time, start_time, end_time, geoParams, dtypes=None, constraints=None, units=None):
         self.server = server
         self.serverInfo = serverInfo
         self.datasetid = datasetid
@@ -80,29 +346,32 @@ class ERDDAPHandler:
         self.start_time = start_time
         self.end_time = end_time
         self.geoParams = geoParams
+        # Column dtypes from the DAS, see das_client.getDtypePlan
+        self.dtypes = dtypes
+        # Units per variable from the DAS for formats without them, see das_client.getUnits
+        self.units = units
+        # Extra (variable, operator, value) filters applied to every data request, e.g. from setBbox
+        self.constraints = constraints
+        # orderByClosest interval like "10minutes" while decimate is downloading, None otherwise,
+        # decimationKeys are the station/depth columns each bucket is kept per
+        self.decimation = None
+        self.decimationKeys = None
 
     
+    # Catalog is cached per server, see catalog_cache
+    def getCatalog(self) -> cc.CatalogCache:
+        return cc.getCatalog(self.serverInfo)
+
     def getDatasetIDList(self) -> list:
-        url = f"{self.serverInfo}"
-        response = requests.get(url)
-        data = response.json()
-        
-        column_names = data['table']['columnNames']
-        dataset_id_index = column_names.index("Dataset ID")
-        
-        rows = data['table']['rows']
-        dataset_id_list = [row[dataset_id_index] for row in rows if row[dataset_id_index] != "allDatasets"]
-        
-        return dataset_id_list
+        return self.getCatalog().getDatasetIDs()
     
     def getDas(self, datasetid: str) -> str:
-        dataset_id_list = self.getDatasetIDList()
-        if datasetid not in dataset_id_list:
+        if not self.getCatalog().contains(datasetid):
             print(f"\nDataset ID {datasetid} not found in the list of available datasets.")
             return None
         else:
             url = f"{self.server}{datasetid}.das"
-            response = requests.get(url)
+            response = tp.get(url)
             return response.text
         
     def setErddap(self, erddapIndex: int) -> None:
@@ -118,68 +387,28 @@ class ERDDAPHandler:
             print(f"\nSelected ERDDAP Server: {erddap_dict['name']}")
 
             server_obj = custom_server
-            baseurl = erddap_dict['url']
-
-            if baseurl.endswith("/index.html"):
-                baseurl = baseurl[:-10]
+            baseurl = getBaseUrl(erddap_dict)
 
-                try:
-                    serv_check = requests.get(baseurl)
-                    serv_check.raise_for_status()
+            # A fresh probe is only sent if the cached one is missing, old or says the server is down
+            health = loadServerHealth()
+            result = health.get(baseurl)
+            if result is None or not result["available"] or (time.time() - result.get("checked", 0)) > HEALTH_TTL:
+                result = probeServer(baseurl)
 
-                
-                    server_url = baseurl + "/tabledap/"
-                    setattr(server_obj, 'server', server_url)
+            if not result["available"]:
+                print(f"Error {result['error']} occurred when connecting to {baseurl}")
+                return None
 
-                    server_info_url = baseurl + "/info/index.json"
-                    setattr(server_obj, 'serverInfo', server_info_url)
+            setattr(server_obj, 'server', baseurl + "/tabledap/")
+            setattr(server_obj, 'serverInfo', baseurl + "/info/index.json?itemsPerPage=100000")
 
-                    return server_obj
-                
-                except requests.exceptions.HTTPError as http_err:
-                    print(f"HTTP error {http_err} occurred when connecting to {baseurl}")
-                    return None
-
-            else:
-
-                try:
-                    serv_check = requests.get(baseurl)
-                    serv_check.raise_for_status()
-
-                    server_url = erddap_dict['url'] + "/tabledap/"
-                    setattr(server_obj, 'server', server_url)
-
-                    server_info_url = erddap_dict['url'] + "/info/index.json?itemsPerPage=100000"
-                    setattr(server_obj, 'serverInfo', server_info_url)
-
-                    return server_obj
-                except requests.exceptions.HTTPError as http_err:
-                    print(f"HTTP error {http_err} occurred when connecting to {baseurl}")
-                    return None
+            return server_obj
 
             
     # Generates URL for ERDDAP request based on class object attributes
     def generate_url(self, isSeed: bool, additionalAttr: list = None) -> str:
-        # Initialize the attribute list
-        attrs = []
-
-        # If 'depth' is in additionalAttr, remove it and place it first
-        if additionalAttr and 'depth' in additionalAttr:
-            additionalAttr.remove('depth')
-            attrs.append('depth')
-
-        # Then add 'longitude' and 'latitude'
-        attrs.extend([self.longitude, self.latitude])
-
-        # Then add the rest of additionalAttr
-        if additionalAttr:
-            attrs.extend(additionalAttr)
-
-        # Finally, add 'time'
-        attrs.append(self.time)
-
-        # Join the attributes into the URL
-        attrs_str = '%2C'.join(attrs)
+        # orderedAttributes puts depth first without touching the caller's list
+        attrs = self.orderedAttributes(additionalAttr)
 
         # Construct time constraints
         if isSeed:
@@ -188,23 +417,12 @@ class ERDDAPHandler:
             endtime_seed = self.start_time + timedelta(days=3)
             endtime_seed_str = endtime_seed.strftime('%Y-%m-%dT%H:%M:%S')
             start_time_str = self.start_time.strftime('%Y-%m-%dT%H:%M:%S')
-            time_constraints = (
-                f"&{self.time}%3E%3D{start_time_str}Z"
-                f"&{self.time}%3C%3D{endtime_seed_str}Z"
-            )
+            start, end = f"{start_time_str}Z", f"{endtime_seed_str}Z"
             print(f"Start Time: {start_time_str}", f"End Time: {endtime_seed_str}")
         else:
-            time_constraints = (
-                f"&{self.time}%3E%3D{self.start_time}Z"
-                f"&{self.time}%3C%3D{self.end_time}Z"
-            )
-
-        # Construct the full URL
-        url = (
-            f"{self.server}{self.datasetid}.csvp?"
-            f"{attrs_str}"
-            f"{time_constraints}&orderBy(%22{self.time}%22)"
-        )
+            start, end = f"{self.start_time}Z", f"{self.end_time}Z"
+
+        url = self.buildQuery(attrs, start, end).toUrl()
 
         if isSeed:
             print(f"Seed URL: {url}")
@@ -212,12 +430,54 @@ class ERDDAPHandler:
             print(f"\nGenerated URL: {url}")
 
         return url
-        
+
+    # Query for attrs between start and end, with the handler's own constraints pushed to the server
+    def buildQuery(self, attrs: list, start, end, inclusiveEnd: bool = True) -> tq.TabledapQuery:
+        query = tq.TabledapQuery(self.server, self.datasetid, self.getFormat().name, attrs)
+        query.timeRange(self.time, start, end, inclusiveEnd)
+        for variable, operator, value in self.constraints or []:
+            query.where(variable, operator, value)
+        if self.decimation:
+            return query.orderByClosest(*(self.decimationKeys or []), f"{self.time}/{self.decimation}")
+        return query.orderBy(self.time)
+
+    # Limits every data request to a lon/lat box on the server side
+    def setBbox(self, minLon: float, maxLon: float, minLat: float, maxLat: float) -> None:
+        constraints = [c for c in (self.constraints or []) if c[0] not in (self.longitude, self.latitude)]
+        self.constraints = constraints + [(self.longitude, ">=", minLon), (self.longitude, "<=", maxLon),
+                                          (self.latitude, ">=", minLat), (self.latitude, "<=", maxLat)]
+
+    # The response format requested from ERDDAP, csvp unless fileType picks another supported one
+    def getFormat(self) -> rf.ResponseFormat:
+        return rf.getFormat(self.fileType)
+
+    # Same variable order as generate_url without touching the caller's list
+    def orderedAttributes(self, additionalAttr: list = None) -> list:
+        extra = list(additionalAttr or [])
+        attrs = []
+        if 'depth' in extra:
+            extra.remove('depth')
+            attrs.append('depth')
+        attrs.extend([self.longitude, self.latitude])
+        attrs.extend(extra)
+        attrs.append(self.time)
+        return attrs
+
+    # URL for one time window of a chunked download, start and end are datetimes.
+    # Windows before the last one exclude their end so neighbouring chunks never share a row.
+    def generateChunkUrl(self, additionalAttr: list, start: datetime, end: datetime, isLast: bool) -> str:
+        return self.buildQuery(self.orderedAttributes(additionalAttr), start, end, isLast).toUrl()
+
     def fetchData(self, url):
-        response = self.return_response(url)
-        if isinstance(response, dict) and "status_code" in response:
-            return pd.DataFrame()  
-        return pd.read_csv(StringIO(response))
+        fmt = self.getFormat()
+        file_path = os.path.join(getTempDir(), f"{self.datasetid}_fetch.{fmt.name}")
+        result = streamToFile(url, file_path, fmt=fmt)
+        if result is None or result["path"] is None:
+            return pd.DataFrame()
+        try:
+            return rf.readFrame(file_path, fmt, queryColumns(url), self.dtypes)
+        finally:
+            os.remove(file_path)
 
     def filterAttributesWithData(self, data, attributes):
         valid_attributes = []
@@ -227,41 +487,102 @@ class ERDDAPHandler:
         return valid_attributes
     
 
-    #Works
+    # Keeps the attributes that have at least one non-missing value in the dataset.
+    # When the dataset can't be profiled every attribute is kept.
     def attributeRequest(self, attributes: list) -> list:
-        oldStart = self.start_time
-        oldEnd = self.end_time
-
-        time_list = self.iterateTime("days", 7)
-
-        self.start_time = time_list[0]
-        self.end_time = time_list[-1]
-        
-        generated_url = self.generate_url(isSeed=True, additionalAttr=attributes)
-
-        data = self.fetchData(generated_url)
-
-        valid_attributes = self.filterAttributesWithData(data, attributes)
-
-        self.start_time = oldStart
-        self.end_time = oldEnd
-
-        return valid_attributes
-
+        counts = self.getAttributeCounts(attributes)
+        if counts is None:
+            return list(attributes)
+        empty = [attr for attr in attributes if counts.get(attr) == 0]
+        if empty:
+            print(f"\nSkipping variables with no data in {self.datasetid}: {', '.join(empty)}")
+        return [attr for attr in attributes if counts.get(attr) != 0]
+
+    # Non-missing value count per attribute, from the metadata store or one orderByCount request
+    def getAttributeCounts(self, attributes: list) -> dict:
+        cached = ms.getVariableCounts(self.server, self.datasetid, ATTRIBUTE_COUNT_MAX_AGE)
+        if all(attr in cached for attr in attributes):
+            return {attr: cached[attr] for attr in attributes}
+
+        counts = self.countAttributes(attributes)
+        if counts is None:
+            # A sample only covers a few days, it isn't kept in place of a real count
+            return self.sampleAttributes(attributes)
+        ms.saveVariableCounts(self.server, self.datasetid, counts)
+        return counts
+
+    def readCounts(self, url: str, attributes: list) -> pd.DataFrame:
+        fmt = self.getFormat()
+        file_path = os.path.join(getTempDir(), f"{self.datasetid}_count.{fmt.name}")
+        result = streamToFile(url, file_path, fmt=fmt)
+        if result is None or result["path"] is None:
+            return None
+        try:
+            return rf.readFrame(file_path, fmt, attributes)
+        except (ValueError, OSError) as e:
+            print(f"\nCould not read the counts for {self.datasetid}: {e}")
+            return None
+        finally:
+            os.remove(file_path)
+
+    # One row with the count of every attribute over the whole dataset, counted by the server
+    def countAttributes(self, attributes: list) -> dict:
+        url = tq.TabledapQuery(self.server, self.datasetid, self.getFormat().name, attributes).orderByCount().toUrl()
+        frame = self.readCounts(url, attributes)
+        if frame is None or len(frame) != 1:
+            return None
+        try:
+            return {attr: int(frame[attr].iloc[0]) for attr in attributes}
+        except (KeyError, ValueError, TypeError):
+            return None
 
+    # Fallback for servers without orderByCount, counts values in the first SAMPLE_DAYS of data.
+    # Variables with no values in the sample are left out rather than counted as 0, a sensor
+    # added after the dataset started would otherwise be dropped.
+    def sampleAttributes(self, attributes: list) -> dict:
+        if not self.start_time:
+            return None
+        start = datetime.fromisoformat(str(self.start_time).rstrip("Z"))
+        end = start + timedelta(days=SAMPLE_DAYS)
+        if self.end_time:
+            end = min(end, datetime.fromisoformat(str(self.end_time).rstrip("Z")))
+        url = self.buildQuery(self.orderedAttributes(attributes), start, end).toUrl()
+        frame = self.readCounts(url, queryColumns(url))
+        if frame is None or len(frame) == 0:
+            return None
+        counts = {attr: int(frame[attr].notna().sum()) for attr in attributes if attr in frame.columns}
+        return {attr: count for attr, count in counts.items() if count}
 
     #Works and important
     def responseToCsv(self, response: any) -> str:
-        csvResponse = response
-        csvData = StringIO(csvResponse)
-
-        df = pd.read_csv(csvData, header=None, low_memory=False)
-
         temp_dir = getTempDir()
         file_path = os.path.join(temp_dir, f"{self.datasetid}.csv")
 
-        df.to_csv(file_path, index=False, header=False)
+        # The body is already csv, write it as is instead of round tripping it through pandas
+        with open(file_path, 'w', encoding="utf-8", newline="") as f:
+            f.write(response)
+
+        return file_path
 
+    # Loads a downloaded csvp file with the DAS dtype plan applied
+    def readCsv(self, file_path: str) -> pd.DataFrame:
+        return rf.readFrame(file_path, rf.getFormat("csvp"), dtypes=self.dtypes)
+
+    # Streaming replacement for return_response + responseToCsv, the body goes straight to disk.
+    # failure is filled in as for streamToFile, it stays empty when there were no matching results.
+    def downloadToCsv(self, url: str, validate: bool = True, failure: dict = None) -> str:
+        file_path = os.path.join(getTempDir(), f"{self.datasetid}.csv")
+        expected = None
+        if validate and self.attributes:
+            expected = [attr for attr in self.attributes if attr]
+        result = downloadAsCsvp(url, file_path, self.getFormat(), validate, expected, failure, self.units)
+        if result is None:
+            return None
+        if result["path"] is None:
+            print(f"\nNo matching results for {self.datasetid}")
+            return None
+        if validate:
+            print(f"\nDownloaded {result['rows']} rows ({describeTransfer(result)}) to {file_path}")
         return file_path
 
     #Works and important
@@ -289,11 +610,11 @@ class ERDDAPHandler:
         if incrementType == "days":
             while current <= end:
                 timeList.append(current.isoformat())
-                current += datetime.timedelta(days=increment)
+                current += timedelta(days=increment)
         elif incrementType == "hours":
             while current <= end:
                 timeList.append(current.isoformat())
-                current += datetime.timedelta(hours=increment)
+                current += timedelta(hours=increment)
         return timeList
     
     # We will use this to decide how to chunk the dataset
@@ -303,6 +624,9 @@ class ERDDAPHandler:
         
         if intervalType is None:
             return (end - start).days
+
+        elif intervalType == "seconds":
+            return int((end - start).total_seconds())
         
         elif intervalType == "months":
             year_diff = end.year - start.year
@@ -332,34 +656,11 @@ class ERDDAPHandler:
 
     #Last update is read from database, currentTime is from current time function
     @staticmethod
-    def generateUpdateUrl(full_url: str, last_update: str, currentTime: str) -> str:
-        if '?' in full_url:
-            base_url, query_string = full_url.split('?', 1)
-        else:
-            base_url = full_url
-            query_string = ""
-
-        # Split along encoding
-        params = query_string.split('&')
-
-        updated_params = []
-
-        #Note: time params are hardcoded here.
-        for param in params:
-            if param.startswith('time%3E%3D'):
-                updated_params.append(f"time%3E%3D{last_update}Z")
-            elif param.startswith('time%3C%3D'):
-                updated_params.append(f"time%3C%3D{currentTime}Z")
-            else:
-                updated_params.append(param)
-
-
-        # Join the updated parameters back into a query string
-        updated_query_string = '&'.join(updated_params)
-
-        updated_url = f"{base_url}?{updated_query_string}"
-
-        return updated_url
+    def generateUpdateUrl(full_url: str, last_update: str, currentTime: str, timeVar: str = "time") -> str:
+        query = tq.TabledapQuery.fromUrl(full_url)
+        query.setConstraint(timeVar, ">=", f"{last_update}Z")
+        query.setConstraint(timeVar, "<=", f"{currentTime}Z")
+        return query.toUrl()
 
     @staticmethod
     def updateObjectfromParams(erddapObject: "ERDDAPHandler", params: dict) -> None:
@@ -370,7 +671,7 @@ class ERDDAPHandler:
     @staticmethod
     def return_response(generatedUrl: str):
         try:
-            response = requests.get(generatedUrl)
+            response = tp.get(generatedUrl)
             response.raise_for_status()
             return response.text
         except requests.exceptions.HTTPError as http_err:
@@ -1,13 +1,15 @@
 from . import erddap_client as ec
 from . import das_client as dc
+from . import das_fetcher as df
+from . import metadata_store as ms
 from . import ago_wrapper as aw
 from logs import updatelog as ul
-from src.utils import OverwriteFS
+from .utils import OverwriteFS
 from arcgis.gis import GIS
 
 #from utils import OverwriteFS
 
-import sys, os, datetime
+import sys, os, datetime, json
 from datetime import timedelta, datetime
 
 #This module will handle the logic for determining the level of detail in the data that is being processed
@@ -32,24 +34,70 @@ def checkDataRange(datasetid) -> bool:
     else:
         return False  
 
+#Queries the allDatasets table once for every tabledap dataset with data in the moving window
+#Returns None if the server doesn't expose allDatasets so the caller can fall back to the DAS scan
+def allDatasetsNRTFind(ERDDAPObj: ec.ERDDAPHandler, days: int = 7) -> list:
+    catalog = ERDDAPObj.getCatalog()
+    if not catalog.hasAllDatasets:
+        return None
+
+    url = (
+        f"{ERDDAPObj.server}allDatasets.json?datasetID%2CminTime%2CmaxTime"
+        f"&dataStructure=%22table%22"
+        f"&minTime%3C%3Dnow"
+        f"&maxTime%3E%3Dnow-{days}days"
+    )
+    response = ec.ERDDAPHandler.return_response(url)
+    if isinstance(response, dict) and "status_code" in response:
+        # ERDDAP answers an empty result with a 404
+        if response["status_code"] == 404 and "no matching results" in str(response["message"]):
+            return []
+        print(f"allDatasets query failed on {ERDDAPObj.server}, falling back to DAS scan.")
+        return None
+
+    try:
+        table = json.loads(response)['table']
+        id_index = table['columnNames'].index("datasetID")
+    except (ValueError, KeyError) as e:
+        print(f"Could not read allDatasets response: {e}")
+        return None
+
+    ValidDatasetIDs = [row[id_index] for row in table['rows'] if row[id_index] != "allDatasets"]
+    return ValidDatasetIDs
+
 #This function returns all datasetIDs that have data within the last 7 days
-#Maybe request a fresh json everytime?
-def batchNRTFind(ERDDAPObj: ec.ERDDAPHandler) -> list:
-    ValidDatasetIDs = []
-    DIDList = ec.ERDDAPHandler.getDatasetIDList(ERDDAPObj)
-    for datasetid in DIDList:
-        if dc.checkForJson(datasetid) == False:
-            das_resp = ec.ERDDAPHandler.getDas(ERDDAPObj, datasetid=datasetid)
-            parsed_response = dc.parseDasResponse(das_resp)
-            parsed_response = dc.convertToDict(parsed_response)
-            dc.saveToJson(parsed_response, datasetid)
-        
+def batchNRTFind(ERDDAPObj: ec.ERDDAPHandler, useAllDatasets: bool = True) -> list:
+    if useAllDatasets:
+        ValidDatasetIDs = allDatasetsNRTFind(ERDDAPObj)
+        if ValidDatasetIDs is not None:
+            print(f"Found {len(ValidDatasetIDs)} datasets with data within the last 7 days.")
+            return ValidDatasetIDs
+
+    server = ERDDAPObj.server
+    catalog = ERDDAPObj.getCatalog()
+    DIDList = catalog.getDatasetIDs()
+    window_start, window_end = movingWindow(isStr=False)
+
+    # Only the catalog delta since the last scan needs its DAS fetched, plus anything never stored.
+    # Datasets that were already in the window are revalidated once stale since their time range keeps growing.
+    changes = catalog.getChanges("das")
+    updated = set(changes["added"]) | set(changes["changed"])
+    for datasetid in changes["removed"]:
+        ms.deleteDataset(server, datasetid)
+
+    was_in_window = set(ms.findDatasetsInRange(window_start.timestamp(), window_end.timestamp(), server))
+    fetch_list = [datasetid for datasetid in DIDList
+                  if datasetid in updated
+                  or not ms.hasDataset(datasetid, server)
+                  or (datasetid in was_in_window and df.isStale(ERDDAPObj, datasetid))]
+    print(f"{len(changes['added'])} added, {len(changes['changed'])} changed, {len(changes['removed'])} removed since the last scan.")
+
+    results = df.fetchDasBatch(ERDDAPObj, fetch_list, revalidate=True)
+    catalog.markSynced("das", [result.datasetid for result in results if result.error is None] + changes["removed"])
 
-            if checkDataRange(datasetid) == True:
-                ValidDatasetIDs.append(datasetid)
-        else:
-            if checkDataRange(datasetid) == True:
-                ValidDatasetIDs.append(datasetid)
+    # One indexed query over the metadata store instead of a file read per dataset
+    in_window = set(ms.findDatasetsInRange(window_start.timestamp(), window_end.timestamp(), server))
+    ValidDatasetIDs = [datasetid for datasetid in DIDList if datasetid in in_window]
     
     print(f"Found {len(ValidDatasetIDs)} datasets with data within the last 7 days.")
     return ValidDatasetIDs
@@ -0,0 +1,239 @@
+#SQLite store for dataset metadata, replaces the per-dataset DAS JSON files.
+#One row per (server, datasetid) with indexed time range, bbox and fetch time columns,
+#the variable names in their own indexed table, and the raw DAS kept zlib compressed.
+import os, sqlite3, threading, time, zlib
+
+_connection = None
+_connection_path = None
+_lock = threading.RLock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    server TEXT NOT NULL,
+    datasetid TEXT NOT NULL,
+    time_start REAL,
+    time_end REAL,
+    min_lon REAL,
+    max_lon REAL,
+    min_lat REAL,
+    max_lat REAL,
+    fetched_at REAL NOT NULL,
+    das BLOB NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    PRIMARY KEY (server, datasetid)
+);
+CREATE INDEX IF NOT EXISTS idx_datasets_datasetid ON datasets (datasetid);
+CREATE INDEX IF NOT EXISTS idx_datasets_time ON datasets (time_start, time_end);
+CREATE INDEX IF NOT EXISTS idx_datasets_bbox ON datasets (min_lon, max_lon, min_lat, max_lat);
+CREATE INDEX IF NOT EXISTS idx_datasets_fetched ON datasets (fetched_at);
+CREATE TABLE IF NOT EXISTS variables (
+    server TEXT NOT NULL,
+    datasetid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (server, datasetid, name)
+);
+CREATE INDEX IF NOT EXISTS idx_variables_name ON variables (name);
+CREATE TABLE IF NOT EXISTS variable_counts (
+    server TEXT NOT NULL,
+    datasetid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    counted_at REAL NOT NULL,
+    PRIMARY KEY (server, datasetid, name)
+);
+"""
+
+# Columns added after the first release of the store, added to older databases on connect
+ADDED_COLUMNS = {
+    "etag": "TEXT",
+    "last_modified": "TEXT",
+    "content_hash": "TEXT"
+}
+
+def getStorePath() -> str:
+    agol_home = os.getenv('AGOL_HOME', '/arcgis/home')
+    das_conf_dir = os.path.join(agol_home, 'e2a_das_conf')
+    os.makedirs(das_conf_dir, exist_ok=True)
+    return os.path.join(das_conf_dir, 'metadata.db')
+
+# One shared connection, calls are serialized with _lock so worker threads can use it
+def getConnection() -> sqlite3.Connection:
+    global _connection, _connection_path
+    path = getStorePath()
+    with _lock:
+        if _connection is None or _connection_path != path:
+            connection = sqlite3.connect(path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            migrate(connection)
+            _connection = connection
+            _connection_path = path
+        return _connection
+
+def migrate(connection: sqlite3.Connection) -> None:
+    existing = {row[1] for row in connection.execute("PRAGMA table_info(datasets)")}
+    with connection:
+        for column, column_type in ADDED_COLUMNS.items():
+            if column not in existing:
+                connection.execute(f"ALTER TABLE datasets ADD COLUMN {column} {column_type}")
+
+def compressDas(das_text: str) -> bytes:
+    return zlib.compress(das_text.encode("utf-8"))
+
+def decompressDas(blob: bytes) -> str:
+    return zlib.decompress(blob).decode("utf-8")
+
+# time_range is (start, end) epoch seconds, bbox is (min_lon, max_lon, min_lat, max_lat), either may be None
+# etag, last_modified and content_hash are the validators used to revalidate the DAS later
+def upsertDataset(server: str, datasetid: str, das_text: str, time_range=None, bbox=None, variables: list = None,
+                  etag: str = None, last_modified: str = None, content_hash: str = None) -> None:
+    time_start, time_end = time_range if time_range else (None, None)
+    min_lon, max_lon, min_lat, max_lat = bbox if bbox else (None, None, None, None)
+    server = server or ""
+
+    with _lock:
+        connection = getConnection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO datasets "
+                "(server, datasetid, time_start, time_end, min_lon, max_lon, min_lat, max_lat, fetched_at, das, "
+                "etag, last_modified, content_hash) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (server, datasetid, time_start, time_end, min_lon, max_lon, min_lat, max_lat, time.time(),
+                 compressDas(das_text), etag, last_modified, content_hash)
+            )
+            connection.execute("DELETE FROM variables WHERE server = ? AND datasetid = ?", (server, datasetid))
+            connection.executemany(
+                "INSERT OR IGNORE INTO variables (server, datasetid, name) VALUES (?, ?, ?)",
+                [(server, datasetid, name) for name in (variables or [])]
+            )
+
+# Marks a stored DAS as still current, keeping the old validators where no new ones came back
+def touchDataset(server: str, datasetid: str, etag: str = None, last_modified: str = None) -> None:
+    with _lock:
+        connection = getConnection()
+        with connection:
+            connection.execute(
+                "UPDATE datasets SET fetched_at = ?, etag = COALESCE(?, etag), "
+                "last_modified = COALESCE(?, last_modified) WHERE server = ? AND datasetid = ?",
+                (time.time(), etag, last_modified, server or "", datasetid)
+            )
+
+def deleteDataset(server: str, datasetid: str) -> None:
+    with _lock:
+        connection = getConnection()
+        with connection:
+            connection.execute("DELETE FROM datasets WHERE server = ? AND datasetid = ?", (server or "", datasetid))
+            connection.execute("DELETE FROM variables WHERE server = ? AND datasetid = ?", (server or "", datasetid))
+            connection.execute("DELETE FROM variable_counts WHERE server = ? AND datasetid = ?", (server or "", datasetid))
+
+# Without a server the most recently fetched copy of the dataset is used
+def fetchRow(datasetid: str, columns: str, server: str = None):
+    with _lock:
+        connection = getConnection()
+        if server is None:
+            return connection.execute(
+                f"SELECT {columns} FROM datasets WHERE datasetid = ? ORDER BY fetched_at DESC LIMIT 1",
+                (datasetid,)
+            ).fetchone()
+        return connection.execute(
+            f"SELECT {columns} FROM datasets WHERE server = ? AND datasetid = ?",
+            (server, datasetid)
+        ).fetchone()
+
+def hasDataset(datasetid: str, server: str = None) -> bool:
+    return fetchRow(datasetid, "1", server) is not None
+
+def getDas(datasetid: str, server: str = None) -> str:
+    row = fetchRow(datasetid, "das", server)
+    return decompressDas(row[0]) if row else None
+
+# Returns (etag, last_modified, content_hash), all None when the dataset isn't stored
+def getValidators(datasetid: str, server: str = None) -> tuple:
+    row = fetchRow(datasetid, "etag, last_modified, content_hash", server)
+    return tuple(row) if row else (None, None, None)
+
+def getTimeRange(datasetid: str, server: str = None):
+    row = fetchRow(datasetid, "time_start, time_end", server)
+    if row is None or row[0] is None or row[1] is None:
+        return None
+    return int(row[0]), int(row[1])
+
+def getBbox(datasetid: str, server: str = None):
+    row = fetchRow(datasetid, "min_lon, max_lon, min_lat, max_lat", server)
+    return tuple(row) if row else None
+
+def getFetchedAt(datasetid: str, server: str = None) -> float:
+    row = fetchRow(datasetid, "fetched_at", server)
+    return row[0] if row else None
+
+def getVariables(datasetid: str, server: str = None) -> list:
+    with _lock:
+        connection = getConnection()
+        if server is None:
+            row = fetchRow(datasetid, "server", None)
+            if row is None:
+                return []
+            server = row[0]
+        rows = connection.execute(
+            "SELECT name FROM variables WHERE server = ? AND datasetid = ? ORDER BY name",
+            (server, datasetid)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+# Datasets whose time range overlaps [start, end], both epoch seconds
+def findDatasetsInRange(start: float, end: float, server: str = None) -> list:
+    query = "SELECT datasetid FROM datasets WHERE time_start <= ? AND time_end >= ?"
+    params = [end, start]
+    if server is not None:
+        query += " AND server = ?"
+        params.append(server)
+    with _lock:
+        rows = getConnection().execute(query, params).fetchall()
+    return [row[0] for row in rows]
+
+def findDatasetsInBbox(min_lon: float, max_lon: float, min_lat: float, max_lat: float, server: str = None) -> list:
+    query = ("SELECT datasetid FROM datasets WHERE min_lon <= ? AND max_lon >= ? "
+             "AND min_lat <= ? AND max_lat >= ?")
+    params = [max_lon, min_lon, max_lat, min_lat]
+    if server is not None:
+        query += " AND server = ?"
+        params.append(server)
+    with _lock:
+        rows = getConnection().execute(query, params).fetchall()
+    return [row[0] for row in rows]
+
+def findDatasetsWithVariable(name: str, server: str = None) -> list:
+    query = "SELECT datasetid FROM variables WHERE name = ?"
+    params = [name]
+    if server is not None:
+        query += " AND server = ?"
+        params.append(server)
+    with _lock:
+        rows = getConnection().execute(query, params).fetchall()
+    return [row[0] for row in rows]
+
+# counts is {variable: number of non-missing values}, from an orderByCount profile of the dataset
+def saveVariableCounts(server: str, datasetid: str, counts: dict) -> None:
+    counted_at = time.time()
+    with _lock:
+        connection = getConnection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO variable_counts (server, datasetid, name, count, counted_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(server or "", datasetid, name, int(count), counted_at) for name, count in counts.items()]
+            )
+
+# Counts profiled less than maxAge seconds ago, {} when the dataset hasn't been profiled
+def getVariableCounts(server: str, datasetid: str, maxAge: float = None) -> dict:
+    query = "SELECT name, count FROM variable_counts WHERE server = ? AND datasetid = ?"
+    params = [server or "", datasetid]
+    if maxAge is not None:
+        query += " AND counted_at >= ?"
+        params.append(time.time() - maxAge)
+    with _lock:
+        rows = getConnection().execute(query, params).fetchall()
+    return {name: count for name, count in rows}
@@ -0,0 +1,271 @@
+#Long running NRT updater that polls each item on its own cadence instead of one pass over everything.
+#Items wait in a heap keyed by when they are next due. A dataset is polled at a fraction of how far
+#its newest timestamp moves each time new data shows up, seeded from the DAS time_coverage_resolution,
+#and polled less often while nothing new turns up. Hourly buoys get refreshed hourly and
+#daily products are left alone in between. The schedule is saved so a restart picks up where it stopped.
+import copy, heapq, json, os, random, re, time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import core
+from . import chunked_download as cd
+from . import das_client as dc
+from . import erddap_client as ec
+from . import transport as tp
+from logs import updatelog as ul
+
+# Seconds between polls of a dataset with no resolution in its DAS and no history yet
+DEFAULT_INTERVAL = 3600
+# Bounds on the interval estimate and on the wait between two polls of one item
+MIN_INTERVAL = 300
+MAX_INTERVAL = 86400
+# Poll at this fraction of the update interval so new data is picked up within about half of it
+POLL_FRACTION = 0.5
+# Each poll in a row that finds nothing new stretches the next wait by this factor
+SLOWDOWN = 1.5
+# Weight of the newest observed step in the interval estimate
+EWMA_ALPHA = 0.3
+# +/- fraction added to every wait so items sharing a cadence don't all fire together
+JITTER = 0.1
+# Items updated at once
+MAX_PARALLEL = 4
+# Wait after a failed update, doubled for each failure in a row
+FAILURE_BACKOFF = 600
+# How often the list of NRT items is reread from AGOL and the catalog
+ITEM_REFRESH_SECONDS = 3600
+# New items are spread over this many seconds instead of all polled at startup
+STARTUP_SPREAD = 60
+
+STATE_FILE = "nrt_schedule.json"
+
+DURATION_RE = re.compile(r"^P(?:([\d.]+)Y)?(?:([\d.]+)M)?(?:([\d.]+)W)?(?:([\d.]+)D)?"
+                         r"(?:T(?:([\d.]+)H)?(?:([\d.]+)M)?(?:([\d.]+)S)?)?$", re.I)
+# Seconds per unit in DURATION_RE group order, years and months are approximate
+DURATION_UNITS = (365 * 86400, 30 * 86400, 7 * 86400, 86400, 3600, 60, 1)
+
+# ISO 8601 duration in seconds, "PT1H" -> 3600, "P1D" -> 86400. None when it can't be read.
+def parseDuration(value: str):
+    match = DURATION_RE.match(value.strip()) if value else None
+    if match is None or not any(match.groups()):
+        return None
+    try:
+        seconds = sum(float(part) * unit for part, unit in zip(match.groups(), DURATION_UNITS) if part)
+    except ValueError:
+        return None
+    return seconds or None
+
+# time_coverage_resolution from NC_Global in seconds, None when the dataset doesn't give one
+def resolutionSeconds(dasJson: dict):
+    try:
+        value = dasJson["NC_Global"]["time_coverage_resolution"]["value"]
+    except (KeyError, TypeError):
+        return None
+    return parseDuration(str(value))
+
+# Seconds the newest data time moved from before to after, None when either can't be read
+def dataStep(before, after):
+    try:
+        step = (cd.parseTime(after) - cd.parseTime(before)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+    return step if step > 0 else None
+
+def clamp(seconds: float) -> float:
+    return min(max(seconds, MIN_INTERVAL), MAX_INTERVAL)
+
+def jitter(seconds: float) -> float:
+    return seconds * random.uniform(1 - JITTER, 1 + JITTER)
+
+def describeDelay(seconds: float) -> str:
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f}h"
+    return f"{seconds / 60:.0f}min"
+
+def statePath() -> str:
+    return os.path.join(ul.makeDBdir(), STATE_FILE)
+
+# {datasetid: {"itemid", "interval", "next_due", "last_run", "last_data", "last_change", "misses", "failures"}}
+# last_data is the newest data time as logged, the other times are epoch seconds so they survive a restart
+def loadState(path: str) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"\nCould not read the NRT schedule at {path}, starting fresh: {e}")
+        return {}
+
+def saveState(path: str, state: dict) -> None:
+    temppath = path + ".tmp"
+    with open(temppath, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(temppath, path)
+
+def newEntry(datasetid: str, itemid: str, now: float) -> dict:
+    das_data = dc.openDasJson(datasetid)
+    resolution = resolutionSeconds(das_data) if das_data else None
+    return {
+        "itemid": itemid,
+        "interval": clamp(resolution or DEFAULT_INTERVAL),
+        "next_due": now + random.uniform(0, STARTUP_SPREAD),
+        "last_run": None,
+        "last_data": None,
+        "last_change": None,
+        "misses": 0,
+        "failures": 0
+    }
+
+# Newest data time the update log holds for itemid, None if the item isn't logged
+def latestData(itemid: str):
+    params = ul.updateCallFromID(itemid)
+    return params[1] if params else None
+
+
+class NRTScheduler:
+    def __init__(self, incremental: bool = True, maxFeatures: int = None, maxParallel: int = MAX_PARALLEL,
+                 path: str = None):
+        self.gcload = ec.erddapGcoos
+        self.incremental = incremental
+        self.maxFeatures = maxFeatures
+        self.maxParallel = max(maxParallel, 1)
+        self.path = path or statePath()
+        self.state = loadState(self.path)
+        # (next_due, datasetid), entries whose next_due no longer matches the state are stale
+        self.heap = []
+        # future -> datasetid
+        self.running = {}
+
+    # Rereads the NRT items, drops the ones that are gone and seeds new ones
+    def refreshItems(self) -> None:
+        now = time.time()
+        nrt_dict, skip = core.prepareNRTUpdate(self.gcload)
+        for datasetid in set(self.state) - set(nrt_dict):
+            del self.state[datasetid]
+        for datasetid, itemid in nrt_dict.items():
+            entry = self.state.get(datasetid)
+            if entry is None:
+                self.state[datasetid] = newEntry(datasetid, itemid, now)
+            else:
+                entry["itemid"] = itemid
+
+        busy = set(self.running.values())
+        # Skipped items wait for the next refresh, their DAS failed or they left the catalog
+        self.heap = [(entry["next_due"], datasetid) for datasetid, entry in self.state.items()
+                     if datasetid not in busy and datasetid not in skip]
+        heapq.heapify(self.heap)
+        saveState(self.path, self.state)
+        print(f"\nScheduling {len(self.heap)} NRT items, {len(skip)} skipped")
+
+    # Runs on a worker thread. Returns (updated, newest data before, newest data after).
+    def pollItem(self, datasetid: str, itemid: str) -> tuple:
+        before = latestData(itemid)
+        updated = core.updateNRTItem(copy.copy(self.gcload), datasetid, itemid, self.incremental, self.maxFeatures)
+        return updated, before, latestData(itemid)
+
+    # Works out the item's next poll from what the last one found. Returns the wait in seconds.
+    def reschedule(self, datasetid: str, updated: bool, before, after, now: float):
+        entry = self.state.get(datasetid)
+        if entry is None:
+            # Removed from AGOL while it was running
+            return None
+        entry["last_run"] = now
+        if not updated:
+            entry["failures"] += 1
+            delay = FAILURE_BACKOFF * 2 ** (entry["failures"] - 1)
+        else:
+            entry["failures"] = 0
+            if after and after != before:
+                # The data's own time step, the wall clock between polls would only follow the poll rate
+                step = dataStep(before or entry["last_data"], after)
+                if step is not None:
+                    entry["interval"] = clamp(EWMA_ALPHA * step + (1 - EWMA_ALPHA) * entry["interval"])
+                entry["last_change"] = now
+                entry["last_data"] = after
+                entry["misses"] = 0
+                delay = entry["interval"] * POLL_FRACTION
+            else:
+                entry["misses"] += 1
+                delay = entry["interval"] * POLL_FRACTION * SLOWDOWN ** entry["misses"]
+
+        delay = jitter(clamp(delay))
+        entry["next_due"] = now + delay
+        heapq.heappush(self.heap, (entry["next_due"], datasetid))
+        return delay
+
+    def finish(self, future) -> None:
+        datasetid = self.running.pop(future)
+        try:
+            updated, before, after = future.result()
+        except Exception as e:
+            print(f"\nNRT update of {datasetid} failed: {e}")
+            updated, before, after = False, None, None
+        delay = self.reschedule(datasetid, updated, before, after, time.time())
+        if delay is not None:
+            if not updated:
+                outcome = "failed"
+            elif after and after != before:
+                outcome = f"current to {after}"
+            else:
+                outcome = "no new data"
+            print(f"\n{datasetid}: {outcome}, next poll in {describeDelay(delay)}")
+        saveState(self.path, self.state)
+
+    # Submits every item that is due while there are free workers
+    def startDue(self, pool: ThreadPoolExecutor, now: float) -> None:
+        busy = set(self.running.values())
+        while self.heap and len(self.running) < self.maxParallel and self.heap[0][0] <= now:
+            due, datasetid = heapq.heappop(self.heap)
+            entry = self.state.get(datasetid)
+            if entry is None or entry["next_due"] != due or datasetid in busy:
+                continue
+            future = pool.submit(self.pollItem, datasetid, entry["itemid"])
+            self.running[future] = datasetid
+            busy.add(datasetid)
+
+    # Polls items as they come due until stopAfter seconds have passed, or forever. Ctrl-C stops it.
+    def run(self, stopAfter: float = None) -> None:
+        deadline = time.time() + stopAfter if stopAfter else None
+        self.refreshItems()
+        next_refresh = time.time() + ITEM_REFRESH_SECONDS
+
+        with ThreadPoolExecutor(max_workers=self.maxParallel) as pool:
+            try:
+                while deadline is None or time.time() < deadline:
+                    now = time.time()
+                    if now >= next_refresh:
+                        self.refreshItems()
+                        next_refresh = now + ITEM_REFRESH_SECONDS
+                    self.startDue(pool, now)
+
+                    # Sleep until the next item is due, the next refresh or the deadline.
+                    # With every worker busy only a finished update can free one up.
+                    wake = [next_refresh]
+                    if deadline is not None:
+                        wake.append(deadline)
+                    if self.heap and len(self.running) < self.maxParallel:
+                        wake.append(self.heap[0][0])
+                    timeout = max(min(wake) - time.time(), 0)
+
+                    if self.running:
+                        done, _ = wait(list(self.running), timeout=timeout, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self.finish(future)
+                    else:
+                        time.sleep(timeout)
+            except KeyboardInterrupt:
+                print("\nStopping the NRT scheduler, waiting for running updates to finish")
+            finally:
+                for future in wait(list(self.running)).done:
+                    self.finish(future)
+                saveState(self.path, self.state)
+        tp.printStats()
+
+    # Next poll of every item, soonest first, e.g. for checking the schedule from a notebook
+    def describe(self) -> list:
+        return sorted(((datasetid, entry["next_due"], entry["interval"]) for datasetid, entry in self.state.items()),
+                      key=lambda row: row[1])
+
+
+# Runs NRT updates on each dataset's own cadence, see NRTScheduler
+def runScheduler(incremental: bool = True, maxFeatures: int = None, maxParallel: int = MAX_PARALLEL,
+                 stopAfter: float = None) -> None:
+    NRTScheduler(incremental, maxFeatures, maxParallel).run(stopAfter)
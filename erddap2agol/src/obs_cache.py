@@ -0,0 +1,232 @@
+#Local Parquet cache of downloaded observations, one file per dataset per UTC day.
+#A publish or NRT update only asks ERDDAP for days that aren't cached or may still change,
+#then rebuilds the csv it uploads from the cached days.
+#pyarrow is optional, without it isAvailable() is False and callers download as before.
+import os, json, time, hashlib, threading, shutil
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+from . import erddap_client as ec
+from . import response_formats as rf
+from . import chunked_download as cd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# A day is refetched until it was last fetched this many days after it ended,
+# recent days are still filling in and getting QC'd on the server
+MUTABLE_DAYS = 2
+# Total size of all cached partitions before the least recently read ones are evicted
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+# Longest run of missing days fetched in one request
+MAX_FETCH_DAYS = 31
+DAY = timedelta(days=1)
+
+# One lock per dataset directory so different datasets fill their caches in parallel,
+# _lock only keeps two evictions from running at once
+_lock = threading.Lock()
+_dataset_locks = {}
+_dataset_locks_lock = threading.Lock()
+
+def isAvailable() -> bool:
+    return pyarrow is not None
+
+def getCacheRoot() -> str:
+    agol_home = os.getenv('AGOL_HOME', '/arcgis/home')
+    cache_root = os.path.join(agol_home, 'e2a_obs_cache')
+    os.makedirs(cache_root, exist_ok=True)
+    return cache_root
+
+def getDatasetDir(erddapObj: ec.ERDDAPHandler) -> str:
+    server_key = hashlib.sha1((erddapObj.server or "").encode("utf-8")).hexdigest()[:12]
+    dataset_dir = os.path.join(getCacheRoot(), server_key, erddapObj.datasetid)
+    os.makedirs(dataset_dir, exist_ok=True)
+    return dataset_dir
+
+def datasetLock(datasetDir: str) -> threading.RLock:
+    with _dataset_locks_lock:
+        return _dataset_locks.setdefault(datasetDir, threading.RLock())
+
+def getIndexPath(datasetDir: str) -> str:
+    return os.path.join(datasetDir, "index.json")
+
+def partitionPath(datasetDir: str, day) -> str:
+    return os.path.join(datasetDir, f"{day:%Y-%m-%d}.parquet")
+
+# {"columns": [...], "units": {...}, "partitions": {"2024-05-01": {"rows", "bytes", "fetched_at", "accessed_at"}}}
+def loadIndex(datasetDir: str) -> dict:
+    try:
+        with open(getIndexPath(datasetDir), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"columns": None, "units": {}, "partitions": {}}
+
+def saveIndex(datasetDir: str, index: dict) -> None:
+    path = getIndexPath(datasetDir)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=4)
+    os.replace(tmp_path, path)
+
+def dayEnd(day) -> float:
+    return datetime.combine(day + DAY, datetime.min.time(), tzinfo=timezone.utc).timestamp()
+
+def needsFetch(index: dict, day) -> bool:
+    entry = index["partitions"].get(f"{day:%Y-%m-%d}")
+    if entry is None:
+        return True
+    return entry["fetched_at"] < dayEnd(day) + MUTABLE_DAYS * 86400
+
+# Runs of consecutive days that need fetching, as (first_day, last_day) no longer than MAX_FETCH_DAYS
+def planFetch(index: dict, days: list) -> list:
+    runs = []
+    for day in days:
+        if not needsFetch(index, day):
+            continue
+        if runs and runs[-1][1] + DAY == day and (day - runs[-1][0]).days < MAX_FETCH_DAYS:
+            runs[-1] = (runs[-1][0], day)
+        else:
+            runs.append((day, day))
+    return runs
+
+# Downloads whole UTC days first_day..last_day and writes one partition per day, empty days included
+def fetchDays(erddapObj: ec.ERDDAPHandler, attrs: list, firstDay, lastDay, datasetDir: str, index: dict) -> bool:
+    start = datetime.combine(firstDay, datetime.min.time())
+    end = datetime.combine(lastDay + DAY, datetime.min.time())
+    url = erddapObj.generateChunkUrl(attrs, start, end, False)
+    tmp_path = os.path.join(datasetDir, f"fetch_{firstDay:%Y%m%d}_{lastDay:%Y%m%d}.csv")
+
+    result = ec.downloadAsCsvp(url, tmp_path, erddapObj.getFormat(), units=erddapObj.units)
+    if result is None:
+        return False
+    columns = index["columns"]
+    if result["path"] is None:
+        frame = pd.DataFrame({name: [] for name in columns})
+        frame = rf.applyDtypePlan(frame, erddapObj.dtypes)
+    else:
+        try:
+            frame = rf.readFrame(tmp_path, rf.getFormat("csvp"), dtypes=erddapObj.dtypes)
+        finally:
+            os.remove(tmp_path)
+        index["units"].update(frame.attrs.get("units", {}))
+    if not pd.api.types.is_datetime64_any_dtype(frame[erddapObj.time]):
+        rf.applyDtypePlan(frame, {erddapObj.time: "datetime64"})
+
+    fetched_at = time.time()
+    days = frame[erddapObj.time].dt.date
+    day = firstDay
+    while day <= lastDay:
+        part = frame[days == day]
+        path = partitionPath(datasetDir, day)
+        part.to_parquet(path, index=False)
+        index["partitions"][f"{day:%Y-%m-%d}"] = {"rows": len(part), "bytes": os.path.getsize(path),
+                                                  "fetched_at": fetched_at, "accessed_at": fetched_at}
+        day += DAY
+    return True
+
+# Missing values go out the way ERDDAP writes them: NaN for numbers, empty for strings
+def writeCsvRows(frame: pd.DataFrame, out) -> None:
+    frame = frame.copy()
+    for name in frame.columns:
+        if isinstance(frame[name].dtype, pd.CategoricalDtype) or frame[name].dtype == object:
+            frame[name] = frame[name].astype(object).where(frame[name].notna(), "")
+    frame.to_csv(out, header=False, index=False, na_rep="NaN", date_format='%Y-%m-%dT%H:%M:%SZ',
+                 lineterminator="\n")
+
+# Brings the cache up to date for the erddapObj time range and writes the csvp file to publish from it.
+# Returns the file path, or None when pyarrow is missing or a fetch failed so the caller can download directly.
+def buildPublishFile(erddapObj: ec.ERDDAPHandler, attrs: list, out_path: str = None) -> str:
+    if not isAvailable():
+        return None
+    start = cd.parseTime(erddapObj.start_time).replace(tzinfo=timezone.utc)
+    end = cd.parseTime(erddapObj.end_time).replace(tzinfo=timezone.utc)
+    out_path = out_path or os.path.join(ec.getTempDir(), f"{erddapObj.datasetid}.csv")
+    columns = erddapObj.orderedAttributes(attrs)
+
+    dataset_dir = getDatasetDir(erddapObj)
+    with datasetLock(dataset_dir):
+        index = loadIndex(dataset_dir)
+        # Partitions are read back by column name, only a different set of variables invalidates them
+        if sorted(index["columns"] or []) != sorted(columns):
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+            os.makedirs(dataset_dir, exist_ok=True)
+            index = {"columns": columns, "units": {}, "partitions": {}}
+
+        days = [start.date() + DAY * offset for offset in range((end.date() - start.date()).days + 1)]
+        runs = planFetch(index, days)
+        fetched = sum((last - first).days + 1 for first, last in runs)
+        print(f"\n{erddapObj.datasetid}: {len(days) - fetched} of {len(days)} days cached, fetching {fetched}")
+        for first_day, last_day in runs:
+            ok = fetchDays(erddapObj, attrs, first_day, last_day, dataset_dir, index)
+            saveIndex(dataset_dir, index)
+            if not ok:
+                return None
+
+        units = index["units"]
+        rows = 0
+        tmp_path = out_path + ".part"
+        with open(tmp_path, 'w', encoding="utf-8", newline="") as out:
+            out.write(",".join(f"{name} ({units[name]})" if units.get(name) else name for name in columns) + "\n")
+            for day in days:
+                frame = pd.read_parquet(partitionPath(dataset_dir, day))
+                times = frame[erddapObj.time]
+                frame = frame[(times >= start) & (times <= end)]
+                if len(frame):
+                    writeCsvRows(frame[columns], out)
+                    rows += len(frame)
+                index["partitions"][f"{day:%Y-%m-%d}"]["accessed_at"] = time.time()
+        os.replace(tmp_path, out_path)
+        saveIndex(dataset_dir, index)
+    # Outside the dataset lock, evict takes the locks of the datasets it trims
+    evict()
+
+    if rows == 0:
+        print(f"No cached rows for {erddapObj.datasetid} between {start:%Y-%m-%d} and {end:%Y-%m-%d}")
+        return None
+    print(f"Built {out_path} from the observation cache ({rows} rows)")
+    return out_path
+
+# Removes the least recently read partitions across all datasets until the cache fits in maxBytes.
+# Datasets that are being built right now are skipped, their partitions are the ones in use.
+def evict(maxBytes: int = MAX_CACHE_BYTES) -> int:
+    with _lock:
+        entries = []
+        for server_key in os.listdir(getCacheRoot()):
+            server_dir = os.path.join(getCacheRoot(), server_key)
+            if not os.path.isdir(server_dir):
+                continue
+            for datasetid in os.listdir(server_dir):
+                dataset_dir = os.path.join(server_dir, datasetid)
+                for day, entry in loadIndex(dataset_dir)["partitions"].items():
+                    entries.append((entry["accessed_at"], entry["bytes"], dataset_dir, day))
+
+        total = sum(entry[1] for entry in entries)
+        victims = {}
+        for accessed_at, nbytes, dataset_dir, day in sorted(entries):
+            if total <= maxBytes:
+                break
+            victims.setdefault(dataset_dir, []).append(day)
+            total -= nbytes
+
+        removed = 0
+        for dataset_dir, days in victims.items():
+            lock = datasetLock(dataset_dir)
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                index = loadIndex(dataset_dir)
+                for day in days:
+                    if day not in index["partitions"]:
+                        continue
+                    path = os.path.join(dataset_dir, f"{day}.parquet")
+                    if os.path.exists(path):
+                        os.remove(path)
+                    del index["partitions"][day]
+                    removed += 1
+                saveIndex(dataset_dir, index)
+            finally:
+                lock.release()
+        if removed:
+            print(f"Evicted {removed} cached partitions to stay under {maxBytes / 1e9:.1f} GB")
+        return removed
@@ -0,0 +1,92 @@
+#Runs a batch of items through a chain of stages, each on its own worker threads.
+#Stages are joined by bounded queues, so a fast stage blocks once it is QUEUE_SIZE items
+#ahead of the next one instead of piling up downloads, and slow network or publish waits
+#of different items overlap. A batch takes about as long as its slowest stage.
+import queue, threading, time
+from collections import namedtuple
+
+# Items allowed to wait between two stages
+QUEUE_SIZE = 2
+
+# func takes an item and returns the item for the next stage, or None to drop it
+Stage = namedtuple("Stage", ["name", "func", "workers"])
+
+_DONE = object()
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float, outcome: str) -> None:
+        with self.lock:
+            self.busy += seconds
+            if outcome == "processed":
+                self.processed += 1
+            elif outcome == "dropped":
+                self.dropped += 1
+            else:
+                self.failed += 1
+
+    def describe(self) -> str:
+        return (f"{self.name}: {self.processed} done, {self.dropped} skipped, {self.failed} failed, "
+                f"{self.busy:.1f}s busy")
+
+
+def stageWorker(stage: Stage, inbox: queue.Queue, outbox: queue.Queue, stats: StageStats, label) -> None:
+    while True:
+        item = inbox.get()
+        if item is _DONE:
+            return
+        start = time.perf_counter()
+        try:
+            result = stage.func(item)
+        except Exception as e:
+            stats.record(time.perf_counter() - start, "failed")
+            print(f"\n{stage.name} failed for {label(item)}: {e}")
+            continue
+        stats.record(time.perf_counter() - start, "dropped" if result is None else "processed")
+        if result is not None and outbox is not None:
+            outbox.put(result)
+
+# Feeds items through stages in order. label(item) names an item in error messages.
+# Returns what the last stage returned for each item that made it through, in completion order.
+def runPipeline(items: list, stages: list, queueSize: int = QUEUE_SIZE, label=str) -> list:
+    queues = [queue.Queue(maxsize=queueSize) for _ in stages]
+    results = queue.Queue()
+    stats = [StageStats(stage.name) for stage in stages]
+    start = time.perf_counter()
+
+    threads = []
+    for index, stage in enumerate(stages):
+        outbox = queues[index + 1] if index + 1 < len(stages) else results
+        workers = [threading.Thread(target=stageWorker, name=f"{stage.name}-{n}",
+                                    args=(stage, queues[index], outbox, stats[index], label), daemon=True)
+                   for n in range(max(stage.workers, 1))]
+        for worker in workers:
+            worker.start()
+        threads.append(workers)
+
+    for item in items:
+        queues[0].put(item)
+
+    # Close the stages front to back, each one only after everything upstream has drained into it
+    for index, workers in enumerate(threads):
+        for _ in workers:
+            queues[index].put(_DONE)
+        for worker in workers:
+            worker.join()
+
+    print(f"\nPipeline finished {len(items)} items in {time.perf_counter() - start:.1f}s")
+    for stage_stats in stats:
+        print(f"  {stage_stats.describe()}")
+
+    finished = []
+    while not results.empty():
+        finished.append(results.get())
+    return finished
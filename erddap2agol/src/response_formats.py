@@ -0,0 +1,187 @@
+#Readers for the ERDDAP tabledap output formats we can request.
+#Each reader streams rows out of the downloaded file, and toCsvp rewrites any of them
+#as csvp so publishing only ever deals with one layout.
+import csv, json, os
+from collections import namedtuple
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+# layout is how the column names arrive:
+#   "inline"  one header row of "name (units)"
+#   "tworow"  a row of names then a row of units
+#   "none"    no header, the requested variables give the names
+#   "jsonl1"  a JSON array of names, then one JSON array per row
+#   "jsonl"   one JSON array per row, no names
+#   "nc"      a netCDF file with one variable per column along a "row" dimension
+ResponseFormat = namedtuple("ResponseFormat", ["name", "layout", "delimiter", "headerRows", "binary"])
+
+FORMATS = {
+    "csvp": ResponseFormat("csvp", "inline", ",", 1, False),
+    "csv": ResponseFormat("csv", "tworow", ",", 2, False),
+    "csv0": ResponseFormat("csv0", "none", ",", 0, False),
+    "tsvp": ResponseFormat("tsvp", "inline", "\t", 1, False),
+    "tsv": ResponseFormat("tsv", "tworow", "\t", 2, False),
+    "tsv0": ResponseFormat("tsv0", "none", "\t", 0, False),
+    "jsonlCSV1": ResponseFormat("jsonlCSV1", "jsonl1", None, 1, False),
+    "jsonlCSV": ResponseFormat("jsonlCSV", "jsonl", None, 0, False),
+    "nc": ResponseFormat("nc", "nc", None, 0, True),
+}
+
+DEFAULT_FORMAT = "csvp"
+# Rows pulled from a netCDF variable per read
+NC_BLOCK_ROWS = 50000
+
+def getFormat(name: str = None) -> ResponseFormat:
+    fmt = FORMATS.get(name or DEFAULT_FORMAT)
+    if fmt is None:
+        raise ValueError(f"Unsupported response format: {name}. Supported: {', '.join(FORMATS)}")
+    if fmt.layout == "nc" and netCDF4 is None:
+        raise ValueError("The nc format needs the netCDF4 package, install it or choose a text format.")
+    return fmt
+
+# "temp (degree_C)" -> ("temp", "degree_C"), "temp" -> ("temp", None)
+def splitUnits(column: str) -> tuple:
+    column = column.strip().strip('"')
+    if column.endswith(")") and " (" in column:
+        name, units = column.split(" (", 1)
+        return name, units[:-1]
+    return column, None
+
+# Column names from the first line of a response, None for layouts without a names line
+def headerNames(fmt: ResponseFormat, line: str) -> list:
+    if fmt.layout in ("inline", "tworow"):
+        return [splitUnits(column)[0] for column in next(csv.reader([line], delimiter=fmt.delimiter))]
+    if fmt.layout == "jsonl1":
+        return json.loads(line)
+    return None
+
+def ncTimeToIso(value) -> str:
+    return datetime.fromtimestamp(float(value), tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def isEpochTime(units: str) -> bool:
+    return bool(units) and units.startswith("seconds since 1970-01-01")
+
+def readHeader(path: str, fmt: ResponseFormat, columns: list = None) -> tuple:
+    if fmt.layout == "nc":
+        with netCDF4.Dataset(path) as nc:
+            names = [name for name, var in nc.variables.items() if var.dimensions[:1] == ("row",)]
+            units = [getattr(nc.variables[name], "units", None) for name in names]
+        return names, units
+    if fmt.layout in ("none", "jsonl"):
+        return list(columns or []), [None] * len(columns or [])
+    with open(path, 'r', encoding="utf-8", newline="") as f:
+        if fmt.layout == "jsonl1":
+            names = json.loads(f.readline())
+            return names, [None] * len(names)
+        reader = csv.reader(f, delimiter=fmt.delimiter)
+        first = next(reader, [])
+        if fmt.layout == "inline":
+            pairs = [splitUnits(column) for column in first]
+            return [name for name, _ in pairs], [units for _, units in pairs]
+        units = next(reader, [None] * len(first))
+        return first, [unit or None for unit in units]
+
+def iterNcRows(path: str, names: list, units: list):
+    with netCDF4.Dataset(path) as nc:
+        nrows = len(nc.dimensions["row"])
+        for block_start in range(0, nrows, NC_BLOCK_ROWS):
+            block = slice(block_start, min(block_start + NC_BLOCK_ROWS, nrows))
+            columns = []
+            for name, unit in zip(names, units):
+                values = nc.variables[name][block]
+                if values.dtype.kind == "S":
+                    values = netCDF4.chartostring(values)
+                mask = np.ma.getmaskarray(values)
+                data = np.ma.getdata(values).tolist()
+                if isEpochTime(unit):
+                    data = [ncTimeToIso(value) for value in data]
+                columns.append(["" if missing else value for value, missing in zip(data, mask)])
+            yield from zip(*columns)
+
+# Returns (names, units, rows) where rows is a generator of per-row lists read lazily from the file.
+# columns names the variables for layouts that don't carry their own header.
+def openRows(path: str, fmt: ResponseFormat, columns: list = None) -> tuple:
+    names, units = readHeader(path, fmt, columns)
+
+    def textRows():
+        with open(path, 'r', encoding="utf-8", newline="") as f:
+            if fmt.layout in ("jsonl", "jsonl1"):
+                for index, line in enumerate(f):
+                    if index < fmt.headerRows or not line.strip():
+                        continue
+                    yield json.loads(line)
+            else:
+                reader = csv.reader(f, delimiter=fmt.delimiter)
+                for index, row in enumerate(reader):
+                    if index < fmt.headerRows or not row:
+                        continue
+                    yield row
+
+    if fmt.layout == "nc":
+        return names, units, iterNcRows(path, names, units)
+    return names, units, textRows()
+
+# Rewrites a response in any supported format as csvp, returns the number of data rows.
+# units ({name: units}, see das_client.getUnits) fills in the units a headerless layout doesn't carry,
+# so the header reads "latitude (degrees_north)" the same as a csvp download.
+def toCsvp(path: str, fmt: ResponseFormat, out_path: str, columns: list = None, units: dict = None) -> int:
+    names, file_units, rows = openRows(path, fmt, columns)
+    units = dict(units or {})
+    # netCDF times are written out as ISO 8601, which csvp labels UTC
+    units.update({name: "UTC" if isEpochTime(unit) else unit for name, unit in zip(names, file_units) if unit})
+    units = [units.get(name) for name in names]
+    count = 0
+    tmp_path = out_path + ".part"
+    with open(tmp_path, 'w', encoding="utf-8", newline="") as out:
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow([f"{name} ({unit})" if unit else name for name, unit in zip(names, units)])
+        for row in rows:
+            writer.writerow(["" if value is None else value for value in row])
+            count += 1
+    os.replace(tmp_path, out_path)
+    return count
+
+# Casts columns of a loaded frame to a dtype plan (see das_client.getDtypePlan)
+def applyDtypePlan(frame: pd.DataFrame, dtypes: dict) -> pd.DataFrame:
+    for name, dtype in (dtypes or {}).items():
+        if name not in frame.columns:
+            continue
+        try:
+            if dtype == "datetime64":
+                frame[name] = pd.to_datetime(frame[name], format="ISO8601", utc=True, errors="coerce")
+            else:
+                frame[name] = frame[name].astype(dtype)
+        except (ValueError, TypeError) as e:
+            print(f"Keeping {name} as {frame[name].dtype}, could not cast to {dtype}: {e}")
+    return frame
+
+# Loads a response into a DataFrame with plain variable names as columns.
+# dtypes is applied while reading, the units row or "(units)" suffixes end up in frame.attrs["units"].
+def readFrame(path: str, fmt: ResponseFormat, columns: list = None, dtypes: dict = None) -> pd.DataFrame:
+    names, units = readHeader(path, fmt, columns)
+    dtypes = dtypes or {}
+
+    if fmt.layout in ("inline", "tworow", "none"):
+        read_types = {name: dtypes[name] for name in names if dtypes.get(name) not in (None, "datetime64")}
+        times = [name for name in names if dtypes.get(name) == "datetime64"]
+        try:
+            frame = pd.read_csv(path, sep=fmt.delimiter, header=None, skiprows=fmt.headerRows,
+                                names=names, dtype=read_types, low_memory=False)
+        except (ValueError, TypeError) as e:
+            # A value that doesn't fit the DAS type, fall back to inferred types for this file
+            print(f"Could not apply the dtype plan to {path}: {e}")
+            frame = pd.read_csv(path, sep=fmt.delimiter, header=None, skiprows=fmt.headerRows,
+                                names=names, low_memory=False)
+        applyDtypePlan(frame, {name: "datetime64" for name in times})
+    else:
+        _, _, rows = openRows(path, fmt, columns)
+        frame = applyDtypePlan(pd.DataFrame(list(rows), columns=names or None), dtypes)
+
+    frame.attrs["units"] = {name: unit for name, unit in zip(names, units) if unit}
+    return frame
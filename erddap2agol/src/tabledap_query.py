@@ -0,0 +1,158 @@
+#Structured tabledap request: variables, constraints and server side functions.
+#Builds the same percent encoded urls generate_url always produced and parses them back,
+#so logged urls can be edited constraint by constraint instead of by string prefix.
+import copy, re
+from datetime import datetime
+from urllib.parse import quote, unquote
+
+OPERATORS = ("!=", "=~", "<=", ">=", "=", "<", ">")
+# Characters left as is in constraint values, matches the time values in existing urls
+VALUE_SAFE = ":-._"
+
+CONSTRAINT_RE = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)(!=|=~|<=|>=|=|<|>)(.*)$", re.S)
+FUNCTION_RE = re.compile(r"^([A-Za-z]+)\((.*)\)$", re.S)
+
+
+# A constraint value that is sent quoted, e.g. station="42001" or a =~ regex
+class QuotedValue(str):
+    pass
+
+
+def formatValue(value) -> str:
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+def encodeValue(value) -> str:
+    if isinstance(value, QuotedValue):
+        return "%22" + quote(str(value), safe="") + "%22"
+    return quote(formatValue(value), safe=VALUE_SAFE)
+
+# text is already percent decoded
+def decodeValue(text: str):
+    if len(text) >= 2 and text[0] == '"' and text[-1] == '"':
+        return QuotedValue(text[1:-1])
+    return text
+
+
+class TabledapQuery:
+    def __init__(self, server: str, datasetid: str, fileType: str = "csvp", variables: list = None):
+        self.server = server
+        self.datasetid = datasetid
+        self.fileType = fileType
+        self.variables = list(variables or [])
+        # [(variable, operator, value)] in url order
+        self.constraints = []
+        # [(name, argument)] e.g. ("orderBy", "time"), ("distinct", None), ("orderByCount", "")
+        self.functions = []
+
+    def copy(self) -> "TabledapQuery":
+        return copy.deepcopy(self)
+
+    def select(self, *variables) -> "TabledapQuery":
+        self.variables.extend(variables)
+        return self
+
+    # String values for = and != are quoted for you, pass QuotedValue to force it elsewhere
+    def where(self, variable: str, operator: str, value) -> "TabledapQuery":
+        if operator not in OPERATORS:
+            raise ValueError(f"Unsupported tabledap operator: {operator}")
+        if operator in ("=", "!=", "=~") and isinstance(value, str) and not isinstance(value, QuotedValue):
+            value = QuotedValue(value)
+        self.constraints.append((variable, operator, value))
+        return self
+
+    # Replaces the first constraint on variable with this operator, or adds it
+    def setConstraint(self, variable: str, operator: str, value) -> "TabledapQuery":
+        for index, (name, op, _) in enumerate(self.constraints):
+            if name == variable and op == operator:
+                self.constraints[index] = (variable, operator, value)
+                return self
+        self.constraints.append((variable, operator, value))
+        return self
+
+    def removeConstraints(self, variable: str) -> "TabledapQuery":
+        self.constraints = [constraint for constraint in self.constraints if constraint[0] != variable]
+        return self
+
+    def getConstraint(self, variable: str, operator: str):
+        for name, op, value in self.constraints:
+            if name == variable and op == operator:
+                return value
+        return None
+
+    def timeRange(self, timeVar: str, start, end, inclusiveEnd: bool = True) -> "TabledapQuery":
+        self.where(timeVar, ">=", start)
+        return self.where(timeVar, "<=" if inclusiveEnd else "<", end)
+
+    def bbox(self, minLon: float, maxLon: float, minLat: float, maxLat: float,
+             lonVar: str = "longitude", latVar: str = "latitude") -> "TabledapQuery":
+        return (self.where(lonVar, ">=", minLon).where(lonVar, "<=", maxLon)
+                .where(latVar, ">=", minLat).where(latVar, "<=", maxLat))
+
+    # argument None renders as name(), "" as name("")
+    def addFunction(self, name: str, argument: str = None) -> "TabledapQuery":
+        self.functions.append((name, argument))
+        return self
+
+    def distinct(self) -> "TabledapQuery":
+        return self.addFunction("distinct")
+
+    def orderBy(self, *variables) -> "TabledapQuery":
+        return self.addFunction("orderBy", ",".join(variables))
+
+    def orderByMax(self, *variables) -> "TabledapQuery":
+        return self.addFunction("orderByMax", ",".join(variables))
+
+    def orderByMin(self, *variables) -> "TabledapQuery":
+        return self.addFunction("orderByMin", ",".join(variables))
+
+    # With no variables ERDDAP returns one row with the number of non-missing values of each variable
+    def orderByCount(self, *variables) -> "TabledapQuery":
+        return self.addFunction("orderByCount", ",".join(variables))
+
+    # The last variable may carry an interval, e.g. orderByClosest("station", "time/1hour")
+    def orderByClosest(self, *variables) -> "TabledapQuery":
+        return self.addFunction("orderByClosest", ",".join(variables))
+
+    def orderByMean(self, *variables) -> "TabledapQuery":
+        return self.addFunction("orderByMean", ",".join(variables))
+
+    def orderByLimit(self, *variables, limit: int) -> "TabledapQuery":
+        return self.addFunction("orderByLimit", ",".join(list(variables) + [str(limit)]))
+
+    def toUrl(self) -> str:
+        parts = ["%2C".join(quote(variable, safe="") for variable in self.variables)]
+        for variable, operator, value in self.constraints:
+            parts.append(f"{variable}{quote(operator, safe='')}{encodeValue(value)}")
+        for name, argument in self.functions:
+            parts.append(f"{name}()" if argument is None else f"{name}(%22{quote(argument, safe='/')}%22)")
+        return f"{self.server}{self.datasetid}.{self.fileType}?" + "&".join(parts)
+
+    # Parses a tabledap url, e.g. one logged by updateLog, back into a query
+    @classmethod
+    def fromUrl(cls, url: str) -> "TabledapQuery":
+        base, _, query_string = url.partition("?")
+        server, _, filename = base.rpartition("/")
+        datasetid, _, fileType = filename.rpartition(".")
+        query = cls(server + "/", datasetid, fileType)
+
+        parts = query_string.split("&") if query_string else []
+        if parts and not FUNCTION_RE.match(unquote(parts[0])) and not CONSTRAINT_RE.match(unquote(parts[0])):
+            query.variables = [name for name in unquote(parts[0]).split(",") if name]
+            parts = parts[1:]
+        for part in parts:
+            decoded = unquote(part)
+            function = FUNCTION_RE.match(decoded)
+            if function:
+                argument = function.group(2)
+                query.functions.append((function.group(1), argument.strip('"') if argument else None))
+                continue
+            constraint = CONSTRAINT_RE.match(decoded)
+            if constraint is None:
+                raise ValueError(f"Can't parse tabledap query part: {decoded}")
+            variable, operator, value = constraint.groups()
+            query.constraints.append((variable, operator, decodeValue(value)))
+        return query
@@ -0,0 +1,302 @@
+#Shared HTTP transport for every ERDDAP and download request.
+#One requests.Session keeps keep-alive pools per host so catalog, DAS and data
+#calls reuse TLS connections instead of handshaking on every request.
+#Every request also goes through the host's limiter: a token bucket for requests/second,
+#a cap on requests in flight, and a pause after 429/503 (Retry-After) or other 5xx answers.
+import threading, time, weakref, requests
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+# gzip and deflate always, plus br/zstd when urllib3 finds brotli or zstandard installed.
+# Responses are decoded by urllib3 chunk by chunk as they stream, never held whole.
+try:
+    from urllib3.util.request import ACCEPT_ENCODING
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# (connect, read) timeout in seconds, read is the wait between bytes
+DEFAULT_TIMEOUT = (10, 300)
+# Number of hosts we keep a pool for, and keep-alive connections per host
+POOL_HOSTS = 16
+POOL_PER_HOST = 8
+USER_AGENT = "erddap2agol"
+
+# Per host defaults, change one host with configureHost
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 10
+DEFAULT_CONCURRENCY = 4
+# "Slow down" answers, retried here after the host's pause
+THROTTLE_STATUS = {429, 503}
+THROTTLE_RETRIES = 3
+# Seconds a host is paused after a 5xx without Retry-After, doubled for each one in a row
+BACKOFF_BASE = 1.0
+MAX_BACKOFF = 120.0
+# Longest Retry-After we honour, a server asking for more gets the request failed instead
+MAX_RETRY_AFTER = 600.0
+# Longest wait for a free slot on a host before the request fails with SlotTimeout
+SLOT_TIMEOUT = 1800.0
+
+_session = None
+_session_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def getSession() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_PER_HOST)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({
+                "Accept-Encoding": ACCEPT_ENCODING,
+                "User-Agent": USER_AGENT
+            })
+            _session = session
+        return _session
+
+
+class SlotTimeout(requests.exceptions.Timeout):
+    pass
+
+
+class HostLimiter:
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST, concurrency: int = DEFAULT_CONCURRENCY):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.active = 0
+        self.paused_until = 0.0
+        self.failures = 0
+        self.condition = threading.Condition()
+
+    def configure(self, rate: float = None, burst: int = None, concurrency: int = None) -> None:
+        with self.condition:
+            if rate is not None:
+                self.rate = rate
+            if burst is not None:
+                self.burst = burst
+                self.tokens = min(self.tokens, float(burst))
+            if concurrency is not None:
+                self.concurrency = concurrency
+            self.condition.notify_all()
+
+    def refill(self, now: float) -> None:
+        if self.rate:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Blocks until the host has a free slot, a token and isn't paused. Returns the seconds waited.
+    # Raises SlotTimeout after timeout seconds without a free slot, pauses and tokens don't count.
+    def acquire(self, timeout: float = SLOT_TIMEOUT) -> float:
+        start = time.monotonic()
+        slot_wait = 0.0
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                delay = None
+                if self.active < self.concurrency:
+                    delay = self.paused_until - now
+                    if self.rate and self.tokens < 1:
+                        delay = max(delay, (1 - self.tokens) / self.rate)
+                    if delay <= 0:
+                        if self.rate:
+                            self.tokens -= 1
+                        self.active += 1
+                        return time.monotonic() - start
+                    self.condition.wait(delay)
+                    continue
+                if timeout is not None and slot_wait >= timeout:
+                    raise SlotTimeout(f"No free slot after {slot_wait:.0f}s, {self.active} requests still hold one")
+                self.condition.wait(None if timeout is None else timeout - slot_wait)
+                slot_wait += time.monotonic() - now
+
+    def release(self) -> None:
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    # Pauses the host after throttling or a server error, clears the backoff after anything else.
+    # Returns the pause the server asked for in seconds, 0 when there is none.
+    def observe(self, response: requests.Response) -> float:
+        status = response.status_code
+        with self.condition:
+            if status < 500 and status != 429:
+                self.failures = 0
+                return 0.0
+            pause = retryAfter(response) if status in THROTTLE_STATUS else None
+            if pause is None:
+                pause = min(BACKOFF_BASE * (2 ** self.failures), MAX_BACKOFF)
+            self.failures += 1
+            # A longer Retry-After fails the request, the host itself is only held for MAX_RETRY_AFTER
+            self.paused_until = max(self.paused_until, time.monotonic() + min(pause, MAX_RETRY_AFTER))
+            return pause
+
+
+# Retry-After as seconds, given either as a number or an HTTP date. None when absent or unreadable.
+def retryAfter(response: requests.Response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def getLimiter(url: str) -> HostLimiter:
+    host = urlparse(url).netloc
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = HostLimiter()
+            _limiters[host] = limiter
+        return limiter
+
+# rate is requests/second (0 for no limit), burst the requests allowed back to back,
+# concurrency the requests in flight at once. host may be a hostname or any url on it.
+def configureHost(host: str, rate: float = None, burst: int = None, concurrency: int = None) -> None:
+    url = host if "//" in host else f"//{host}"
+    getLimiter(url).configure(rate, burst, concurrency)
+
+def hostStats(url: str) -> dict:
+    return _stats.setdefault(urlparse(url).netloc,
+                             {"requests": 0, "errors": 0, "statuses": {}, "wire_bytes": 0, "bytes": 0,
+                              "throttled": 0, "retries": 0, "waited": 0.0})
+
+def countRequest(url: str, status_code) -> None:
+    with _stats_lock:
+        host_stats = hostStats(url)
+        host_stats["requests"] += 1
+        if status_code is None or status_code >= 400:
+            host_stats["errors"] += 1
+        if status_code in THROTTLE_STATUS:
+            host_stats["throttled"] += 1
+        key = str(status_code)
+        host_stats["statuses"][key] = host_stats["statuses"].get(key, 0) + 1
+
+def countWait(url: str, waited: float, retried: bool = False) -> None:
+    with _stats_lock:
+        host_stats = hostStats(url)
+        host_stats["waited"] += waited
+        if retried:
+            host_stats["retries"] += 1
+
+# A streamed response keeps its host slot until it is closed or read to the end by iterContent.
+# One that is dropped without either gives the slot back when it is garbage collected.
+def holdSlot(response: requests.Response, limiter: HostLimiter) -> None:
+    # Only a weak reference in the new close, so dropping the response really frees it
+    close = type(response).close
+    owner = weakref.ref(response)
+    lock = threading.Lock()
+    released = []
+
+    def release():
+        with lock:
+            if released:
+                return
+            released.append(True)
+        limiter.release()
+
+    def closeAndRelease():
+        try:
+            if owner() is not None:
+                close(owner())
+        finally:
+            release()
+
+    response.close = closeAndRelease
+    weakref.finalize(response, release)
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    limiter = getLimiter(url)
+
+    for attempt in range(THROTTLE_RETRIES + 1):
+        countWait(url, limiter.acquire(), attempt > 0)
+        try:
+            response = getSession().request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            limiter.release()
+            countRequest(url, None)
+            raise
+        countRequest(url, response.status_code)
+        pause = limiter.observe(response)
+        if response.status_code in THROTTLE_STATUS and attempt < THROTTLE_RETRIES and pause <= MAX_RETRY_AFTER:
+            # The next acquire waits out the pause the host just asked for
+            response.close()
+            limiter.release()
+            continue
+        break
+
+    if kwargs.get("stream"):
+        holdSlot(response, limiter)
+    else:
+        countBytes(url, wireBytes(response), len(response.content))
+        limiter.release()
+    return response
+
+# Bytes read off the socket so far, before decompression. None if the response doesn't say.
+def wireBytes(response: requests.Response):
+    try:
+        return response.raw.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+def countBytes(url: str, wire: int, decoded: int) -> None:
+    with _stats_lock:
+        host_stats = hostStats(url)
+        host_stats["bytes"] += decoded or 0
+        host_stats["wire_bytes"] += wire if wire is not None else decoded or 0
+
+# Decompressed chunks of a streamed response, the transfer is counted once the stream ends
+def iterContent(response: requests.Response, chunk_size: int):
+    decoded = 0
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            decoded += len(chunk)
+            yield chunk
+    finally:
+        countBytes(response.url, wireBytes(response), decoded)
+        response.close()
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+def head(url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("allow_redirects", True)
+    return request("HEAD", url, **kwargs)
+
+# Per-host request counters, e.g. {"erddap.gcoos.org": {"requests": 12, "errors": 0, ...}}
+def getStats() -> dict:
+    with _stats_lock:
+        return {host: dict(s, statuses=dict(s["statuses"])) for host, s in _stats.items()}
+
+def resetStats() -> None:
+    with _stats_lock:
+        _stats.clear()
+
+def printStats() -> None:
+    for host, host_stats in getStats().items():
+        line = f"{host}: {host_stats['requests']} requests, {host_stats['errors']} errors"
+        if host_stats["throttled"] or host_stats["retries"]:
+            line += f", {host_stats['throttled']} throttled, {host_stats['retries']} retried"
+        if host_stats["waited"] >= 1:
+            line += f", {host_stats['waited']:.0f}s waiting on the rate limit"
+        if host_stats["bytes"]:
+            line += (f", {host_stats['wire_bytes'] / 1e6:.1f} MB transferred for {host_stats['bytes'] / 1e6:.1f} MB of data"
+                     f" ({formatRatio(host_stats['wire_bytes'], host_stats['bytes'])})")
+        print(line)
+
+def formatRatio(wire: int, decoded: int) -> str:
+    return f"{decoded / wire:.1f}x compression" if wire else "no transfer"
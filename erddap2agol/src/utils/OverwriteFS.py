@@ -79,6 +79,12 @@ import os, sys, datetime, tempfile, json, time, traceback, platform
 import urllib.request, urllib.parse, shutil, filecmp, zlib
 import base64, collections
 
+# Use erddap2agol's pooled transport when imported as part of the package
+try:
+    from .. import transport
+except ImportError:
+    transport = None
+
 if not __name__ == "__main__":
     # Make sure arcgis module is loaded if importing
     import arcgis
@@ -2141,25 +2147,34 @@ Or
                 # Set lastModified to file lastModified if Service details are not available!
                 lastModified = serviceLastModified if serviceLastModified else fileLastModified
 
+                request = None
                 try:
-                    authHandlers = []
-
-                    # Add Hander(s)
-                    authHandlers.append( urllib.request.HTTPSHandler( context=urllib.request.ssl.SSLContext( urllib.request.ssl.PROTOCOL_SSLv23)))
-
-                    # Install Handler(s)
                     if not verbose == False:
                         print( "\nAccessing URL...")
-                    urllib.request.install_opener( urllib.request.build_opener( * authHandlers))
 
                     headers = {
                         "Accept": "*/*",
-                        "Accept-Encoding": "*",
+                        "Accept-Encoding": "gzip, deflate",
                         "User-Agent": "Python/v{} OverwriteFS.py/{}".format( platform.python_version(), version)
                     }
 
-                    request = urllib.request.urlopen( urllib.request.Request( updateFile, headers=headers))
-                    headers = dict( request.info()._headers) if hasattr( request, "info") else {}   # Get Header 'Tuple' list and convert to dictionary
+                    if transport:
+                        # Pooled session negotiates its own encodings and decodes them while streaming
+                        del headers[ "Accept-Encoding"]
+                        request = transport.get( updateFile, headers=headers, stream=True)
+                        request.raise_for_status()
+                        headers = dict( request.headers)
+                    else:
+                        authHandlers = []
+
+                        # Add Hander(s)
+                        authHandlers.append( urllib.request.HTTPSHandler( context=urllib.request.ssl.SSLContext( urllib.request.ssl.PROTOCOL_SSLv23)))
+
+                        # Install Handler(s)
+                        urllib.request.install_opener( urllib.request.build_opener( * authHandlers))
+
+                        request = urllib.request.urlopen( urllib.request.Request( updateFile, headers=headers))
+                        headers = dict( request.info()._headers) if hasattr( request, "info") else {}   # Get Header 'Tuple' list and convert to dictionary
 
                     # Adjust Headers
                     for key, value in headers.copy().items():
@@ -2211,10 +2226,23 @@ Or
                         print( "\nDownloading Data...")
 
                     with open( outputFile, "wb") as oFP:
-                        buffer = request.read()
-                        while buffer:
-                            oFP.write( buffer)
-                            buffer = request.read()
+                        if transport:
+                            for buffer in transport.iterContent( request, 1024 * 1024):
+                                oFP.write( buffer)
+                        else:
+                            # urllib hands back the body as sent, inflate gzip/deflate as it streams in
+                            encoding = { key.lower(): value for key, value in headers.items()}.get( "content-encoding", "").lower()
+                            decompressor = zlib.decompressobj( zlib.MAX_WBITS | 32) if encoding in ["gzip", "x-gzip", "deflate"] else None
+                            wireBytes = 0
+                            buffer = request.read( 1024 * 1024)
+                            while buffer:
+                                wireBytes += len( buffer)
+                                oFP.write( decompressor.decompress( buffer) if decompressor else buffer)
+                                buffer = request.read( 1024 * 1024)
+                            if decompressor:
+                                oFP.write( decompressor.flush())
+                            if verbose:
+                                print( " - Transferred: {:,} bytes{}".format( wireBytes, " ({} encoded)".format( encoding) if decompressor else ""))
 
                         updateFile = outputFile
 
@@ -2228,6 +2256,11 @@ Or
 
                     return outcome
 
+                finally:
+                    # Error and 'No Change' exits leave the body unread, close it so the host's slot is freed
+                    if request is not None:
+                        request.close()
+
             elif os.path.isdir( updateFile):
                 updateFile = os.path.join( updateFile, outputFile)
 
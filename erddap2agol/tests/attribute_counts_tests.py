@@ -0,0 +1,75 @@
+import unittest
+import sys
+import os
+import io
+import copy
+from contextlib import redirect_stdout
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import erddap_client as ec
+from src import metadata_store as ms
+from tests.fixtures import AgolHomeTestCase
+
+ATTRIBUTES = ["sea_water_temperature", "salinity", "wind_speed"]
+COUNT_RESPONSE = ("sea_water_temperature (count),salinity (count),wind_speed (count)\n"
+                  "120,0,45\n")
+SAMPLE_RESPONSE = ("longitude (degrees_east),latitude (degrees_north),sea_water_temperature (degree_C),"
+                   "salinity (PSU),wind_speed (m s-1),time (UTC)\n"
+                   "-88.0,28.0,25.5,,NaN,2024-05-01T00:00:00Z\n"
+                   "-88.0,28.0,25.6,,3.2,2024-05-01T01:00:00Z\n")
+
+class TestAttributeRequest(AgolHomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.handler = copy.copy(ec.erddapGcoos)
+        self.handler.datasetid = "gcoos_42001"
+        self.handler.fileType = "csvp"
+        self.handler.start_time = "2024-05-01T00:00:00"
+        self.handler.end_time = "2024-06-01T00:00:00"
+        self.responses = {"orderByCount": COUNT_RESPONSE, "sample": SAMPLE_RESPONSE}
+        self.urls = []
+
+    def fakeStream(self, url, file_path, validate=True, expected_columns=None, fmt=None, failure=None):
+        self.urls.append(url)
+        body = self.responses["orderByCount" if "orderByCount" in url else "sample"]
+        if body is None:
+            return None
+        with open(file_path, 'w') as f:
+            f.write(body)
+        return {"path": file_path, "bytes": len(body), "rows": None, "header": None, "wire_bytes": len(body)}
+
+    def request(self) -> list:
+        with mock.patch.object(ec, "streamToFile", self.fakeStream), redirect_stdout(io.StringIO()):
+            return self.handler.attributeRequest(ATTRIBUTES)
+
+    def test_counted_attributes_are_kept_and_cached(self):
+        self.assertEqual(self.request(), ["sea_water_temperature", "wind_speed"])
+        self.assertEqual(len(self.urls), 1)
+        self.assertEqual(ms.getVariableCounts(self.handler.server, "gcoos_42001"),
+                         {"sea_water_temperature": 120, "salinity": 0, "wind_speed": 45})
+
+        self.urls = []
+        self.assertEqual(self.request(), ["sea_water_temperature", "wind_speed"])
+        self.assertEqual(self.urls, [])
+
+    def test_sample_only_drops_nothing(self):
+        self.responses["orderByCount"] = None
+        # salinity has no values in the sample, it may still have some later in the dataset
+        self.assertEqual(self.request(), ATTRIBUTES)
+        self.assertEqual(len(self.urls), 2)
+        self.assertIn("time%3C%3D2024-05-08T00:00:00Z", self.urls[1])
+        self.assertEqual(ms.getVariableCounts(self.handler.server, "gcoos_42001"), {})
+
+    def test_sample_counts_values(self):
+        with mock.patch.object(ec, "streamToFile", self.fakeStream), redirect_stdout(io.StringIO()):
+            counts = self.handler.sampleAttributes(ATTRIBUTES)
+        self.assertEqual(counts, {"sea_water_temperature": 2, "wind_speed": 1})
+
+    def test_no_profile_keeps_everything(self):
+        self.responses = {"orderByCount": None, "sample": None}
+        self.assertEqual(self.request(), ATTRIBUTES)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import sys
+import os
+import io
+from contextlib import redirect_stdout
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import catalog_cache as cc
+from tests.fixtures import AgolHomeTestCase
+
+SERVER_INFO = "https://erddap.gcoos.org/erddap/info/index.json?itemsPerPage=100000"
+COLUMNS = ["griddap", "tabledap", "Title", "Dataset ID"]
+
+def catalogRow(datasetid: str, title: str = None) -> list:
+    return ["", f"https://erddap.gcoos.org/erddap/tabledap/{datasetid}", title or datasetid, datasetid]
+
+class FakeResponse:
+    def __init__(self, status_code: int, rows: list = None, etag: str = None):
+        self.status_code = status_code
+        self.rows = rows
+        self.headers = {"ETag": etag} if etag else {}
+
+    def json(self):
+        return {"table": {"columnNames": COLUMNS, "rows": self.rows}}
+
+    def raise_for_status(self):
+        pass
+
+class TestCatalogCache(AgolHomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.responses = []
+        self.requests = []
+
+    def fakeGet(self, url, headers=None, **kwargs):
+        self.requests.append(dict(headers or {}))
+        return self.responses.pop(0)
+
+    def refresh(self, catalog, *responses):
+        self.responses.extend(responses)
+        with mock.patch.object(cc.tp, "get", self.fakeGet), redirect_stdout(io.StringIO()):
+            return catalog.refresh(force=True)
+
+    def test_changes_since_last_sync(self):
+        catalog = cc.CatalogCache(SERVER_INFO)
+        self.refresh(catalog, FakeResponse(200, [catalogRow("a"), catalogRow("b"), catalogRow("allDatasets")], "v1"))
+        self.assertEqual(catalog.getChanges("agol"), {"added": ["a", "b"], "removed": [], "changed": []})
+        self.assertTrue(catalog.hasAllDatasets)
+
+        catalog.markSynced("agol")
+        self.assertEqual(catalog.getChanges("agol"), {"added": [], "removed": [], "changed": []})
+
+        self.refresh(catalog, FakeResponse(200, [catalogRow("b", "new title"), catalogRow("c")], "v2"))
+        self.assertEqual(catalog.getChanges("agol"), {"added": ["c"], "removed": ["a"], "changed": ["b"]})
+        # Each consumer keeps its own baseline
+        self.assertEqual(catalog.getChanges("das")["added"], ["b", "c"])
+
+    def test_partial_sync_keeps_the_rest_pending(self):
+        catalog = cc.CatalogCache(SERVER_INFO)
+        self.refresh(catalog, FakeResponse(200, [catalogRow("a")]))
+        catalog.markSynced("agol")
+        self.refresh(catalog, FakeResponse(200, [catalogRow("b"), catalogRow("c")]))
+
+        catalog.markSynced("agol", ["a", "b"])
+        self.assertEqual(catalog.getChanges("agol"), {"added": ["c"], "removed": [], "changed": []})
+
+    def test_revalidation_and_persistence(self):
+        catalog = cc.CatalogCache(SERVER_INFO)
+        self.refresh(catalog, FakeResponse(200, [catalogRow("a")], "v1"))
+        catalog.markSynced("agol")
+
+        self.assertFalse(self.refresh(catalog, FakeResponse(304)))
+        self.assertEqual(self.requests[-1].get("If-None-Match"), "v1")
+        self.assertEqual(catalog.datasetIDs, ["a"])
+
+        reloaded = cc.CatalogCache(SERVER_INFO)
+        self.assertEqual(reloaded.datasetIDs, ["a"])
+        self.assertTrue(reloaded.contains("a"))
+        self.assertEqual(reloaded.getChanges("agol"), {"added": [], "removed": [], "changed": []})
+        self.assertEqual(len(self.requests), 2)
+
+if __name__ == '__main__':
+    unittest.main()
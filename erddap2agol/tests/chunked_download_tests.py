@@ -0,0 +1,115 @@
+import unittest
+import sys
+import os
+import io
+import copy
+import json
+from contextlib import redirect_stdout
+from datetime import timedelta
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import erddap_client as ec
+from src import chunked_download as cd
+from src import tabledap_query as tq
+from tests.fixtures import AgolHomeTestCase
+
+HEADER = "longitude (degrees_east),latitude (degrees_north),sea_water_temperature (degree_C),time (UTC)\n"
+
+class TestCheckpointResume(AgolHomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.handler = copy.copy(ec.erddapGcoos)
+        self.handler.datasetid = "gcoos_42001"
+        self.handler.fileType = "csvp"
+        self.handler.start_time = "2020-01-01T00:00:00"
+        self.handler.end_time = "2020-03-01T00:00:00"
+        self.requested = []
+        self.failAfter = None
+
+    # Hourly rows for the window the url asks for
+    def fakeDownload(self, url, file_path, fmt=None, validate=True, expected_columns=None, failure=None, units=None):
+        query = tq.TabledapQuery.fromUrl(url)
+        start = cd.parseTime(query.getConstraint("time", ">="))
+        end = query.getConstraint("time", "<=")
+        inclusive = end is not None
+        end = cd.parseTime(end if inclusive else query.getConstraint("time", "<"))
+        self.requested.append(start)
+        if self.failAfter is not None and len(self.requested) > self.failAfter:
+            failure.update(status=400, retryable=False)
+            return None
+
+        rows = []
+        moment = start
+        while moment < end or (inclusive and moment == end):
+            rows.append(f"-88.0,28.0,25.5,{moment:%Y-%m-%dT%H:%M:%S}Z\n")
+            moment += timedelta(hours=1)
+        body = HEADER + "".join(rows)
+        with open(file_path, 'w') as f:
+            f.write(body)
+        return {"path": file_path, "bytes": len(body), "rows": len(rows), "header": HEADER.strip(),
+                "wire_bytes": len(body)}
+
+    def download(self, attrs=("sea_water_temperature",)):
+        with mock.patch.object(ec, "downloadAsCsvp", self.fakeDownload), redirect_stdout(io.StringIO()):
+            return cd.downloadChunked(self.handler, list(attrs), chunkDays=10, maxPerHost=1, retries=0)
+
+    def manifest(self) -> dict:
+        with open(cd.getManifestPath(cd.getBackfillDir(self.handler.datasetid))) as f:
+            return json.load(f)
+
+    def readTimes(self, path: str) -> list:
+        with open(path) as f:
+            return [line.rstrip("\n").split(",")[-1] for line in f.readlines()[1:]]
+
+    def test_resume_fetches_only_missing_windows(self):
+        self.failAfter = 2
+        self.assertIsNone(self.download())
+        self.assertEqual(len(self.manifest()["chunks"]), 2)
+
+        self.failAfter = None
+        self.requested = []
+        path = self.download()
+        self.assertEqual(len(self.requested), 4)
+        self.assertEqual(min(self.requested), cd.parseTime("2020-01-21T00:00:00"))
+        times = self.readTimes(path)
+        self.assertEqual(len(times), 60 * 24 + 1)
+        self.assertEqual(times, sorted(set(times)))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "e2a_backfill", "gcoos_42001", "manifest.json")))
+
+    def test_resume_ignores_attribute_order(self):
+        self.failAfter = 2
+        self.download(("sea_water_temperature", "salinity"))
+        self.failAfter = None
+        self.requested = []
+        self.download(("salinity", "sea_water_temperature"))
+        self.assertEqual(min(self.requested), cd.parseTime("2020-01-21T00:00:00"))
+
+    def test_damaged_checkpoint_is_refetched(self):
+        self.failAfter = 2
+        self.download()
+        second = self.manifest()["chunks"][1]
+        chunk_path = os.path.join(cd.getBackfillDir(self.handler.datasetid), second["file"])
+        with open(chunk_path) as f:
+            lines = f.readlines()
+        with open(chunk_path, 'w') as f:
+            f.writelines(lines[:-1])
+
+        self.failAfter = None
+        self.requested = []
+        path = self.download()
+        self.assertEqual(min(self.requested), cd.parseTime(second["start"]))
+        self.assertEqual(len(self.readTimes(path)), 60 * 24 + 1)
+
+    def test_changed_request_starts_over(self):
+        self.failAfter = 2
+        self.download()
+        self.failAfter = None
+        self.requested = []
+        self.download(("sea_water_temperature", "salinity"))
+        self.assertEqual(min(self.requested), cd.parseTime("2020-01-01T00:00:00"))
+        self.assertEqual(len(self.requested), 6)
+
+if __name__ == '__main__':
+    unittest.main()
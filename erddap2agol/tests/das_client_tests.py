@@ -0,0 +1,98 @@
+import unittest
+import sys
+import os
+import json
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import das_client as dc
+from src import metadata_store as ms
+from tests.fixtures import AgolHomeTestCase
+
+SAMPLE_DAS = """Attributes {
+ s {
+  time {
+    String _CoordinateAxisType "Time";
+    Float64 actual_range 1.4516352e+9, 1.7291808e+9;
+    String units "seconds since 1970-01-01T00:00:00Z";
+  }
+  sea_water_temperature {
+    Float32 actual_range 10.5, 31.2;
+    Int16 precision 2;
+    String comment "He said \\"hi\\"";
+  }
+ }
+  NC_Global {
+    String history "created
+updated";
+    String license "CC-BY";
+  }
+}
+"""
+
+class TestDasParser(unittest.TestCase):
+    def test_typed_values(self):
+        model = dc.parseDasStream(SAMPLE_DAS.splitlines())
+        temperature = model["s"]["sea_water_temperature"]
+
+        self.assertEqual(temperature["actual_range"].value, (10.5, 31.2))
+        self.assertEqual(temperature["precision"].value, 2)
+        self.assertEqual(temperature["comment"].value, 'He said "hi"')
+        self.assertEqual(model["NC_Global"]["history"].value, "created\nupdated")
+
+    def test_bytes_lines(self):
+        model = dc.parseDasStream(SAMPLE_DAS.encode("utf-8").splitlines())
+        self.assertEqual(model["NC_Global"]["license"].value, "CC-BY")
+
+    def test_time_range(self):
+        model = dc.parseDasStream(SAMPLE_DAS.splitlines())
+        self.assertEqual(dc.getTimeRange(model), (1451635200, 1729180800))
+
+    def test_legacy_shape(self):
+        data = dc.convertToDict(dc.parseDasResponse(SAMPLE_DAS))
+
+        self.assertEqual(list(data), ["s", "time", "sea_water_temperature", "NC_Global"])
+        self.assertEqual(data["s"], {})
+        self.assertEqual(data["NC_Global"]["license"], {"datatype": "String", "value": "CC-BY"})
+        start, end = data["time"]["actual_range"]["value"].split(", ")
+        self.assertEqual((int(float(start)), int(float(end))), (1451635200, 1729180800))
+
+    def test_dtype_plan(self):
+        model = dc.parseDasStream(SAMPLE_DAS.splitlines())
+        expected = {"time": dc.DATETIME, "sea_water_temperature": "float32"}
+
+        self.assertEqual(dc.getDtypePlan(model), expected)
+        self.assertEqual(dc.getDtypePlan(dc.convertToDict(dc.parseDasResponse(SAMPLE_DAS))), expected)
+
+    def test_units(self):
+        model = dc.parseDasStream(SAMPLE_DAS.splitlines())
+        # csvp labels time columns UTC, variables without units get none
+        self.assertEqual(dc.getUnits(model), {"time": "UTC"})
+        self.assertEqual(dc.getUnits(dc.convertToDict(dc.parseDasResponse(SAMPLE_DAS))), {"time": "UTC"})
+
+
+class TestDasCache(AgolHomeTestCase):
+    def setUp(self):
+        super().setUp()
+        # Create the store now, its first write would clear the cache on its own
+        ms.hasDataset("gcoos_00000")
+        dc._dasCache.clear()
+
+    def tearDown(self):
+        dc._dasCache.clear()
+
+    def test_missing_dataset_is_found_once_saved(self):
+        self.assertFalse(dc.checkForJson("gcoos_42001"))
+        dc.saveDas(SAMPLE_DAS, "gcoos_42001", "https://erddap.gcoos.org/erddap/tabledap/")
+        self.assertTrue(dc.checkForJson("gcoos_42001"))
+
+    def test_missing_dataset_is_found_once_written_elsewhere(self):
+        # A legacy JSON file written after the lookup doesn't go through saveDas
+        self.assertFalse(dc.checkForJson("gcoos_42002"))
+        with open(dc.getJsonPath("gcoos_42002"), 'w') as f:
+            json.dump(dc.convertToDict(dc.parseDasResponse(SAMPLE_DAS)), f)
+        self.assertTrue(dc.checkForJson("gcoos_42002"))
+
+
+if __name__ == '__main__':
+    unittest.main()
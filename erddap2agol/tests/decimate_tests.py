@@ -0,0 +1,90 @@
+import unittest
+import sys
+import os
+import copy
+import tempfile
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import erddap_client as ec
+from src import decimate as dm
+
+HEADER = "station,longitude (degrees_east),latitude (degrees_north),sea_water_temperature (degree_C),time (UTC)\n"
+
+def stationRows(station: str, minutes: list) -> list:
+    return [f"{station},-88.0,28.0,25.{minute},2024-05-01T{minute // 60:02d}:{minute % 60:02d}:00Z\n"
+            for minute in minutes]
+
+class TestDecimateFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "data.csv")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, rows: list) -> None:
+        with open(self.path, 'w') as f:
+            f.write(HEADER + "".join(sorted(rows, key=lambda row: row.split(",")[-1])))
+
+    def readRows(self) -> list:
+        with open(self.path) as f:
+            return [line.rstrip("\n").split(",") for line in f.readlines()[1:]]
+
+    def test_one_row_per_bucket_per_station(self):
+        self.write(stationRows("42001", range(0, 120, 10)) + stationRows("42002", range(5, 120, 10)))
+        kept = dm.decimateFile(self.path, "time", 3600, ["station"])
+        rows = self.readRows()
+        self.assertEqual(kept, 6)
+        self.assertEqual(sorted(row[0] for row in rows), ["42001"] * 3 + ["42002"] * 3)
+        times = [row[-1] for row in rows]
+        self.assertEqual(times, sorted(times))
+
+    def test_without_keys_stations_share_buckets(self):
+        self.write(stationRows("42001", range(0, 120, 10)) + stationRows("42002", range(5, 120, 10)))
+        self.assertEqual(dm.decimateFile(self.path, "time", 3600), 3)
+
+class TestDownloadDecimated(unittest.TestCase):
+    def setUp(self):
+        self.handler = copy.copy(ec.erddapGcoos)
+        self.handler.datasetid = "gcoos_42001"
+        self.handler.fileType = "csvp"
+        self.handler.start_time = "2024-05-01T00:00:00"
+        self.handler.end_time = "2024-05-04T00:00:00"
+        self.urls = []
+
+    def fakeDownload(self, status):
+        def downloadToCsv(url, validate=True, failure=None):
+            self.urls.append(url)
+            if status is not None and failure is not None:
+                failure.update(status=status, retryable=status >= 500)
+            return None
+        return downloadToCsv
+
+    def test_empty_window_is_not_refetched(self):
+        self.handler.downloadToCsv = self.fakeDownload(None)
+        path, url = dm.downloadDecimated(self.handler, ["sea_water_temperature"], 100)
+        self.assertIsNone(path)
+        self.assertEqual(len(self.urls), 1)
+        self.assertIn("orderByClosest", url)
+
+    def test_server_error_is_not_refetched(self):
+        self.handler.downloadToCsv = self.fakeDownload(500)
+        dm.downloadDecimated(self.handler, ["sea_water_temperature"], 100)
+        self.assertEqual(len(self.urls), 1)
+
+    def test_rejected_orderByClosest_falls_back(self):
+        self.handler.downloadToCsv = self.fakeDownload(400)
+        path, url = dm.downloadDecimated(self.handler, ["sea_water_temperature"], 100)
+        self.assertIsNone(path)
+        self.assertEqual(len(self.urls), 2)
+        self.assertTrue(url.endswith("orderBy(%22time%22)"))
+
+    def test_feature_keys_in_orderByClosest(self):
+        self.handler.decimation = "1hours"
+        self.handler.decimationKeys = ["station", "depth"]
+        url = self.handler.generate_url(False, ["station", "depth", "sea_water_temperature"])
+        self.assertTrue(url.endswith("&orderByClosest(%22station%2Cdepth%2Ctime/1hours%22)"))
+
+if __name__ == '__main__':
+    unittest.main()
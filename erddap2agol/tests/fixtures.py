@@ -0,0 +1,15 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+# Gives each test its own AGOL_HOME in a temporary directory, so the caches, logs and
+# metadata store written by the code under test never touch a real install.
+# Subclasses that override setUp call super().setUp() first.
+class AgolHomeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        environ = mock.patch.dict(os.environ, {"AGOL_HOME": self.tmp.name})
+        environ.start()
+        self.addCleanup(environ.stop)
@@ -0,0 +1,89 @@
+import unittest
+import sys
+import os
+import io
+import copy
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import core
+from src import erddap_client as ec
+from src import tabledap_query as tq
+
+FULL_URL = ("https://erddap.gcoos.org/erddap/tabledap/gcoos_42001.csvp?longitude%2Clatitude%2Csea_water_temperature%2Ctime"
+            "&time%3E%3D2024-05-01T00:00:00Z&time%3C%3D2024-05-08T00:00:00Z&orderBy(%22time%22)")
+HEADER = "longitude (degrees_east),latitude (degrees_north),sea_water_temperature (degree_C),time (UTC)\n"
+
+class TestIncrementalUpdate(unittest.TestCase):
+    def setUp(self):
+        self.gcload = copy.copy(ec.erddapGcoos)
+        self.gcload.datasetid = "gcoos_42001"
+        # updateCallFromID gives [full_url, latest data, last update]
+        self.logged = [FULL_URL, "2024-05-08T00:00:00", "2024-05-08T00:05:00"]
+        self.body = HEADER + "".join(f"-88.0,28.0,25.{hour},2024-05-08T0{hour}:00:00Z\n" for hour in range(4))
+        self.urls = []
+        self.appended = []
+        self.latest = []
+        self.appendLimit = None
+        self.cutoffs = []
+
+    def fakeDownload(self, url, file_path, fmt=None, validate=True, expected_columns=None, failure=None, units=None):
+        self.urls.append(url)
+        if self.body is None:
+            return {"path": None, "bytes": 0, "rows": 0, "header": None, "wire_bytes": 0}
+        with open(file_path, 'w') as f:
+            f.write(self.body)
+        return {"path": file_path, "bytes": len(self.body), "rows": None, "header": HEADER.strip(),
+                "wire_bytes": len(self.body)}
+
+    def appendRows(self, layer, frame, erddapObj, header):
+        self.appended.append(frame)
+        return len(frame) if self.appendLimit is None else self.appendLimit
+
+    def update(self):
+        with mock.patch.object(core.ul, "updateCallFromID", lambda itemid: self.logged), \
+             mock.patch.object(core.ul, "updateLatestData", lambda itemid, latest, now: self.latest.append(latest)), \
+             mock.patch.object(core.aw, "getFeatureLayer", lambda itemid: object()), \
+             mock.patch.object(core.aw, "appendRows", self.appendRows), \
+             mock.patch.object(core.aw, "deleteBefore", lambda layer, column, cutoff: self.cutoffs.append(cutoff) or 2), \
+             mock.patch.object(ec, "downloadAsCsvp", self.fakeDownload), \
+             redirect_stdout(io.StringIO()):
+            return core.incrementalUpdate(self.gcload, "gcoos_42001", "item1")
+
+    def test_appends_rows_after_the_last_time(self):
+        self.assertTrue(self.update())
+        query = tq.TabledapQuery.fromUrl(self.urls[0])
+        self.assertEqual(query.getConstraint("time", ">="), "2024-05-08T00:00:00Z")
+        self.assertEqual(query.variables, ["longitude", "latitude", "sea_water_temperature", "time"])
+        # The row at the logged time is already in the layer
+        self.assertEqual(len(self.appended[0]), 3)
+        self.assertEqual(self.latest, ["2024-05-08T03:00:00"])
+
+    def test_nothing_new_only_expires(self):
+        self.body = None
+        self.assertTrue(self.update())
+        self.assertEqual(self.appended, [])
+        self.assertEqual(self.latest, ["2024-05-08T00:00:00"])
+
+    def test_expiry_cutoff_is_utc(self):
+        self.body = None
+        self.update()
+        expected = datetime.now(timezone.utc) - timedelta(days=7)
+        self.assertEqual(self.cutoffs[0].utcoffset(), timedelta(0))
+        self.assertLess(abs((self.cutoffs[0] - expected).total_seconds()), 60)
+
+    def test_partial_append_falls_back_to_overwrite(self):
+        self.appendLimit = 1
+        self.assertFalse(self.update())
+        self.assertEqual(self.latest, [])
+
+    def test_unlogged_item_falls_back_to_overwrite(self):
+        self.logged = None
+        self.assertFalse(self.update())
+        self.assertEqual(self.urls, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import sys
+import os
+import tempfile
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import nrt_scheduler as ns
+
+HOUR = 3600
+
+class TestDurations(unittest.TestCase):
+    def test_parseDuration(self):
+        self.assertEqual(ns.parseDuration("PT1H"), 3600)
+        self.assertEqual(ns.parseDuration("PT10M"), 600)
+        self.assertEqual(ns.parseDuration("P1D"), 86400)
+        self.assertEqual(ns.parseDuration("P1DT12H"), 129600)
+        self.assertEqual(ns.parseDuration("pt30s"), 30)
+        self.assertEqual(ns.parseDuration("PT0.5H"), 1800)
+        self.assertIsNone(ns.parseDuration("P"))
+        self.assertIsNone(ns.parseDuration("PT0S"))
+        self.assertIsNone(ns.parseDuration("hourly"))
+        self.assertIsNone(ns.parseDuration(None))
+
+    def test_resolutionSeconds(self):
+        das = {"NC_Global": {"time_coverage_resolution": {"value": "PT1H"}}}
+        self.assertEqual(ns.resolutionSeconds(das), 3600)
+        self.assertIsNone(ns.resolutionSeconds({"NC_Global": {}}))
+        self.assertIsNone(ns.resolutionSeconds({}))
+
+    def test_dataStep(self):
+        self.assertEqual(ns.dataStep("2024-05-01T00:00:00", "2024-05-01T01:00:00Z"), 3600)
+        self.assertIsNone(ns.dataStep("None", "2024-05-01T01:00:00"))
+        self.assertIsNone(ns.dataStep("2024-05-01T01:00:00", "2024-05-01T00:00:00"))
+
+class TestReschedule(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.scheduler = ns.NRTScheduler(path=os.path.join(self.tmp.name, ns.STATE_FILE))
+        self.scheduler.state["buoy"] = {"itemid": "abc", "interval": HOUR, "next_due": 0, "last_run": None,
+                                        "last_data": "2024-05-01T00:00:00", "last_change": None,
+                                        "misses": 0, "failures": 0}
+        self.entry = self.scheduler.state["buoy"]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assertDelay(self, delay, expected):
+        self.assertGreaterEqual(delay, expected * (1 - ns.JITTER))
+        self.assertLessEqual(delay, expected * (1 + ns.JITTER))
+
+    def test_new_data_follows_the_data_step(self):
+        delay = self.scheduler.reschedule("buoy", True, "2024-05-01T00:00:00", "2024-05-01T03:00:00", 1000.0)
+        expected = ns.EWMA_ALPHA * 3 * HOUR + (1 - ns.EWMA_ALPHA) * HOUR
+        self.assertAlmostEqual(self.entry["interval"], expected)
+        self.assertDelay(delay, expected * ns.POLL_FRACTION)
+        self.assertEqual(self.entry["last_data"], "2024-05-01T03:00:00")
+        self.assertEqual(self.entry["next_due"], 1000.0 + delay)
+        self.assertEqual(self.scheduler.heap, [(self.entry["next_due"], "buoy")])
+
+    def test_poll_rate_does_not_change_the_interval(self):
+        # Hourly rows found two hours of wall clock apart still read as hourly
+        self.scheduler.reschedule("buoy", True, "2024-05-01T00:00:00", "2024-05-01T01:00:00", 0.0)
+        self.scheduler.reschedule("buoy", True, "2024-05-01T01:00:00", "2024-05-01T02:00:00", 2 * HOUR)
+        self.assertAlmostEqual(self.entry["interval"], HOUR)
+
+    def test_misses_slow_down(self):
+        self.entry["misses"] = 1
+        delay = self.scheduler.reschedule("buoy", True, "2024-05-01T00:00:00", "2024-05-01T00:00:00", 0.0)
+        self.assertEqual(self.entry["misses"], 2)
+        self.assertEqual(self.entry["interval"], HOUR)
+        self.assertDelay(delay, HOUR * ns.POLL_FRACTION * ns.SLOWDOWN ** 2)
+
+    def test_failures_back_off(self):
+        first = self.scheduler.reschedule("buoy", False, None, None, 0.0)
+        second = self.scheduler.reschedule("buoy", False, None, None, 0.0)
+        self.assertDelay(first, ns.FAILURE_BACKOFF)
+        self.assertDelay(second, ns.FAILURE_BACKOFF * 2)
+        self.scheduler.reschedule("buoy", True, None, "2024-05-01T01:00:00", 0.0)
+        self.assertEqual(self.entry["failures"], 0)
+
+    def test_waits_are_clamped(self):
+        self.entry["misses"] = 20
+        delay = self.scheduler.reschedule("buoy", True, "2024-05-01T00:00:00", "2024-05-01T00:00:00", 0.0)
+        self.assertDelay(delay, ns.MAX_INTERVAL)
+        self.entry["interval"] = 1
+        delay = self.scheduler.reschedule("buoy", True, "2024-05-01T00:00:00", "2024-05-01T00:00:01", 0.0)
+        self.assertDelay(delay, ns.MIN_INTERVAL)
+
+    def test_removed_item_is_not_rescheduled(self):
+        self.assertIsNone(self.scheduler.reschedule("gone", True, None, None, 0.0))
+        self.assertEqual(self.scheduler.heap, [])
+
+    def test_state_survives_a_restart(self):
+        self.scheduler.reschedule("buoy", True, "2024-05-01T00:00:00", "2024-05-01T01:00:00", 0.0)
+        ns.saveState(self.scheduler.path, self.scheduler.state)
+        restarted = ns.NRTScheduler(path=self.scheduler.path)
+        self.assertEqual(restarted.state, self.scheduler.state)
+
+if __name__ == '__main__':
+    unittest.main()
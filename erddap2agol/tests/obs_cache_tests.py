@@ -0,0 +1,92 @@
+import unittest
+import sys
+import os
+import io
+import copy
+from contextlib import redirect_stdout
+from datetime import timedelta
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import erddap_client as ec
+from src import obs_cache as oc
+from src import chunked_download as cd
+from src import tabledap_query as tq
+from tests.fixtures import AgolHomeTestCase
+
+@unittest.skipUnless(oc.isAvailable(), "the observation cache needs pyarrow")
+class TestBuildPublishFile(AgolHomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.handler = copy.copy(ec.erddapGcoos)
+        self.handler.datasetid = "gcoos_42001"
+        self.handler.fileType = "csvp"
+        self.handler.dtypes = {"time": "datetime64", "sea_water_temperature": "float32", "salinity": "float32"}
+        self.handler.start_time = "2020-01-01T00:00:00"
+        self.handler.end_time = "2020-01-10T00:00:00"
+        self.requested = []
+
+    # Six hourly rows for the window the url asks for
+    def fakeDownload(self, url, file_path, fmt=None, validate=True, expected_columns=None, failure=None, units=None):
+        query = tq.TabledapQuery.fromUrl(url)
+        start = cd.parseTime(query.getConstraint("time", ">="))
+        end = cd.parseTime(query.getConstraint("time", "<"))
+        self.requested.append((start, end))
+        header = ",".join(f"{name} ({units})" for name, units in zip(query.variables, self.units(query.variables)))
+        rows = []
+        moment = start
+        while moment < end:
+            rows.append(",".join("25.5" if name in ("sea_water_temperature", "salinity") else
+                                 f"{moment:%Y-%m-%dT%H:%M:%S}Z" if name == "time" else "28.0"
+                                 for name in query.variables) + "\n")
+            moment += timedelta(hours=6)
+        with open(file_path, 'w') as f:
+            f.write(header + "\n" + "".join(rows))
+        return {"path": file_path, "bytes": 0, "rows": len(rows), "header": header, "wire_bytes": 0}
+
+    def units(self, names: list) -> list:
+        known = {"longitude": "degrees_east", "latitude": "degrees_north", "time": "UTC"}
+        return [known.get(name, "degree_C") for name in names]
+
+    def build(self, attrs=("sea_water_temperature",)):
+        with mock.patch.object(ec, "downloadAsCsvp", self.fakeDownload), \
+             mock.patch.object(oc, "MUTABLE_DAYS", -100000), redirect_stdout(io.StringIO()):
+            return oc.buildPublishFile(self.handler, list(attrs), os.path.join(self.tmp.name, "out.csv"))
+
+    def readLines(self, path: str) -> list:
+        with open(path) as f:
+            return f.read().splitlines()
+
+    def test_only_missing_days_are_fetched(self):
+        self.handler.end_time = "2020-01-05T00:00:00"
+        self.build()
+        self.assertEqual(self.requested, [(cd.parseTime("2020-01-01T00:00:00"), cd.parseTime("2020-01-06T00:00:00"))])
+
+        self.requested = []
+        self.handler.end_time = "2020-01-10T00:00:00"
+        path = self.build()
+        self.assertEqual(self.requested, [(cd.parseTime("2020-01-06T00:00:00"), cd.parseTime("2020-01-11T00:00:00"))])
+        lines = self.readLines(path)
+        self.assertEqual(lines[0], "longitude (degrees_east),latitude (degrees_north),"
+                                   "sea_water_temperature (degree_C),time (UTC)")
+        # Nine days of four rows plus the one at end_time
+        self.assertEqual(len(lines) - 1, 9 * 4 + 1)
+        self.assertEqual(lines[1], "28.0,28.0,25.5,2020-01-01T00:00:00Z")
+
+    def test_attribute_order_reuses_the_cache(self):
+        self.build(("sea_water_temperature", "salinity"))
+        self.requested = []
+        path = self.build(("salinity", "sea_water_temperature"))
+        self.assertEqual(self.requested, [])
+        self.assertIn("salinity (degree_C),sea_water_temperature (degree_C)", self.readLines(path)[0])
+
+    def test_different_variables_start_over(self):
+        self.build()
+        self.requested = []
+        self.build(("sea_water_temperature", "salinity"))
+        self.assertEqual(len(self.requested), 1)
+        self.assertEqual(self.requested[0][0], cd.parseTime("2020-01-01T00:00:00"))
+
+if __name__ == '__main__':
+    unittest.main()
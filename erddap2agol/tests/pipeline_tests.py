@@ -0,0 +1,119 @@
+import unittest
+import sys
+import os
+import io
+import copy
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import pipeline as pl
+from src import core
+from src import das_fetcher as df
+from src import erddap_client as ec
+
+class TestRunPipeline(unittest.TestCase):
+    def run_quietly(self, *args, **kwargs):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            result = pl.runPipeline(*args, **kwargs)
+        return result, out.getvalue()
+
+    def test_results_and_accounting(self):
+        def double(item):
+            if item == 3:
+                raise ValueError("bad item")
+            return item * 2
+
+        def keepSmall(item):
+            return item if item < 8 else None
+
+        stages = [pl.Stage("double", double, 2), pl.Stage("keep", keepSmall, 1)]
+        results, out = self.run_quietly([1, 2, 3, 4, 5], stages)
+        self.assertEqual(sorted(results), [2, 4])
+        self.assertIn("double: 4 done, 0 skipped, 1 failed", out)
+        self.assertIn("keep: 2 done, 2 skipped, 0 failed", out)
+        self.assertIn("double failed for 3: bad item", out)
+
+    def test_backpressure(self):
+        release = threading.Event()
+        started = []
+
+        def fast(item):
+            started.append(item)
+            return item
+
+        def slow(item):
+            release.wait()
+            return item
+
+        stages = [pl.Stage("fast", fast, 1), pl.Stage("slow", slow, 1)]
+        results = []
+        runner = threading.Thread(target=lambda: results.extend(self.run_quietly(list(range(20)), stages)[0]))
+        runner.start()
+        time.sleep(0.3)
+        # One item held by the slow stage, a full queue between them and one waiting to be put
+        self.assertEqual(len(started), 1 + pl.QUEUE_SIZE + 1)
+        release.set()
+        runner.join(5)
+        self.assertEqual(sorted(results), list(range(20)))
+
+class TestProcessListInput(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.gcload = copy.copy(ec.erddapGcoos)
+        self.published = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fetchDas(self, gcload, datasetid, revalidate=True):
+        if datasetid == "missing":
+            return df.DasResult(datasetid, None, "404")
+        return df.DasResult(datasetid, f"das of {datasetid}", None)
+
+    def parseDas(self, gcload, datasetid, das):
+        gcload.datasetid = datasetid
+        return ["sea_water_temperature"]
+
+    def download(self, gcload, attrs, seedbool, maxFeatures=None):
+        path = os.path.join(self.tmp.name, f"{gcload.datasetid}.csv")
+        with open(path, 'w') as f:
+            f.write("time (UTC)\n")
+        return path, f"url of {gcload.datasetid}"
+
+    def publish(self, gcload, filepath, url, isNRT):
+        self.published.append((gcload.datasetid, gcload, filepath, url))
+        if gcload.datasetid == "broken":
+            raise RuntimeError("publish failed")
+
+    def run_pipeline(self, datasets):
+        with mock.patch.object(df, "fetchDasResult", self.fetchDas), \
+             mock.patch.object(core, "parseDasNRT", self.parseDas), \
+             mock.patch.object(core, "downloadForPublish", self.download), \
+             mock.patch.object(core, "publishFile", self.publish), \
+             mock.patch.object(ec, "cleanTemp"), \
+             redirect_stdout(io.StringIO()):
+            core.processListInput(datasets, self.gcload, 1)
+
+    def test_each_dataset_gets_its_own_handler(self):
+        self.run_pipeline(["a", "b", "missing", "c"])
+        self.assertEqual(sorted(item[0] for item in self.published), ["a", "b", "c"])
+        for datasetid, gcload, filepath, url in self.published:
+            self.assertIsNot(gcload, self.gcload)
+            self.assertEqual(url, f"url of {datasetid}")
+        self.assertEqual(len({id(item[1]) for item in self.published}), 3)
+        self.assertIsNone(self.gcload.datasetid)
+
+    def test_files_are_removed_after_publishing(self):
+        self.run_pipeline(["a", "broken", "c"])
+        self.assertEqual(len(self.published), 3)
+        for _, _, filepath, _ in self.published:
+            self.assertFalse(os.path.exists(filepath))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+import sys
+import os
+import json
+import tempfile
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import response_formats as rf
+
+COLUMNS = ["station", "latitude", "longitude", "sea_water_temperature", "time"]
+UNITS = {"latitude": "degrees_north", "longitude": "degrees_east", "sea_water_temperature": "degree_C", "time": "UTC"}
+ROWS = [["42001", "28.0", "-88.0", "25.5", "2024-05-01T00:00:00Z"],
+        ["42001", "28.0", "-88.0", "", "2024-05-01T01:00:00Z"]]
+CSVP = ("station,latitude (degrees_north),longitude (degrees_east),sea_water_temperature (degree_C),time (UTC)\n"
+        "42001,28.0,-88.0,25.5,2024-05-01T00:00:00Z\n"
+        "42001,28.0,-88.0,,2024-05-01T01:00:00Z\n")
+
+def delimited(delimiter: str, header: list) -> str:
+    return "".join(delimiter.join(row) + "\n" for row in header + ROWS)
+
+def jsonLines(header: list) -> str:
+    return "".join(json.dumps(row) + "\n" for row in header + [[value or None for value in row] for row in ROWS])
+
+unitRow = [UNITS.get(name, "") for name in COLUMNS]
+inline = [f"{name} ({UNITS[name]})" if name in UNITS else name for name in COLUMNS]
+
+RESPONSES = {
+    "csvp": delimited(",", [inline]),
+    "csv": delimited(",", [COLUMNS, unitRow]),
+    "csv0": delimited(",", []),
+    "tsvp": delimited("\t", [inline]),
+    "tsv": delimited("\t", [COLUMNS, unitRow]),
+    "tsv0": delimited("\t", []),
+    "jsonlCSV1": jsonLines([COLUMNS]),
+    "jsonlCSV": jsonLines([]),
+}
+
+class TestToCsvp(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.out = os.path.join(self.tmp.name, "out.csv")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def convert(self, name: str, units: dict = None) -> str:
+        path = os.path.join(self.tmp.name, f"response.{name}")
+        with open(path, 'w') as f:
+            f.write(RESPONSES[name])
+        self.assertEqual(rf.toCsvp(path, rf.getFormat(name), self.out, COLUMNS, units), len(ROWS))
+        with open(self.out) as f:
+            return f.read()
+
+    def test_every_format_matches_csvp(self):
+        for name in RESPONSES:
+            with self.subTest(format=name):
+                self.assertEqual(self.convert(name, UNITS), CSVP)
+
+    def test_units_in_the_response_win(self):
+        self.assertEqual(self.convert("csv", {"latitude": "degrees"}), CSVP)
+
+    def test_headerless_without_units(self):
+        self.assertTrue(self.convert("csv0").startswith("station,latitude,longitude,"))
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            rf.getFormat("ncCF")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import sys
+import os
+import copy
+from datetime import datetime
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import tabledap_query as tq
+from src import erddap_client as ec
+from src import decimate as dm
+
+SERVER = "https://erddap.gcoos.org/erddap/tabledap/"
+
+# A url in the shape generate_url has always logged
+LOGGED_URL = (f"{SERVER}gcoos_42001.csvp?depth%2Clongitude%2Clatitude%2Csea_water_temperature%2Ctime"
+              "&time%3E%3D2024-05-01T00:00:00Z&time%3C%3D2024-05-04T00:00:00Z&orderBy(%22time%22)")
+
+class TestTabledapQuery(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.handler = copy.copy(ec.erddapGcoos)
+        self.handler.datasetid = "gcoos_42001"
+        self.handler.fileType = "csvp"
+        self.handler.start_time = "2024-05-01T00:00:00"
+        self.handler.end_time = "2024-05-04T00:00:00"
+
+    def test_round_trip(self):
+        query = tq.TabledapQuery.fromUrl(LOGGED_URL)
+        self.assertEqual(query.server, SERVER)
+        self.assertEqual(query.datasetid, "gcoos_42001")
+        self.assertEqual(query.fileType, "csvp")
+        self.assertEqual(query.variables, ["depth", "longitude", "latitude", "sea_water_temperature", "time"])
+        self.assertEqual(query.getConstraint("time", ">="), "2024-05-01T00:00:00Z")
+        self.assertEqual(query.functions, [("orderBy", "time")])
+        self.assertEqual(query.toUrl(), LOGGED_URL)
+
+    def test_generate_url_unchanged(self):
+        attrs = ["sea_water_temperature", "depth"]
+        self.assertEqual(self.handler.generate_url(False, attrs), LOGGED_URL)
+        self.assertEqual(attrs, ["sea_water_temperature", "depth"])
+
+    def test_chunk_url_excludes_end(self):
+        url = self.handler.generateChunkUrl(["sea_water_temperature"], datetime(2024, 5, 1), datetime(2024, 5, 2), False)
+        self.assertIn("&time%3E%3D2024-05-01T00:00:00Z&time%3C2024-05-02T00:00:00Z&", url)
+
+    def test_constraints_pushed_down(self):
+        self.handler.setBbox(-98, -80.5, 18, 31)
+        self.handler.constraints.append(("station", "=", "42001"))
+        url = self.handler.generate_url(False, ["sea_water_temperature"])
+        self.assertIn("&longitude%3E%3D-98&longitude%3C%3D-80.5&latitude%3E%3D18&latitude%3C%3D31", url)
+        self.assertIn("&station%3D%2242001%22&orderBy(%22time%22)", url)
+        query = tq.TabledapQuery.fromUrl(url)
+        self.assertEqual(query.getConstraint("station", "="), "42001")
+        self.assertEqual(query.toUrl(), url)
+
+    def test_server_side_functions(self):
+        query = tq.TabledapQuery(SERVER, "gcoos_42001", "csvp", ["station", "time"])
+        query.where("station", "=~", "420.*").orderByClosest("station", "time/1hour").distinct()
+        url = query.toUrl()
+        self.assertTrue(url.endswith("station%2Ctime&station%3D~%22420.%2A%22"
+                                     "&orderByClosest(%22station%2Ctime/1hour%22)&distinct()"))
+        self.assertEqual(tq.TabledapQuery.fromUrl(url).toUrl(), url)
+        with self.assertRaises(ValueError):
+            query.where("station", "like", "420")
+
+    def test_orderByCount_all_variables(self):
+        query = tq.TabledapQuery(SERVER, "gcoos_42001", "csvp", ["salinity", "sea_water_temperature"]).orderByCount()
+        url = query.toUrl()
+        self.assertTrue(url.endswith("csvp?salinity%2Csea_water_temperature&orderByCount(%22%22)"))
+        self.assertEqual(tq.TabledapQuery.fromUrl(url).functions, [("orderByCount", "")])
+
+    def test_decimation_replaces_orderBy(self):
+        self.handler.decimation = dm.formatInterval(dm.bucketSeconds(self.handler, 100))
+        url = self.handler.generate_url(False, ["sea_water_temperature"])
+        self.assertTrue(url.endswith("&orderByClosest(%22time/1hours%22)"))
+
+    def test_generateUpdateUrl(self):
+        url = ec.ERDDAPHandler.generateUpdateUrl(LOGGED_URL, "2024-05-03T12:00:00", "2024-05-05T00:00:00")
+        self.assertEqual(url, LOGGED_URL.replace("2024-05-01T00:00:00Z", "2024-05-03T12:00:00Z")
+                                        .replace("2024-05-04T00:00:00Z", "2024-05-05T00:00:00Z"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import unittest
+import sys
+import os
+import gc
+import gzip
+import io
+import time
+import requests
+import urllib3
+from email.utils import formatdate
+from unittest import mock
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import transport as tp
+
+URL = "https://erddap.example.org/erddap/tabledap/gcoos_42001.csvp"
+
+class FakeResponse:
+    def __init__(self, status_code: int, retry_after: str = None):
+        self.status_code = status_code
+        self.headers = {"Retry-After": retry_after} if retry_after else {}
+        self.content = b""
+        self.raw = None
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class FakeSession:
+    def __init__(self, responses: list):
+        self.responses = responses
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        return self.responses.pop(0)
+
+class TestRetryAfter(unittest.TestCase):
+    def test_seconds_and_dates(self):
+        self.assertEqual(tp.retryAfter(FakeResponse(429, "120")), 120.0)
+        self.assertEqual(tp.retryAfter(FakeResponse(429, "-5")), 0.0)
+        self.assertAlmostEqual(tp.retryAfter(FakeResponse(503, formatdate(time.time() + 60, usegmt=True))), 60, delta=2)
+        self.assertIsNone(tp.retryAfter(FakeResponse(429)))
+        self.assertIsNone(tp.retryAfter(FakeResponse(429, "soon")))
+
+class TestHostLimiter(unittest.TestCase):
+    def test_token_bucket(self):
+        limiter = tp.HostLimiter(rate=20, burst=2, concurrency=10)
+        self.assertLess(limiter.acquire(), 0.01)
+        self.assertLess(limiter.acquire(), 0.01)
+        # Burst used up, the next token comes after 1/rate seconds
+        self.assertAlmostEqual(limiter.acquire(), 0.05, delta=0.03)
+
+    def test_in_flight_cap(self):
+        limiter = tp.HostLimiter(rate=0, concurrency=1)
+        limiter.acquire()
+        with self.assertRaises(tp.SlotTimeout):
+            limiter.acquire(timeout=0.05)
+        limiter.release()
+        self.assertLess(limiter.acquire(timeout=0.05), 0.01)
+
+    def test_backoff_doubles_and_resets(self):
+        limiter = tp.HostLimiter()
+        self.assertEqual(limiter.observe(FakeResponse(500)), tp.BACKOFF_BASE)
+        self.assertEqual(limiter.observe(FakeResponse(502)), tp.BACKOFF_BASE * 2)
+        self.assertEqual(limiter.observe(FakeResponse(200)), 0.0)
+        self.assertEqual(limiter.failures, 0)
+
+    def test_long_retry_after_is_clamped(self):
+        limiter = tp.HostLimiter()
+        self.assertEqual(limiter.observe(FakeResponse(429, "86400")), 86400.0)
+        self.assertLessEqual(limiter.paused_until - time.monotonic(), tp.MAX_RETRY_AFTER)
+
+class TestRequest(unittest.TestCase):
+    def setUp(self):
+        tp._limiters.clear()
+
+    def tearDown(self):
+        tp._limiters.clear()
+
+    def request(self, *responses, **kwargs):
+        session = FakeSession(list(responses))
+        with mock.patch.object(tp, "getSession", lambda: session), \
+             mock.patch.object(tp, "countWait"), mock.patch.object(tp, "countRequest"), \
+             mock.patch.object(tp, "countBytes"):
+            return tp.get(URL, **kwargs), session
+
+    def test_throttle_is_retried(self):
+        response, session = self.request(FakeResponse(429, "0"), FakeResponse(200))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(session.calls, 2)
+        self.assertEqual(tp.getLimiter(URL).active, 0)
+
+    def test_long_retry_after_fails_without_hanging_the_host(self):
+        response, session = self.request(FakeResponse(429, "86400"))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(session.calls, 1)
+        self.assertLessEqual(tp.getLimiter(URL).paused_until - time.monotonic(), tp.MAX_RETRY_AFTER)
+
+    def test_streamed_slot_is_released(self):
+        limiter = tp.getLimiter(URL)
+        response = requests.Response()
+        response.raw = io.BytesIO()
+        limiter.acquire()
+        tp.holdSlot(response, limiter)
+        response.close()
+        response.close()
+        self.assertEqual(limiter.active, 0)
+
+        dropped = requests.Response()
+        limiter.acquire()
+        tp.holdSlot(dropped, limiter)
+        del dropped
+        gc.collect()
+        self.assertEqual(limiter.active, 0)
+
+def gzipResponse(body: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.url = URL
+    response.raw = urllib3.HTTPResponse(body=io.BytesIO(gzip.compress(body)), headers={"Content-Encoding": "gzip"},
+                                        status=200, preload_content=False, decode_content=True)
+    return response
+
+class TestByteAccounting(unittest.TestCase):
+    def setUp(self):
+        tp.resetStats()
+
+    def tearDown(self):
+        tp.resetStats()
+
+    def test_streamed_bytes_counted_once_on_the_wire_and_decoded(self):
+        body = b"2024-05-01T00:00:00Z,25.5\n" * 1000
+        response = gzipResponse(body)
+        chunks = list(tp.iterContent(response, 1024))
+        self.assertEqual(b"".join(chunks), body)
+        stats = tp.getStats()["erddap.example.org"]
+        self.assertEqual(stats["bytes"], len(body))
+        self.assertEqual(stats["wire_bytes"], len(gzip.compress(body)))
+        self.assertLess(stats["wire_bytes"], stats["bytes"])
+
+    def test_unknown_wire_size_counts_the_decoded_size(self):
+        tp.countBytes(URL, None, 500)
+        tp.countBytes(URL, 100, 400)
+        stats = tp.getStats()["erddap.example.org"]
+        self.assertEqual((stats["wire_bytes"], stats["bytes"]), (600, 900))
+
+    def test_compression_ratio(self):
+        self.assertEqual(tp.formatRatio(100, 900), "9.0x compression")
+        self.assertEqual(tp.formatRatio(0, 0), "no transfer")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#Benchmarks DAS parsing over a large corpus.
+#Uses a directory of .das files if one is given, otherwise builds a synthetic corpus.
+#   python scripts/bench_das_parser.py --datasets 2000 --variables 60
+#   python scripts/bench_das_parser.py --corpus /path/to/das_files
+
+import os
+import sys
+import time
+import argparse
+import json
+from collections import OrderedDict
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from erddap2agol.src import das_client as dc
+
+
+# The line splitting parser that parseDasResponse used before the streaming parser, kept as a baseline
+def legacyParse(response_text):
+    data = OrderedDict()
+    current_section = None
+
+    for line in response_text.strip().splitlines():
+        line = line.strip()
+        if line.startswith("Attributes {"):
+            continue
+        if line.endswith("{"):
+            current_section = OrderedDict()
+            data[line.split()[0]] = current_section
+            continue
+        if line == "}":
+            current_section = None
+            continue
+        if current_section is not None:
+            parts = line.split(maxsplit=2)
+            if len(parts) == 3:
+                datatype, description, value = parts
+                current_section[description] = {"datatype": datatype, "value": value.strip('";')}
+    return data
+
+
+# What an NRT range check used to cost: parse, save/load the JSON, re-split actual_range
+def legacyTimeLookup(response_text):
+    data = json.loads(json.dumps(legacyParse(response_text), indent=4))
+    start_time_str, end_time_str = data['time']['actual_range']['value'].split(', ')
+    return int(float(start_time_str)), int(float(end_time_str))
+
+
+def syntheticDas(index: int, variables: int) -> str:
+    lines = ["Attributes {", " s {", "  time {",
+             '    String _CoordinateAxisType "Time";',
+             f"    Float64 actual_range {1.4e9 + index:.7e}, {1.7e9 + index:.7e};",
+             '    String units "seconds since 1970-01-01T00:00:00Z";',
+             "  }"]
+    for var in range(variables):
+        lines.extend([
+            f"  var_{var} {{",
+            "    Float32 _FillValue -9999.0;",
+            f"    Float32 actual_range {var * 0.5}, {var * 2.5};",
+            '    String coverage_content_type "physicalMeasurement";',
+            f'    String long_name "Synthetic variable {var}";',
+            "    Int16 precision 2;",
+            '    String units "degree_C";',
+            "  }"])
+    lines.extend([" }", "  NC_Global {",
+                  '    String history "created',
+                  'updated with a \\"quoted\\" note";',
+                  '    String license "CC-BY";',
+                  "    Float64 Easternmost_Easting -80.5;",
+                  "  }", "}"])
+    return "\n".join(lines)
+
+
+def loadCorpus(args) -> list:
+    if args.corpus:
+        corpus = []
+        for name in sorted(os.listdir(args.corpus)):
+            if name.endswith(".das"):
+                with open(os.path.join(args.corpus, name), 'r') as f:
+                    corpus.append(f.read())
+        return corpus
+    return [syntheticDas(i, args.variables) for i in range(args.datasets)]
+
+
+def bench(label: str, func, corpus: list, repeat: int) -> None:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            func(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    per_doc = best / len(corpus) * 1e6
+    print(f"{label:<28} {best:8.3f}s total  {per_doc:9.1f}us/doc")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DAS parsing")
+    parser.add_argument("--corpus", help="Directory of .das files")
+    parser.add_argument("--datasets", type=int, default=1000)
+    parser.add_argument("--variables", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = loadCorpus(args)
+    if not corpus:
+        print("No DAS documents found.")
+        return
+    size_mb = sum(len(text) for text in corpus) / 1e6
+    print(f"{len(corpus)} DAS documents, {size_mb:.1f} MB")
+
+    bench("legacy line parser", legacyParse, corpus, args.repeat)
+    bench("parseDasStream (typed)", lambda text: dc.parseDasStream(text.splitlines()), corpus, args.repeat)
+    bench("parseDasResponse (compat)", dc.parseDasResponse, corpus, args.repeat)
+    bench("legacy + JSON time lookup", legacyTimeLookup, corpus, args.repeat)
+    bench("typed + getTimeRange", lambda text: dc.getTimeRange(dc.parseDasStream(text.splitlines())), corpus, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
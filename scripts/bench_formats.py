@@ -0,0 +1,133 @@
+#Benchmarks the tabledap response formats on synthetic data.
+#For each format: bytes on disk, bytes gzip sends over the wire, streaming parse time,
+#DataFrame load time, and the peak memory (tracemalloc) of each.
+#   python scripts/bench_formats.py --rows 200000
+#   python scripts/bench_formats.py --rows 50000 --formats csvp jsonlCSV1 nc
+
+import os
+import sys
+import csv
+import json
+import gzip
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from erddap2agol.src import response_formats as rf
+
+COLUMNS = [("station", None), ("longitude", "degrees_east"), ("latitude", "degrees_north"),
+           ("sea_water_temperature", "degree_C"), ("salinity", "PSU"), ("depth", "m"), ("time", "UTC")]
+
+
+def syntheticRows(count: int) -> list:
+    random.seed(1)
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for i in range(count):
+        rows.append([f"station_{i % 25}",
+                     round(-90 + random.random(), 5),
+                     round(27 + random.random(), 5),
+                     round(20 + random.random() * 10, 3),
+                     round(30 + random.random() * 6, 3) if i % 17 else None,
+                     float(i % 5),
+                     (start + timedelta(minutes=6 * i)).strftime('%Y-%m-%dT%H:%M:%SZ')])
+    return rows
+
+
+# Writes rows the way ERDDAP lays out each format
+def writeFormat(fmt: rf.ResponseFormat, rows: list, path: str) -> None:
+    names = [name for name, _ in COLUMNS]
+    if fmt.layout == "nc":
+        writeNc(rows, path)
+        return
+    with open(path, 'w', encoding="utf-8", newline="") as f:
+        if fmt.layout in ("jsonl", "jsonl1"):
+            if fmt.layout == "jsonl1":
+                f.write(json.dumps(names) + "\n")
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+            return
+        writer = csv.writer(f, delimiter=fmt.delimiter, lineterminator="\n")
+        if fmt.layout == "inline":
+            writer.writerow([f"{name} ({units})" if units else name for name, units in COLUMNS])
+        elif fmt.layout == "tworow":
+            writer.writerow(names)
+            writer.writerow([units or "" for _, units in COLUMNS])
+        for row in rows:
+            writer.writerow(["NaN" if value is None else value for value in row])
+
+
+def writeNc(rows: list, path: str) -> None:
+    import numpy as np
+    netCDF4 = rf.netCDF4
+    with netCDF4.Dataset(path, "w") as nc:
+        nc.createDimension("row", len(rows))
+        nc.createDimension("station_strlen", 12)
+        station = nc.createVariable("station", "S1", ("row", "station_strlen"))
+        station[:] = netCDF4.stringtochar(np.array([row[0] for row in rows], dtype="S12"))
+        for index, (name, units) in enumerate(COLUMNS[1:-1], start=1):
+            var = nc.createVariable(name, "f8", ("row",), fill_value=np.nan)
+            var.units = units
+            var[:] = [np.nan if row[index] is None else row[index] for row in rows]
+        times = nc.createVariable("time", "f8", ("row",))
+        times.units = "seconds since 1970-01-01T00:00:00Z"
+        times[:] = [datetime.strptime(row[-1], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+                    for row in rows]
+
+
+def gzipSize(path: str) -> int:
+    with open(path, 'rb') as f:
+        return len(gzip.compress(f.read(), compresslevel=6))
+
+
+def measure(func) -> tuple:
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def consumeRows(path: str, fmt: rf.ResponseFormat, columns: list) -> None:
+    _, _, rows = rf.openRows(path, fmt, columns)
+    for _ in rows:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tabledap response formats")
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--formats", nargs="*", default=list(rf.FORMATS))
+    args = parser.parse_args()
+
+    rows = syntheticRows(args.rows)
+    columns = [name for name, _ in COLUMNS]
+    print(f"{args.rows} synthetic rows, {len(columns)} columns\n")
+    print(f"{'format':<11}{'bytes':>12}{'gzip':>12}{'stream s':>10}{'stream MB':>11}{'frame s':>10}{'frame MB':>10}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in args.formats:
+            try:
+                fmt = rf.getFormat(name)
+            except ValueError as e:
+                print(f"{name:<11}skipped: {e}")
+                continue
+            path = os.path.join(tmp_dir, f"bench.{name}")
+            writeFormat(fmt, rows, path)
+            size = os.path.getsize(path)
+            wire = gzipSize(path)
+            stream_time, stream_peak = measure(lambda: consumeRows(path, fmt, columns))
+            frame_time, frame_peak = measure(lambda: rf.readFrame(path, fmt, columns))
+            print(f"{name:<11}{size:>12}{wire:>12}{stream_time:>10.3f}{stream_peak / 1e6:>11.2f}"
+                  f"{frame_time:>10.3f}{frame_peak / 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()